@@ -0,0 +1,6 @@
+"""
+Benchmarks for the Test Automation Tool
+
+Runs the tool against a local mock of the OpenAI and Anthropic APIs, so
+throughput can be measured offline without API keys or cost.
+"""
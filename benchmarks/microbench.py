@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the pure-Python hot paths
+
+Times read_questions, format_input_tree_for_prompt, classify_response,
+categorize_response and save_output_tree on synthetic inputs (a 100k-line
+question file, a deep input tree, long responses), saves the timings as a
+baseline and fails when a path got slower than the baseline by more than
+the allowed threshold.
+
+Usage (from the repository root):
+    python -m benchmarks.microbench --save-baseline    # on the reference commit
+    python -m benchmarks.microbench                    # on your change; exits 1 on a regression
+
+The committed baseline (benchmarks/microbench_baseline.json) was recorded at
+the default scale. A missing baseline file, or a benchmark without a baseline
+entry of the same input size (e.g. with another --scale), also exits 1.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import List, Dict, Any, Callable
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import main
+
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'microbench_baseline.json')
+
+# A path fails when it is more than this much slower than its baseline (0.25 = 25%)
+DEFAULT_THRESHOLD = 0.25
+
+WORDS = (
+    "stack queue deque list array node pointer push pop enqueue dequeue insert remove search update "
+    "iterator position capacity resize amortized tree heap hash map key value order first last top "
+    "front back element index complexity constant linear logarithmic implementation interface"
+).split()
+
+CLASSIFICATION_TYPES = ["Definition", "Application Use cases", "Abstract Data type", "Comparative", "Misleading"]
+
+
+def generate_questions_file(path: str, lines: int, rng: random.Random) -> str:
+    """Writes a question file mixing structured lines, simple lines, comments and blank lines."""
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(lines):
+            kind = i % 10
+            if kind == 0:
+                f.write(f"# Section {i // 10}\n")
+            elif kind == 1:
+                f.write("\n")
+            elif kind < 4:
+                f.write(f"What is the {rng.choice(WORDS)} of a {rng.choice(WORDS)} {i}?\n")
+            else:
+                keywords = "|".join(rng.sample(WORDS, 4))
+                f.write(f"What is a {rng.choice(WORDS)} {i}?|Chapter {6 + i % 5}|{rng.choice(WORDS).title()}|Good|Undergraduate|"
+                        f"New Topic|{rng.choice(CLASSIFICATION_TYPES)}|Correct & Complete|{keywords}\n")
+    return path
+
+
+def generate_input_tree(depth: int, breadth: int, rng: random.Random) -> Dict[str, Any]:
+    """A tree of nested dicts breadth wide and depth deep whose leaves are lists of topics."""
+    if depth <= 1:
+        return {f"{rng.choice(WORDS).title()} {i}": rng.sample(CLASSIFICATION_TYPES, 3) for i in range(breadth)}
+    return {f"{rng.choice(WORDS).title()} {i}": generate_input_tree(depth - 1, breadth, rng) for i in range(breadth)}
+
+
+def _count_nodes(tree: Any) -> int:
+    if isinstance(tree, dict):
+        return sum(1 + _count_nodes(value) for value in tree.values())
+    if isinstance(tree, list):
+        return sum(_count_nodes(item) for item in tree)
+    return 1
+
+
+def generate_response(words: int, rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)) + "."
+
+
+def generate_response_data(count: int, words: int, rng: random.Random) -> List[Dict[str, Any]]:
+    """count (response_data, expected keywords) pairs with long responses; some are errors or clarification requests."""
+    items = []
+    for i in range(count):
+        response_data = {"service": ("copilot", "claude", "chatgpt")[i % 3], "question": f"What is a {rng.choice(WORDS)}?",
+                         "response": generate_response(words, rng), "prompt_used": ""}
+        if i % 20 == 0:
+            response_data.update(response="", error="Injected error")
+        elif i % 20 == 1:
+            response_data["response"] = "Could you clarify what you mean? " + response_data["response"]
+        items.append((response_data, rng.sample(WORDS, 4)))
+    return items
+
+
+def generate_results(questions: int, words: int, rng: random.Random) -> List[Dict[str, Any]]:
+    """Categorized question results shaped like process_question's output."""
+    results = []
+    for i in range(questions):
+        keywords = rng.sample(WORDS, 4)
+        question = f"What is a {rng.choice(WORDS)} {i}?"
+        responses = []
+        for service in ("copilot", "claude", "chatgpt"):
+            response_data = {"service": service, "question": question, "context_tree": None, "input_tree": None,
+                             "response": generate_response(words, rng), "prompt_used": "Input Tree:\n...\n\nQuestion: " + question}
+            responses.append(main.categorize_response(response_data, keywords))
+        results.append({"question": question, "expected_keywords": keywords, "responses": responses})
+    return results
+
+
+def _time(fn: Callable[[], Any], repeat: int) -> float:
+    """Best of repeat runs of fn(), in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_microbenchmarks(scale: float = 1.0, repeat: int = 5, seed: int = 0, only: List[str] = None) -> Dict[str, Dict[str, Any]]:
+    """Runs the microbenchmarks; returns {name: {"seconds": best time, "size": input size}}."""
+    rng = random.Random(seed)
+    workdir = tempfile.mkdtemp(prefix='microbench_')
+    results = {}
+
+    def bench(name: str, size: int, fn: Callable[[], Any]):
+        if only and name not in only:
+            return
+        results[name] = {"seconds": round(_time(fn, repeat), 6), "size": size}
+        print(f"  {name:<32}{results[name]['seconds']:>10.4f}s  ({size} items)", flush=True)
+
+    try:
+        lines = max(1, int(100_000 * scale))
+        questions_path = generate_questions_file(os.path.join(workdir, 'questions.txt'), lines, rng)
+        bench("read_questions", lines, lambda: sum(1 for _ in main.read_questions(questions_path)))
+
+        tree = generate_input_tree(6, max(2, round(5 * scale ** (1 / 6))), rng)
+        bench("format_input_tree_for_prompt", _count_nodes(tree), lambda: main.format_input_tree_for_prompt(tree))
+
+        items = generate_response_data(max(1, int(2_000 * scale)), 1_000, rng)
+        bench("classify_response", len(items), lambda: [main.classify_response(response_data, keywords) for response_data, keywords in items])
+        bench("categorize_response", len(items), lambda: [main.categorize_response(response_data, keywords) for response_data, keywords in items])
+
+        question_results = generate_results(max(1, int(5_000 * scale)), 300, rng)
+        output_path = os.path.join(workdir, 'output.json')
+        bench("save_output_tree", len(question_results), lambda: main.save_output_tree(question_results, output_path))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare_to_baseline(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Returns a message for every benchmark that is slower than its baseline by more than threshold or has no comparable baseline."""
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get("benchmarks", {}).get(name)
+        if reference is None or reference.get("size") != result["size"]:
+            print(f"  {name:<32}no comparable baseline  FAILED")
+            regressions.append(f"{name} has no baseline entry for size {result['size']} (run with --save-baseline)")
+            continue
+        ratio = result["seconds"] / reference["seconds"] if reference["seconds"] else 1.0
+        limit = baseline.get("thresholds", {}).get(name, threshold)
+        status = "REGRESSION" if ratio > 1 + limit else "ok"
+        print(f"  {name:<32}{reference['seconds']:>10.4f}s -> {result['seconds']:.4f}s  ({ratio:.2f}x, limit {1 + limit:.2f}x)  {status}")
+        if status != "ok":
+            regressions.append(f"{name} is {ratio:.2f}x slower than the baseline (limit {1 + limit:.2f}x)")
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Microbenchmarks and regression gate for the pure-Python hot paths')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help='Baseline file (default: benchmarks/microbench_baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline instead of comparing')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help=f'Allowed slowdown before failing, e.g. 0.25 = 25%% (default: the baseline\'s, or {DEFAULT_THRESHOLD})')
+    parser.add_argument('--scale', type=float, default=1.0, help='Input size factor, e.g. 0.1 for a quick run (default: 1)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per benchmark; the best time counts (default: 5)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic inputs (default: 0)')
+    parser.add_argument('--only', default=None, help='Comma-separated benchmarks to run')
+    parser.add_argument('--json', dest='json_path', default=None, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    only = [name.strip() for name in args.only.split(',')] if args.only else None
+    print(f"Running microbenchmarks (scale {args.scale}, best of {args.repeat})...")
+    results = run_microbenchmarks(args.scale, args.repeat, args.seed, only)
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        baseline = {"threshold": args.threshold if args.threshold is not None else DEFAULT_THRESHOLD,
+                    "scale": args.scale, "seed": args.seed, "python": sys.version.split()[0], "benchmarks": results}
+        if os.path.exists(args.baseline):
+            # Keep per-benchmark thresholds and benchmarks that were not run this time
+            with open(args.baseline, 'r', encoding='utf-8') as f:
+                previous = json.load(f)
+            if "thresholds" in previous:
+                baseline["thresholds"] = previous["thresholds"]
+            if only:
+                baseline["benchmarks"] = dict(previous.get("benchmarks", {}), **results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}.")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline first.")
+        sys.exit(1)
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    threshold = args.threshold if args.threshold is not None else baseline.get("threshold", DEFAULT_THRESHOLD)
+    print(f"\nComparing with {args.baseline}:")
+    regressions = compare_to_baseline(results, baseline, threshold)
+    if regressions:
+        print("\nPerformance regressions:")
+        for message in regressions:
+            print(f"  - {message}")
+        sys.exit(1)
+    print("\nNo regressions.")
+
+
+if __name__ == '__main__':
+    main_cli()
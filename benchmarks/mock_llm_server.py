@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Mock LLM server
+
+A local stand-in for the parts of the OpenAI and Anthropic HTTP APIs that
+main.py uses: chat completions and messages (plain and streamed), the OpenAI
+Batch API (files + batches) and Anthropic Message Batches. Latency, jitter,
+error rate and response length are configurable, so benchmarks can run
+offline against realistic timings.
+
+Point the SDKs at it with
+    OPENAI_BASE_URL=http://127.0.0.1:<port>/v1
+    ANTHROPIC_BASE_URL=http://127.0.0.1:<port>
+and any non-empty API key.
+"""
+
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any, Optional, List
+
+FILLER_WORDS = (
+    "the data structure stores elements so that operations run in constant or logarithmic time "
+    "depending on the implementation an array list linked node pointer index insert remove search "
+    "update traverse order first last top front back capacity resize amortized"
+).split()
+
+# (status code, error type) of the errors injected with --error-rate
+INJECTED_ERRORS = [(503, "overloaded_error"), (500, "api_error"), (429, "rate_limit_error")]
+
+
+class MockLLMServer:
+    """Serves the mock APIs from a background thread.
+
+    Every completion waits latency ± jitter seconds before its first token
+    and then stream_interval seconds per chunk of CHUNK_WORDS words, whether
+    it is streamed or not. With error_rate, that fraction of completion
+    requests fails with a 500, 503 or 429 (the 429 carries retry-after-ms).
+    Batch jobs finish batch_latency seconds after they are created.
+    """
+
+    CHUNK_WORDS = 4
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.2, jitter: float = 0.05,
+                 error_rate: float = 0.0, response_words: int = 80, stream_interval: float = 0.005,
+                 batch_latency: float = 1.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.response_words = response_words
+        self.stream_interval = stream_interval
+        self.batch_latency = batch_latency
+        self.stats = {"requests": 0, "errors": 0, "streamed": 0, "batch_requests": 0}
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._files: Dict[str, bytes] = {}
+        self._batches: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+        handler = type("Handler", (_Handler,), {"mock": self})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockLLMServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _new_id(self, prefix: str) -> str:
+        return f"{prefix}{next(self._ids)}"
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self.stats[key] += n
+
+    def first_token_delay(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def injected_error(self) -> Optional[tuple]:
+        """Returns (status, error type) for a request that should fail, or None."""
+        with self._lock:
+            if self.error_rate and self._random.random() < self.error_rate:
+                return self._random.choice(INJECTED_ERRORS)
+        return None
+
+    def answer(self, prompt: str) -> str:
+        """A deterministic answer for prompt: the question's words followed by filler."""
+        rng = random.Random(prompt)
+        question_words = re.findall(r"[A-Za-z]+", prompt)[-12:]
+        words = question_words + [rng.choice(FILLER_WORDS) for _ in range(max(0, self.response_words - len(question_words)))]
+        return " ".join(words[:self.response_words]) + "."
+
+    def chunks(self, text: str) -> List[str]:
+        words = text.split(" ")
+        return [" ".join(words[i:i + self.CHUNK_WORDS]) + (" " if i + self.CHUNK_WORDS < len(words) else "")
+                for i in range(0, len(words), self.CHUNK_WORDS)]
+
+    @staticmethod
+    def usage(prompt: str, text: str) -> Dict[str, int]:
+        return {"input_tokens": len(prompt) // 4 + 1, "output_tokens": len(text) // 4 + 1}
+
+    # --- response bodies ---
+
+    def chat_completion(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        prompt = body["messages"][-1]["content"]
+        text = self.answer(prompt)
+        usage = self.usage(prompt, text)
+        return {
+            "id": self._new_id("chatcmpl-"), "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": usage["input_tokens"], "completion_tokens": usage["output_tokens"],
+                      "total_tokens": usage["input_tokens"] + usage["output_tokens"]}
+        }
+
+    def message(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        prompt = "".join(block["text"] for block in body.get("system") or []) + body["messages"][-1]["content"]
+        text = self.answer(prompt)
+        return {
+            "id": self._new_id("msg_"), "type": "message", "role": "assistant", "model": body["model"],
+            "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": self.usage(prompt, text)
+        }
+
+    def create_openai_batch(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        lines = []
+        for line in self._files[body["input_file_id"]].decode("utf-8").splitlines():
+            request = json.loads(line)
+            lines.append(json.dumps({"id": self._new_id("batch_req_"), "custom_id": request["custom_id"],
+                                     "response": {"status_code": 200, "request_id": "", "body": self.chat_completion(request["body"])},
+                                     "error": None}))
+        self._count("batch_requests", len(lines))
+        output_file_id = self._new_id("file-")
+        self._files[output_file_id] = ("\n".join(lines) + "\n").encode("utf-8")
+        batch = {
+            "id": self._new_id("batch_"), "object": "batch", "endpoint": body["endpoint"], "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"], "created_at": int(time.time()), "status": "in_progress",
+            "output_file_id": None, "error_file_id": None, "_output_file_id": output_file_id, "_done_at": time.time() + self.batch_latency
+        }
+        self._batches[batch["id"]] = batch
+        return batch
+
+    def create_message_batch(self, body: Dict[str, Any], base_url: str) -> Dict[str, Any]:
+        results = [{"custom_id": request["custom_id"], "result": {"type": "succeeded", "message": self.message(request["params"])}}
+                   for request in body["requests"]]
+        self._count("batch_requests", len(results))
+        batch_id = self._new_id("msgbatch_")
+        batch = {
+            "id": batch_id, "type": "message_batch", "processing_status": "in_progress",
+            "request_counts": {"processing": len(results), "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0},
+            "created_at": "2024-01-01T00:00:00Z", "expires_at": "2024-01-02T00:00:00Z", "ended_at": None,
+            "cancel_initiated_at": None, "archived_at": None, "results_url": None,
+            "_results_url": f"{base_url}/v1/messages/batches/{batch_id}/results",
+            "_results": ("\n".join(json.dumps(result) for result in results) + "\n").encode("utf-8"),
+            "_done_at": time.time() + self.batch_latency
+        }
+        self._batches[batch_id] = batch
+        return batch
+
+    def batch_state(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        batch = self._batches.get(batch_id)
+        if batch is None:
+            return None
+        if time.time() >= batch["_done_at"]:
+            if batch.get("object") == "batch":
+                batch.update(status="completed", output_file_id=batch["_output_file_id"])
+            elif batch["processing_status"] != "ended":
+                counts = batch["request_counts"]
+                batch.update(processing_status="ended", results_url=batch["_results_url"], ended_at="2024-01-01T00:00:01Z",
+                             request_counts=dict(counts, processing=0, succeeded=counts["processing"]))
+        return {key: value for key, value in batch.items() if not key.startswith("_")}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock: MockLLMServer = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, status: int = 200, content_type: str = "application/json", headers: Optional[Dict[str, str]] = None):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, error_type: str, message: str):
+        headers = {"retry-after-ms": "100"} if status == 429 else None
+        self._send({"type": "error", "error": {"type": error_type, "message": message}}, status, headers=headers)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        match = re.fullmatch(r"/v1/files/([^/]+)/content", path)
+        if match and match.group(1) in self.mock._files:
+            return self._send(self.mock._files[match.group(1)], content_type="application/octet-stream")
+        match = re.fullmatch(r"/v1/messages/batches/([^/]+)/results", path)
+        if match and match.group(1) in self.mock._batches:
+            return self._send(self.mock._batches[match.group(1)]["_results"], content_type="application/binary")
+        match = re.fullmatch(r"/v1/(?:messages/)?batches/([^/]+)", path)
+        if match:
+            batch = self.mock.batch_state(match.group(1))
+            if batch is not None:
+                return self._send(batch)
+        self._send_error(404, "not_found_error", f"Unknown path {path}")
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        raw = self._read_body()
+        if path == "/v1/files":
+            return self._upload_file(raw)
+        body = json.loads(raw or b"{}")
+        if path == "/v1/batches":
+            return self._send(self.mock.batch_state(self.mock.create_openai_batch(body)["id"]))
+        if path == "/v1/messages/batches":
+            batch = self.mock.create_message_batch(body, f"http://{self.headers.get('Host')}")
+            return self._send(self.mock.batch_state(batch["id"]))
+        if path not in ("/v1/chat/completions", "/v1/messages"):
+            return self._send_error(404, "not_found_error", f"Unknown path {path}")
+
+        self.mock._count("requests")
+        error = self.mock.injected_error()
+        if error is not None:
+            self.mock._count("errors")
+            return self._send_error(error[0], error[1], "Injected error")
+
+        if path == "/v1/chat/completions":
+            response = self.mock.chat_completion(body)
+            text = response["choices"][0]["message"]["content"]
+        else:
+            response = self.mock.message(body)
+            text = response["content"][0]["text"]
+        chunks = self.mock.chunks(text)
+        time.sleep(self.mock.first_token_delay())
+        if not body.get("stream"):
+            time.sleep(self.mock.stream_interval * len(chunks))
+            return self._send(response)
+        self.mock._count("streamed")
+        if path == "/v1/chat/completions":
+            self._stream_chat_completion(response, chunks)
+        else:
+            self._stream_message(response, chunks)
+
+    def _upload_file(self, raw: bytes):
+        # multipart/form-data with a single "file" part
+        boundary = re.search(r'boundary="?([^";]+)"?', self.headers.get("Content-Type", "")).group(1).encode()
+        content = b""
+        for part in raw.split(b"--" + boundary):
+            head, _, data = part.partition(b"\r\n\r\n")
+            if b'name="file"' in head:
+                content = data[:-2] if data.endswith(b"\r\n") else data
+        file_id = self.mock._new_id("file-")
+        self.mock._files[file_id] = content
+        self._send({"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                    "filename": "batch.jsonl", "purpose": "batch", "status": "processed"})
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+    def _event(self, data: Dict[str, Any], event: Optional[str] = None):
+        if event:
+            self.wfile.write(f"event: {event}\n".encode("utf-8"))
+        self.wfile.write(b"data: " + json.dumps(data).encode("utf-8") + b"\n\n")
+        self.wfile.flush()
+
+    def _stream_chat_completion(self, response: Dict[str, Any], chunks: List[str]):
+        self._start_stream()
+        base = {key: response[key] for key in ("id", "created", "model")}
+        base["object"] = "chat.completion.chunk"
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(self.mock.stream_interval)
+            self._event(dict(base, choices=[{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]))
+        self._event(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        self._event(dict(base, choices=[], usage=response["usage"]))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def _stream_message(self, response: Dict[str, Any], chunks: List[str]):
+        self._start_stream()
+        usage = response["usage"]
+        self._event({"type": "message_start", "message": dict(response, content=[], stop_reason=None,
+                                                              usage={"input_tokens": usage["input_tokens"], "output_tokens": 1})}, "message_start")
+        self._event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}, "content_block_start")
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(self.mock.stream_interval)
+            self._event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}}, "content_block_delta")
+        self._event({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        self._event({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                     "usage": {"output_tokens": usage["output_tokens"]}}, "message_delta")
+        self._event({"type": "message_stop"}, "message_stop")
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    """Adds the mock server options to parser."""
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds before the first token of each completion (default: 0.2)')
+    parser.add_argument('--jitter', type=float, default=0.05, help='Random ± variation of the latency in seconds (default: 0.05)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of completion requests that fail with 500/503/429 (default: 0)')
+    parser.add_argument('--response-words', type=int, default=80, help='Words per response (default: 80)')
+    parser.add_argument('--stream-interval', type=float, default=0.005, help='Seconds between streamed chunks (default: 0.005)')
+    parser.add_argument('--batch-latency', type=float, default=1.0, help='Seconds until a batch job completes (default: 1)')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for latency and error injection')
+
+
+def server_from_args(args: argparse.Namespace, host: str = "127.0.0.1", port: int = 0) -> MockLLMServer:
+    return MockLLMServer(host, port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                         response_words=args.response_words, stream_interval=args.stream_interval,
+                         batch_latency=args.batch_latency, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock OpenAI/Anthropic API server for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on, 0 for any free port (default: 8765)')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = server_from_args(args, args.host, args.port)
+    # The benchmark runner reads the URL from this first line
+    print(f"Listening on {server.url}", flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
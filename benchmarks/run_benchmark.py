@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark
+
+Starts the mock LLM server and runs the tool against it through its real
+entry points: main.main() (threaded, asyncio and batch mode),
+process_question() and the web server's /run SSE route. Each scenario runs
+in a fresh process, so module-level state and memory peaks do not leak from
+one scenario into the next. Reports questions/sec, question and API call
+latency, CPU time and peak RSS. Runs fully offline.
+
+Usage (from the repository root):
+    python -m benchmarks.run_benchmark --scenarios main,sse --latency 0.5 --error-rate 0.02
+"""
+
+import argparse
+import contextlib
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from typing import List, Dict, Any, Optional, Tuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.mock_llm_server import add_server_arguments
+
+SCENARIOS = ["main", "main-async", "main-batch", "process_question", "sse"]
+
+
+def _call_latencies(results: List[Dict[str, Any]]) -> List[float]:
+    """Wall times of the API calls recorded in the responses' metrics."""
+    latencies = []
+    for question_result in results:
+        for response in question_result["responses"]:
+            metrics = response["response_data"].get("metrics") or {}
+            if metrics.get("wall_time") is not None and not metrics.get("cache_hit"):
+                latencies.append(metrics["wall_time"])
+    return latencies
+
+
+def _run_main(options: Dict[str, Any], extra_args: List[str]) -> Tuple[List[Dict], List[float]]:
+    import main
+    output_path = os.path.abspath("output.json")
+    sys.argv = ["main.py", options["questions_path"], "--output", output_path, "--cache", "off",
+                "--workers", str(options["workers"])] + options["tree_args"] + extra_args
+    main.main()
+    with open(output_path, "r", encoding="utf-8") as f:
+        return json.load(f)["detailed_results"], []
+
+
+def _run_process_question(options: Dict[str, Any]) -> Tuple[List[Dict], List[float]]:
+    import main
+    trees = []
+    for path in (options["context_tree"], options["input_tree"]):
+        tree = None
+        if path:
+            with open(path, "r", encoding="utf-8") as f:
+                tree = json.load(f)
+        trees.append(tree)
+    context_tree, input_tree = trees
+    results = []
+    latencies = []
+    for q_data in main.iter_questions(options["questions_path"]):
+        start = time.perf_counter()
+        results.append(main.process_question(q_data["question"], context_tree, input_tree, use_copilot=True,
+                                             expected_keywords=q_data.get("keywords", [])))
+        latencies.append(time.perf_counter() - start)
+    return results, latencies
+
+
+def _run_sse(options: Dict[str, Any]) -> Tuple[List[Dict], List[float]]:
+    # The web server reads uploads/ and finds the trees next to the questions file
+    os.makedirs("uploads", exist_ok=True)
+    filename = os.path.basename(options["questions_path"])
+    shutil.copy(options["questions_path"], os.path.join("uploads", filename))
+    for path, name in ((options["context_tree"], "example_context_tree.json"), (options["input_tree"], "example_input_tree.json")):
+        if path:
+            shutil.copy(path, os.path.join("uploads", name))
+
+    import web_server
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, web_server.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Each question's latency is the time from its progress event to the next one (or to completion)
+    marks = []
+    connection = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=600)
+    try:
+        connection.request("GET", f"/run/{filename}")
+        response = connection.getresponse()
+        for line in response:
+            if not line.startswith(b"data: "):
+                continue
+            event = json.loads(line[6:])
+            if event["type"] in ("progress", "complete"):
+                marks.append(time.perf_counter())
+            if event["type"] == "error":
+                raise RuntimeError(event["message"])
+            if event["type"] == "complete":
+                break
+    finally:
+        connection.close()
+        server.shutdown()
+
+    job = web_server.jobs.list()[0]
+    with open(job["output_file"], "r", encoding="utf-8") as f:
+        results = json.load(f)["detailed_results"]
+    return results, [end - start for start, end in zip(marks, marks[1:])]
+
+
+def _run_scenario(name: str, workdir: str, base_url: str, options: Dict[str, Any], conn):
+    """Runs one scenario in this (child) process and sends its measurements through conn."""
+    os.environ.update({
+        "OPENAI_API_KEY": "mock",
+        "ANTHROPIC_API_KEY": "mock",
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "ANTHROPIC_BASE_URL": base_url,
+        "MODEL_CACHE_PATH": "",
+        "RESPONSE_CACHE_MODE": "off",
+        "JOBS_DIR": os.path.join(workdir, "jobs")
+    })
+    os.chdir(workdir)
+    runners = {
+        "main": lambda: _run_main(options, []),
+        "main-async": lambda: _run_main(options, ["--async"]),
+        "main-batch": lambda: _run_main(options, ["--batch", "--batch-poll-interval", str(options["batch_poll_interval"])]),
+        "process_question": lambda: _run_process_question(options),
+        "sse": lambda: _run_sse(options)
+    }
+    try:
+        import main
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results, question_latencies = runners[name]()
+        wall = time.perf_counter() - start
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+        cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+        responses = [response for question_result in results for response in question_result["responses"]]
+        conn.send({
+            "scenario": name,
+            "questions": len(results),
+            "responses": len(responses),
+            "errors": sum(1 for response in responses if response["response_data"].get("error")),
+            "wall_seconds": round(wall, 3),
+            "questions_per_second": round(len(results) / wall, 3) if wall else None,
+            "question_latency": main._percentiles([round(latency, 4) for latency in question_latencies]),
+            "call_latency": main._percentiles(_call_latencies(results)),
+            "cpu_seconds": round(cpu, 3),
+            "cpu_percent": round(100 * cpu / wall, 1) if wall else None,
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb": round(usage_after.ru_maxrss / 1024, 1)
+        })
+    except Exception:
+        conn.send({"scenario": name, "error": traceback.format_exc()})
+    finally:
+        conn.close()
+
+
+def start_mock_server(args: argparse.Namespace) -> Tuple[subprocess.Popen, str]:
+    """Starts the mock server in its own process so it does not share CPU time with the scenario."""
+    command = [sys.executable, "-m", "benchmarks.mock_llm_server", "--port", "0",
+               "--latency", str(args.latency), "--jitter", str(args.jitter), "--error-rate", str(args.error_rate),
+               "--response-words", str(args.response_words), "--stream-interval", str(args.stream_interval),
+               "--batch-latency", str(args.batch_latency)]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    process = subprocess.Popen(command, cwd=REPO_ROOT, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith("Listening on "):
+        process.kill()
+        raise RuntimeError("Mock LLM server did not start")
+    return process, line.split("Listening on ", 1)[1].strip()
+
+
+def prepare_questions(questions_file: str, limit: Optional[int], path: str) -> str:
+    """Copies the first limit question lines of questions_file (no blank or comment lines) to path."""
+    with open(questions_file, "r", encoding="utf-8") as f:
+        lines = [line for line in f if line.strip() and not line.lstrip().startswith("#")]
+    if limit:
+        lines = lines[:limit]
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    return path
+
+
+def run_benchmarks(args: argparse.Namespace) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    process, base_url = start_mock_server(args)
+    results = []
+    try:
+        options = {
+            "questions_path": prepare_questions(args.questions_file, args.limit, os.path.join(workdir, "questions.txt")),
+            "context_tree": os.path.abspath(args.context_tree) if args.context_tree else None,
+            "input_tree": os.path.abspath(args.input_tree) if args.input_tree else None,
+            "workers": args.workers,
+            "batch_poll_interval": args.batch_poll_interval
+        }
+        options["tree_args"] = []
+        if options["context_tree"]:
+            options["tree_args"] += ["--context-tree", options["context_tree"]]
+        if options["input_tree"]:
+            options["tree_args"] += ["--input-tree", options["input_tree"]]
+
+        context = multiprocessing.get_context("spawn")
+        for name in args.scenarios:
+            print(f"Running {name}...", flush=True)
+            scenario_dir = os.path.join(workdir, name)
+            os.makedirs(scenario_dir)
+            receiver, sender = context.Pipe(duplex=False)
+            child = context.Process(target=_run_scenario, args=(name, scenario_dir, base_url, options, sender))
+            child.start()
+            sender.close()
+            try:
+                results.append(receiver.recv())
+            except EOFError:
+                results.append({"scenario": name, "error": f"Scenario process exited with code {child.exitcode}"})
+            child.join()
+    finally:
+        process.terminate()
+        process.wait()
+        if args.keep:
+            print(f"Benchmark files kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "mock_server": {key: getattr(args, key) for key in ("latency", "jitter", "error_rate", "response_words", "stream_interval", "batch_latency", "seed")},
+        "questions_file": args.questions_file,
+        "workers": args.workers,
+        "results": results
+    }
+
+
+def _format_seconds(value: Optional[float]) -> str:
+    return f"{value:.3f}" if value is not None else "-"
+
+
+def print_report(report: Dict[str, Any]):
+    header = f"{'scenario':<18}{'questions':>10}{'errors':>8}{'wall s':>9}{'q/s':>8}{'q p50':>8}{'q p95':>8}{'call p95':>10}{'cpu s':>8}{'cpu %':>7}{'rss MB':>8}"
+    print()
+    print(header)
+    print("-" * len(header))
+    for result in report["results"]:
+        if "error" in result:
+            print(f"{result['scenario']:<18}failed:\n{result['error']}")
+            continue
+        print(f"{result['scenario']:<18}{result['questions']:>10}{result['errors']:>8}{result['wall_seconds']:>9.2f}"
+              f"{result['questions_per_second']:>8.2f}{_format_seconds(result['question_latency']['p50']):>8}"
+              f"{_format_seconds(result['question_latency']['p95']):>8}{_format_seconds(result['call_latency']['p95']):>10}"
+              f"{result['cpu_seconds']:>8.2f}{result['cpu_percent']:>7.1f}{result['peak_rss_mb']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark against a local mock LLM server')
+    parser.add_argument('--scenarios', default='main,main-async,process_question,sse',
+                        help=f'Comma-separated scenarios or "all" ({", ".join(SCENARIOS)}; default: main,main-async,process_question,sse)')
+    parser.add_argument('--questions-file', default=os.path.join(REPO_ROOT, 'questions.txt'), help='Questions file (default: questions.txt)')
+    parser.add_argument('--limit', type=int, default=None, help='Use only the first N questions')
+    parser.add_argument('--context-tree', default=os.path.join(REPO_ROOT, 'example_context_tree.json'), help='Context tree JSON file ("" for none)')
+    parser.add_argument('--input-tree', default=os.path.join(REPO_ROOT, 'example_input_tree.json'), help='Input tree JSON file ("" for none)')
+    parser.add_argument('--workers', type=int, default=4, help='--workers passed to main.main() (default: 4)')
+    parser.add_argument('--batch-poll-interval', type=float, default=0.5, help='Batch poll interval for main-batch (default: 0.5)')
+    parser.add_argument('--json', dest='json_path', default=None, help='Also write the report to this JSON file')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary working directory')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    args.scenarios = SCENARIOS if args.scenarios == 'all' else [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    report = run_benchmarks(args)
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nReport saved to {args.json_path}.")
+
+
+if __name__ == '__main__':
+    main()
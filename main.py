@@ -8,9 +8,24 @@ import sys
 import argparse
 import os
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Union
+from typing import List, Dict, Any, Optional, Union, Callable, Iterable, Iterator, Generator
 import json
+import math
+import re
 import time
+import random
+import functools
+from collections import OrderedDict, deque
+import hashlib
+import sqlite3
+import threading
+import asyncio
+import contextvars
+import atexit
+import shutil
+import tempfile
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
 
 # GUI related imports
 try:
@@ -50,6 +65,846 @@ CONTEXT_TREE_SCHEMA = {
 }
 
 
+# Per-provider cap on concurrent in-flight requests (no entry = unlimited)
+PROVIDER_LIMITS: Dict[str, int] = {}
+PROVIDER_SEMAPHORES: Dict[str, threading.BoundedSemaphore] = {}
+
+
+def configure_provider_limits(limits: Dict[str, Optional[int]]):
+    """Sets the maximum number of in-flight requests for each service."""
+    for service, limit in limits.items():
+        if limit:
+            PROVIDER_LIMITS[service] = limit
+            PROVIDER_SEMAPHORES[service] = threading.BoundedSemaphore(limit)
+        else:
+            PROVIDER_LIMITS.pop(service, None)
+            PROVIDER_SEMAPHORES.pop(service, None)
+
+
+@contextmanager
+def provider_slot(service: str):
+    """Holds one in-flight slot of the given service while the block runs."""
+    semaphore = PROVIDER_SEMAPHORES.get(service)
+    if semaphore is None:
+        yield
+        return
+    with semaphore:
+        yield
+
+
+class TokenBucketLimiter:
+    """Token-bucket rate limiter for one service.
+
+    Tracks two buckets that refill continuously: requests per minute (rpm) and
+    tokens per minute (tpm). A limit of None disables that bucket. Callers
+    reserve capacity up front; a reservation may push a bucket into debt, and
+    the caller then waits until the debt has been refilled, which keeps
+    concurrent callers in arrival order.
+    """
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm) if rpm else 0.0
+        self._tokens = float(tpm) if tpm else 0.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60.0)
+
+    def reserve(self, tokens: int = 0) -> float:
+        """Reserves one request and the given tokens; returns seconds to wait before sending."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self._paused_until - now)
+            if self.rpm:
+                self._requests -= 1
+                if self._requests < 0:
+                    wait = max(wait, -self._requests * 60.0 / self.rpm)
+            if self.tpm:
+                self._tokens -= min(tokens, self.tpm)
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens * 60.0 / self.tpm)
+            return wait
+
+    def acquire(self, tokens: int = 0):
+        """Blocks until one request with the given token estimate may be sent."""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int = 0):
+        """Like acquire(), but waits without blocking the event loop."""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def settle(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """Corrects the token bucket once the real usage of a request is known."""
+        if not self.tpm or actual_tokens is None:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(float(self.tpm), self._tokens + min(estimated_tokens, self.tpm) - actual_tokens)
+
+    def pause(self, seconds: float):
+        """Stops handing out capacity for the given time (e.g. after a 429)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+# Per-provider rate limiters, created on first use from <SERVICE>_RPM / <SERVICE>_TPM
+RATE_LIMITERS: Dict[str, TokenBucketLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def _env_limit(name: str) -> Optional[float]:
+    value = os.getenv(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        print(f"Warning: Ignoring invalid value '{value}' for {name}.")
+        return None
+
+
+def configure_rate_limits(rpm: Optional[Dict[str, float]] = None, tpm: Optional[Dict[str, float]] = None):
+    """Sets requests/tokens per minute per service, overriding the environment."""
+    rpm = rpm or {}
+    tpm = tpm or {}
+    with _rate_limiters_lock:
+        for service in set(rpm) | set(tpm):
+            current = RATE_LIMITERS.get(service)
+            RATE_LIMITERS[service] = TokenBucketLimiter(
+                rpm=rpm.get(service, current.rpm if current else _env_limit(f"{service.upper()}_RPM")),
+                tpm=tpm.get(service, current.tpm if current else _env_limit(f"{service.upper()}_TPM"))
+            )
+
+
+def get_rate_limiter(service: str) -> TokenBucketLimiter:
+    """Returns the shared rate limiter of a service."""
+    with _rate_limiters_lock:
+        limiter = RATE_LIMITERS.get(service)
+        if limiter is None:
+            limiter = TokenBucketLimiter(
+                rpm=_env_limit(f"{service.upper()}_RPM"),
+                tpm=_env_limit(f"{service.upper()}_TPM")
+            )
+            RATE_LIMITERS[service] = limiter
+        return limiter
+
+
+def estimate_tokens(text: str, max_tokens: int = 0) -> int:
+    """Rough token estimate for a request: ~4 characters per prompt token plus the completion budget."""
+    return len(text) // 4 + 1 + max_tokens
+
+
+def _error_status(error: Exception) -> Optional[int]:
+    """Extracts the HTTP status code from an SDK exception, if any."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """Reads the Retry-After (or OpenAI's retry-after-ms) header from an SDK exception, if any."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after-ms")) / 1000
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _note_rate_limit_error(service: str, error: Exception):
+    """Pauses the service's limiter when the provider answers 429."""
+    if _error_status(error) == 429:
+        get_rate_limiter(service).pause(_retry_after_seconds(error) or 1.0)
+
+
+# Status codes worth another attempt besides 5xx (which includes Anthropic's 529 overloaded)
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+
+_CONNECTION_ERRORS: tuple = (ConnectionError, TimeoutError)
+if OPENAI_AVAILABLE:
+    _CONNECTION_ERRORS += (openai.APIConnectionError,)
+if ANTHROPIC_AVAILABLE:
+    _CONNECTION_ERRORS += (anthropic.APIConnectionError,)
+
+
+def _is_retryable_error(error: Exception) -> bool:
+    """True for errors that are likely to go away on their own (rate limits, 5xx, dropped connections)."""
+    status = _error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES or status >= 500
+    return isinstance(error, _CONNECTION_ERRORS)
+
+
+# Provider calls are written once, as step generators, and run either blocking
+# (_drive) or on the event loop (_drive_async). A step generator yields the
+# waits and calls it needs and gets each result (or exception) back:
+#   _Sleep(seconds)  wait that long
+#   a Future         wait for its result
+#   a callable       call it; _drive_async awaits what it returns
+# Only the callables, i.e. the actual SDK calls, differ between the two.
+
+class _Sleep:
+    __slots__ = ("seconds",)
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+
+def _call_step(fn: Callable[[], Any]) -> Generator:
+    """Step generator that makes one call of fn."""
+    return (yield fn)
+
+
+def _drive(steps: Generator) -> Any:
+    """Runs a step generator with blocking waits and calls; returns its result."""
+    value = error = None
+    while True:
+        try:
+            step = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        value = error = None
+        try:
+            if isinstance(step, _Sleep):
+                if step.seconds > 0:
+                    time.sleep(step.seconds)
+            elif isinstance(step, Future):
+                value = step.result()
+            else:
+                value = step()
+        except BaseException as e:
+            error = e
+
+
+async def _drive_async(steps: Generator) -> Any:
+    """Runs a step generator on the event loop; returns its result."""
+    value = error = None
+    while True:
+        try:
+            step = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        value = error = None
+        try:
+            if isinstance(step, _Sleep):
+                if step.seconds > 0:
+                    await asyncio.sleep(step.seconds)
+            elif isinstance(step, Future):
+                value = await asyncio.shield(asyncio.wrap_future(step))
+            else:
+                value = await step()
+        except BaseException as e:
+            error = e
+
+
+class RetryPolicy:
+    """Retries transient provider errors with exponential backoff and full jitter.
+
+    A call is retried up to max_retries times when it fails with a retryable
+    error (see _is_retryable_error). The wait before retry n is the provider's
+    Retry-After if it sent one, otherwise a random time between 0 and
+    min(max_delay, base_delay * 2**n). All services draw from one retry budget
+    per run, so a provider outage cannot turn into an unbounded retry storm;
+    once the budget is used up, errors are returned right away. Per-service
+    counters are available from metrics().
+    """
+
+    def __init__(self, max_retries: int = 3, base_delay: float = 1.0, max_delay: float = 60.0, budget: Optional[int] = None):
+        self.max_retries = max(0, int(max_retries))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self._retries_used = 0
+        self._metrics: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def _service_metrics(self, service: str) -> Dict[str, float]:
+        metrics = self._metrics.get(service)
+        if metrics is None:
+            metrics = {"calls": 0, "retries": 0, "recovered": 0, "gave_up": 0, "budget_exhausted": 0, "backoff_seconds": 0.0}
+            self._metrics[service] = metrics
+        return metrics
+
+    def _delay(self, retry: int, error: Exception) -> float:
+        retry_after = _retry_after_seconds(error)
+        if retry_after is not None:
+            return min(max(retry_after, 0.0), self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+    def _next_delay(self, service: str, retry: int, error: Exception) -> Optional[float]:
+        """Returns how long to wait before retrying after error, or None to give up."""
+        if not _is_retryable_error(error):
+            return None
+        with self._lock:
+            metrics = self._service_metrics(service)
+            if retry >= self.max_retries:
+                metrics["gave_up"] += 1
+                return None
+            if self.budget is not None and self._retries_used >= self.budget:
+                metrics["budget_exhausted"] += 1
+                return None
+            self._retries_used += 1
+            delay = self._delay(retry, error)
+            metrics["retries"] += 1
+            metrics["backoff_seconds"] += delay
+        print(f"  [{service}] {_error_status(error) or type(error).__name__}: retrying in {delay:.1f}s ({retry + 1}/{self.max_retries})")
+        return delay
+
+    def _record_call(self, service: str, retries: int):
+        with self._lock:
+            metrics = self._service_metrics(service)
+            metrics["calls"] += 1
+            if retries:
+                metrics["recovered"] += 1
+
+    def steps(self, service: str, call_steps: Callable[[], Generator], on_retry: Optional[Callable[[], None]] = None) -> Generator:
+        """Step generator (see _drive) that runs call_steps(), retrying transient errors.
+
+        Re-raises the last error when giving up. on_retry, if given, is called
+        before every retry.
+        """
+        retry = 0
+        while True:
+            try:
+                result = yield from call_steps()
+            except Exception as e:
+                delay = self._next_delay(service, retry, e)
+                if delay is None:
+                    self._record_call(service, 0)
+                    raise
+                if on_retry is not None:
+                    on_retry()
+                yield _Sleep(delay)
+                retry += 1
+                continue
+            self._record_call(service, retry)
+            return result
+
+    def call(self, service: str, fn: Callable[[], Any], on_retry: Optional[Callable[[], None]] = None) -> Any:
+        """Calls fn(), retrying transient errors; re-raises the last error when giving up."""
+        return _drive(self.steps(service, lambda: _call_step(fn), on_retry))
+
+    def renewed(self) -> "RetryPolicy":
+        """Returns a policy with the same settings and an unused budget."""
+        return RetryPolicy(self.max_retries, self.base_delay, self.max_delay, self.budget)
+
+    @property
+    def retries_used(self) -> int:
+        with self._lock:
+            return self._retries_used
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        """Returns a copy of the per-service retry counters."""
+        with self._lock:
+            return {service: dict(metrics) for service, metrics in self._metrics.items()}
+
+
+def _env_int(name: str, default: Optional[int]) -> Optional[int]:
+    value = _env_limit(name)
+    return int(value) if value is not None else default
+
+
+retry_policy = RetryPolicy(
+    max_retries=_env_int("RETRY_MAX_RETRIES", 3),
+    base_delay=_env_limit("RETRY_BASE_DELAY") or 1.0,
+    max_delay=_env_limit("RETRY_MAX_DELAY") or 60.0,
+    budget=_env_int("RETRY_BUDGET", None)
+)
+
+
+# Retry policy of the current run, set by use_retry_policy; falls back to the global retry_policy
+_run_retry_policy: contextvars.ContextVar = contextvars.ContextVar("run_retry_policy", default=None)
+
+
+def current_retry_policy() -> RetryPolicy:
+    """Returns the retry policy of the current run (see use_retry_policy), or the global one."""
+    return _run_retry_policy.get() or retry_policy
+
+
+@contextmanager
+def use_retry_policy(policy: Optional[RetryPolicy] = None):
+    """Runs the enclosed calls with their own retry policy and budget.
+
+    Without a policy, a new one with the global policy's settings is used.
+    The web server runs every job this way, so concurrent jobs do not share
+    one retry budget. The policy applies in the calling thread, in asyncio
+    tasks it starts and in the worker threads of process_question,
+    run_questions and run_questions_batch.
+    """
+    if policy is None:
+        policy = retry_policy.renewed()
+    token = _run_retry_policy.set(policy)
+    try:
+        yield policy
+    finally:
+        _run_retry_policy.reset(token)
+
+
+def _submit(executor: ThreadPoolExecutor, fn: Callable, *args) -> Future:
+    """Submits fn(*args) to run in a copy of the current context, so the run's retry policy applies."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def configure_retry_policy(max_retries: Optional[int] = None, base_delay: Optional[float] = None, max_delay: Optional[float] = None, budget: Optional[int] = None):
+    """Replaces the global retry policy; arguments left as None keep their current value."""
+    global retry_policy
+    retry_policy = RetryPolicy(
+        max_retries=max_retries if max_retries is not None else retry_policy.max_retries,
+        base_delay=base_delay if base_delay is not None else retry_policy.base_delay,
+        max_delay=max_delay if max_delay is not None else retry_policy.max_delay,
+        budget=budget if budget is not None else retry_policy.budget
+    )
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit breaker is open."""
+
+
+def _is_provider_failure(error: Exception) -> bool:
+    """True for errors that mean the provider itself is failing (5xx, unreachable, key rejected).
+
+    Rate limits (429) and request errors such as an unknown model are not
+    provider failures: the provider is up and answering.
+    """
+    status = _error_status(error)
+    if status is not None:
+        return status >= 500 or status == 401
+    return isinstance(error, _CONNECTION_ERRORS)
+
+
+class CircuitBreaker:
+    """Per-service circuit breaker (closed / open / half-open).
+
+    After failure_threshold consecutive provider failures the breaker opens
+    and every call fails at once with CircuitOpenError. After
+    recovery_timeout seconds it lets a single probe call through (half-open):
+    if the probe succeeds the breaker closes again, otherwise it stays open
+    for another recovery_timeout. A failure_threshold of 0 disables it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, service: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.opened_count = 0
+        self.rejected_count = 0
+        self._failures = 0
+        self._opened_at = 0.0
+        self._last_error = ""
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raises CircuitOpenError if the call must not go to the provider."""
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN:
+                remaining = self._opened_at + self.recovery_timeout - time.monotonic()
+                if remaining > 0:
+                    self.rejected_count += 1
+                    raise CircuitOpenError(
+                        f"Circuit breaker open for {self.service} after {self._failures} consecutive failures "
+                        f"(last error: {self._last_error}); next probe in {remaining:.1f}s"
+                    )
+                self.state = self.HALF_OPEN
+            if self._probe_in_flight:
+                self.rejected_count += 1
+                raise CircuitOpenError(f"Circuit breaker half-open for {self.service}: waiting for a probe request (last error: {self._last_error})")
+            self._probe_in_flight = True
+
+    def record(self, error: Optional[Exception] = None):
+        """Records the outcome of a call that before_call() let through."""
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            self._probe_in_flight = False
+            if error is None or not _is_provider_failure(error):
+                if self.state != self.CLOSED:
+                    print(f"  [{self.service}] Circuit breaker closed")
+                self.state = self.CLOSED
+                self._failures = 0
+                return
+            self._failures += 1
+            self._last_error = str(error)[:200]
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened_count += 1
+                    print(f"  [{self.service}] Circuit breaker opened for {self.recovery_timeout:g}s after {self._failures} consecutive failures")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def _abandon(self):
+        """Frees the probe slot of a call that was cancelled before it finished."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def steps(self, call_steps: Callable[[], Generator]) -> Generator:
+        """Step generator (see _drive) that runs call_steps() if the breaker lets the call through."""
+        self.before_call()
+        try:
+            result = yield from call_steps()
+        except Exception as e:
+            self.record(e)
+            raise
+        except BaseException:
+            self._abandon()
+            raise
+        self.record()
+        return result
+
+
+# Per-service circuit breakers, created on first use
+CIRCUIT_BREAKERS: Dict[str, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+CIRCUIT_FAILURE_THRESHOLD = _env_int("CIRCUIT_FAILURE_THRESHOLD", 5)
+CIRCUIT_RECOVERY_TIMEOUT = _env_limit("CIRCUIT_RECOVERY_TIMEOUT") or 30.0
+
+
+def configure_circuit_breakers(failure_threshold: Optional[int] = None, recovery_timeout: Optional[float] = None):
+    """Sets the circuit breaker settings and resets all breakers."""
+    global CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RECOVERY_TIMEOUT
+    with _circuit_breakers_lock:
+        if failure_threshold is not None:
+            CIRCUIT_FAILURE_THRESHOLD = failure_threshold
+        if recovery_timeout is not None:
+            CIRCUIT_RECOVERY_TIMEOUT = recovery_timeout
+        CIRCUIT_BREAKERS.clear()
+
+
+def get_circuit_breaker(service: str) -> CircuitBreaker:
+    """Returns the shared circuit breaker of a service."""
+    with _circuit_breakers_lock:
+        breaker = CIRCUIT_BREAKERS.get(service)
+        if breaker is None:
+            breaker = CircuitBreaker(service, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RECOVERY_TIMEOUT)
+            CIRCUIT_BREAKERS[service] = breaker
+        return breaker
+
+
+# Process-wide API clients keyed by (provider, api_key). Reusing one client keeps
+# its HTTP connection pool alive, so later calls skip client construction and
+# the TCP/TLS handshake. The SDK clients are safe to share between threads.
+# Their built-in retries are off: retry_policy is the single retry layer.
+_api_clients: Dict[tuple, Any] = {}
+_api_clients_lock = threading.Lock()
+
+
+def get_openai_client(api_key: str):
+    """Returns the shared OpenAI client for the given API key."""
+    with _api_clients_lock:
+        client = _api_clients.get(("openai", api_key))
+        if client is None:
+            client = openai.OpenAI(api_key=api_key, max_retries=0, http_client=openai.DefaultHttpxClient())
+            _api_clients[("openai", api_key)] = client
+        return client
+
+
+def get_anthropic_client(api_key: str):
+    """Returns the shared Anthropic client for the given API key."""
+    with _api_clients_lock:
+        client = _api_clients.get(("anthropic", api_key))
+        if client is None:
+            client = anthropic.Anthropic(api_key=api_key, max_retries=0, http_client=anthropic.DefaultHttpxClient())
+            _api_clients[("anthropic", api_key)] = client
+        return client
+
+
+def get_async_openai_client(api_key: str):
+    """Returns the shared AsyncOpenAI client for the given API key on the running event loop."""
+    key = ("openai-async", api_key, id(asyncio.get_running_loop()))
+    with _api_clients_lock:
+        client = _api_clients.get(key)
+        if client is None:
+            client = openai.AsyncOpenAI(api_key=api_key, max_retries=0, http_client=openai.DefaultAsyncHttpxClient())
+            _api_clients[key] = client
+        return client
+
+
+def get_async_anthropic_client(api_key: str):
+    """Returns the shared AsyncAnthropic client for the given API key on the running event loop."""
+    key = ("anthropic-async", api_key, id(asyncio.get_running_loop()))
+    with _api_clients_lock:
+        client = _api_clients.get(key)
+        if client is None:
+            client = anthropic.AsyncAnthropic(api_key=api_key, max_retries=0, http_client=anthropic.DefaultAsyncHttpxClient())
+            _api_clients[key] = client
+        return client
+
+
+async def close_async_api_clients():
+    """Closes the async API clients that belong to the running event loop."""
+    loop_id = id(asyncio.get_running_loop())
+    with _api_clients_lock:
+        keys = [key for key in _api_clients if len(key) == 3 and key[2] == loop_id]
+        clients = [_api_clients.pop(key) for key in keys]
+    for client in clients:
+        try:
+            await client.close()
+        except Exception:
+            pass
+
+
+@atexit.register
+def close_api_clients():
+    """Closes all shared API clients and their connection pools."""
+    with _api_clients_lock:
+        clients = [client for key, client in _api_clients.items() if len(key) == 2]
+        _api_clients.clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception:
+            pass
+
+
+# Claude models to try, latest models first
+CLAUDE_MODELS = [
+    "claude-3-5-sonnet-20241022",
+    "claude-3-5-sonnet-20240620",
+    "claude-3-opus-20240229",
+    "claude-3-sonnet-20240229",
+    "claude-3-haiku-20240307"
+]
+
+
+class ModelResolutionCache:
+    """Remembers which model of a fallback list last worked.
+
+    Entries expire after ttl seconds and are dropped when the model is reported
+    as unavailable. If a path is given, entries are loaded from and saved to a
+    JSON file so the next run starts with the resolved model.
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: float = 24 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Warning: Could not read model cache {path}: {e}")
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached model for key, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            if time.time() - entry.get("resolved_at", 0) > self.ttl:
+                del self._entries[key]
+                self._save()
+                return None
+            return entry.get("model")
+
+    def set(self, key: str, model: str):
+        """Records model as the working model for key."""
+        with self._lock:
+            if self._entries.get(key, {}).get("model") == model:
+                return
+            self._entries[key] = {"model": model, "resolved_at": time.time()}
+            self._save()
+
+    def invalidate(self, key: str):
+        """Forgets the model cached for key."""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Warning: Could not write model cache {self.path}: {e}")
+
+
+model_cache = ModelResolutionCache(
+    path=os.getenv("MODEL_CACHE_PATH") or None,
+    ttl=_env_limit("MODEL_CACHE_TTL") or 24 * 60 * 60
+)
+
+
+def configure_model_cache(path: Optional[str] = None, ttl: Optional[float] = None):
+    """Replaces the global model cache, e.g. to persist it to a file."""
+    global model_cache
+    model_cache = ModelResolutionCache(path=path, ttl=ttl if ttl is not None else model_cache.ttl)
+
+
+def _is_model_unavailable_error(error: Exception) -> bool:
+    """True if the error means the model itself cannot be used (retired, unknown or no access)."""
+    if _error_status(error) in (403, 404):
+        return True
+    error_str = str(error).lower()
+    return "model" in error_str and ("not found" in error_str or "deprecated" in error_str or "does not exist" in error_str)
+
+
+class ResponseCacheMiss(Exception):
+    """Raised in offline mode when a request has no cached response."""
+
+
+class ResponseCache:
+    """Content-addressed SQLite cache of AI responses.
+
+    Entries are keyed by a hash of service, model, system prompt, prompt,
+    max_tokens and temperature. Modes:
+      off      - the cache is not used
+      read     - read-through: serve hits, call the API on misses and store the result
+      refresh  - always call the API and overwrite the stored result
+      offline  - serve hits only; a miss fails without calling the API
+    Entries older than max_age seconds are ignored and evicted, and the oldest
+    entries are evicted once there are more than max_entries.
+    """
+
+    MODES = ("off", "read", "refresh", "offline")
+
+    def __init__(self, path: str = ".response_cache.sqlite3", mode: str = "off", max_entries: Optional[int] = None, max_age: Optional[float] = None):
+        if mode not in self.MODES:
+            raise ValueError(f"Invalid response cache mode '{mode}'. Valid modes: {', '.join(self.MODES)}")
+        self.path = path
+        self.mode = mode
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._conn = None
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(service: str, model: str, system_prompt: Optional[str], prompt: str, max_tokens: int, temperature: Optional[float]) -> str:
+        key_data = json.dumps([service, model, system_prompt, prompt, max_tokens, temperature], ensure_ascii=False)
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, service TEXT, model TEXT, payload TEXT, created_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+            self._evict()
+        return self._conn
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns the cached payload for key, or None."""
+        with self._lock:
+            row = self._connect().execute("SELECT payload, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or (self.max_age and time.time() - row[1] > self.max_age):
+            return None
+        return json.loads(row[0])
+
+    def put(self, key: str, service: str, model: str, payload: Dict[str, Any]):
+        """Stores a payload for key."""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, service, model, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, service, model, json.dumps(payload, ensure_ascii=False), time.time())
+                )
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._evict()
+
+    def _evict(self):
+        conn = self._conn
+        with conn:
+            if self.max_age:
+                conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,))
+            if self.max_entries:
+                conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+
+    def _lookup(self, service: str, model: str, system_prompt: Optional[str], prompt: str, max_tokens: int, temperature: Optional[float]):
+        """Returns (key, cached payload or None) for a request according to the cache mode."""
+        key = self.make_key(service, model, system_prompt, prompt, max_tokens, temperature)
+        if self.mode in ("read", "offline"):
+            payload = self.get(key)
+            if payload is not None:
+                return key, payload
+            if self.mode == "offline":
+                raise ResponseCacheMiss(f"No cached {service} response for model {model} (offline mode)")
+        return key, None
+
+    def fetch_steps(self, service: str, model: str, system_prompt: Optional[str], prompt: str, max_tokens: int, temperature: Optional[float], call_steps: Callable[[], Generator]) -> Generator:
+        """Step generator (see _drive) returning the payload for a request; runs call_steps() according to the cache mode.
+
+        The returned payload has "cache_hit" set to whether it came from the cache.
+        """
+        if self.mode == "off":
+            return dict((yield from call_steps()), cache_hit=False)
+        key, payload = self._lookup(service, model, system_prompt, prompt, max_tokens, temperature)
+        if payload is not None:
+            return dict(payload, cache_hit=True)
+        payload = yield from call_steps()
+        self.put(key, service, model, payload)
+        return dict(payload, cache_hit=False)
+
+    def close(self):
+        """Closes the SQLite connection."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+response_cache = ResponseCache(
+    path=os.getenv("RESPONSE_CACHE_PATH", ".response_cache.sqlite3"),
+    mode=os.getenv("RESPONSE_CACHE_MODE", "off"),
+    max_entries=int(_env_limit("RESPONSE_CACHE_MAX_ENTRIES") or 0) or None,
+    max_age=_env_limit("RESPONSE_CACHE_MAX_AGE")
+)
+
+
+def configure_response_cache(mode: str, path: Optional[str] = None, max_entries: Optional[int] = None, max_age: Optional[float] = None):
+    """Replaces the global response cache."""
+    global response_cache
+    response_cache.close()
+    response_cache = ResponseCache(
+        path=path or response_cache.path,
+        mode=mode,
+        max_entries=max_entries if max_entries is not None else response_cache.max_entries,
+        max_age=max_age if max_age is not None else response_cache.max_age
+    )
+
+
 def validate_context_tree(context_tree: Dict) -> bool:
     """Validates if the context tree is in the correct format."""
     if not isinstance(context_tree, dict):
@@ -65,47 +920,231 @@ def validate_context_tree(context_tree: Dict) -> bool:
     return True
 
 
-def read_questions(file_path: str) -> List[Dict[str, Any]]:
-    questions = []
+class _Record:
+    """Base of the compact records below: a __slots__ object that reads and writes like the dict it replaces.
+
+    Fields are accessed as record["field"], record.get("field") or
+    record.field. An unset field counts as a missing key, so
+    record.get("error") and "error" in record behave like they did for the
+    dicts. Keys that are not fields (e.g. written to a checkpoint or the
+    response cache by another version) are kept in a separate dict, so they
+    survive the round trip. to_dict() (used by _record_to_json) returns the
+    JSON form.
+    """
+
+    __slots__ = ("_extra",)
+    _fields: tuple = ()
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        else:
+            extra = getattr(self, "_extra", None)
+            if extra is not None and key in extra:
+                return extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any):
+        if key in self._fields:
+            setattr(self, key, value)
+            return
+        try:
+            self._extra[key] = value
+        except AttributeError:
+            self._extra = {key: value}
+
+    def __contains__(self, key: str) -> bool:
+        if key in self._fields:
+            return hasattr(self, key)
+        extra = getattr(self, "_extra", None)
+        return extra is not None and key in extra
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> List[str]:
+        keys = [key for key in self._fields if hasattr(self, key)]
+        extra = getattr(self, "_extra", None)
+        return keys + list(extra) if extra else keys
+
+    def items(self) -> List[tuple]:
+        items = [(key, getattr(self, key)) for key in self._fields if hasattr(self, key)]
+        extra = getattr(self, "_extra", None)
+        if extra:
+            items.extend(extra.items())
+        return items
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def copy(self) -> "_Record":
+        """Returns a shallow copy of the record."""
+        clone = type(self).__new__(type(self))
+        for name in self.__slots__:
+            if hasattr(self, name):
+                setattr(clone, name, getattr(self, name))
+        extra = getattr(self, "_extra", None)
+        if extra is not None:
+            clone._extra = dict(extra)
+        return clone
+
+
+def _record_to_json(value: Any) -> Dict[str, Any]:
+    """json.dump(default=...) hook that serializes records."""
+    if isinstance(value, _Record):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class Question(_Record):
+    """A question read from a question file ("chapter", "topic" and "raw_line" only for structured lines)."""
+
+    __slots__ = ("question", "keywords", "chapter", "topic", "raw_line", "input_tree")
+    _fields = __slots__
+
+    def __init__(self, question: str, keywords: List[str], **fields):
+        self.question = question
+        self.keywords = keywords
+        for name, value in fields.items():
+            self[name] = value
+
+
+class ServiceResponse(_Record):
+    """The response_data of one service for one question, as returned by the ask_* functions.
+
+    The trees are shared references, and the prompt is kept as the shared
+    PromptBuilder plus the question, so the full prompt_used text is only
+    built when it is read (e.g. while writing the output).
+    """
+
+    __slots__ = ("service", "question", "context_tree", "input_tree", "response", "_prompt", "error", "model_used",
+                 "cache_hit", "usage", "metrics", "batch_id", "keyword_analysis")
+    _fields = ("service", "question", "context_tree", "input_tree", "response", "prompt_used", "error", "model_used",
+               "cache_hit", "usage", "metrics", "batch_id", "keyword_analysis")
+
+    def __init__(self, service: str, question: str, context_tree: Optional[Dict], input_tree: Optional[Dict],
+                 prompt_used: Union[str, "PromptBuilder"], response: str = "", **fields):
+        self.service = service
+        self.question = question
+        self.context_tree = context_tree
+        self.input_tree = input_tree
+        self.response = response
+        self._prompt = prompt_used
+        for name, value in fields.items():
+            self[name] = value
+
+    @property
+    def prompt_used(self) -> str:
+        prompt = self._prompt
+        return prompt.build(self.question) if isinstance(prompt, PromptBuilder) else prompt
+
+    @prompt_used.setter
+    def prompt_used(self, value: str):
+        self._prompt = value
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], prompt_builder: Optional["PromptBuilder"] = None) -> "ServiceResponse":
+        """Builds a record from its dict form; prompt_builder replaces prompt_used if it renders the same prompt."""
+        fields = dict(data)
+        prompt_used = fields.pop("prompt_used", "")
+        if prompt_builder is not None and prompt_used == prompt_builder.build(fields.get("question", "")):
+            prompt_used = prompt_builder
+        return cls(fields.pop("service"), fields.pop("question", ""), fields.pop("context_tree", None),
+                   fields.pop("input_tree", None), prompt_used, **fields)
+
+
+class CategorizedResponse(_Record):
+    """A response with its Output tree category, as returned by categorize_response."""
+
+    __slots__ = ("validity", "result", "response_data")
+    _fields = __slots__
+
+    def __init__(self, validity: str, result: str, response_data: Dict[str, Any]):
+        self.validity = validity
+        self.result = result
+        self.response_data = response_data
+
+
+def _parse_question_line(line: str) -> Optional[Question]:
+    """Parses one stripped line of a question file; returns None for lines without a question."""
+    # Check if it's a structured format separated by pipe (|)
+    if '|' in line:
+        parts = [p.strip() for p in line.split('|')]
+        question = parts[0] if parts else ""
+        if not question:
+            return None
+        
+        # Extract keywords (typically after "Correct & Complete" or from field 8 onwards)
+        keywords = []
+        if len(parts) > 8:
+            # Look for "Correct & Complete" or similar patterns
+            keyword_start_idx = 8
+            for i, part in enumerate(parts):
+                if i >= 7 and ("Complete" in part or "Correct" in part):
+                    keyword_start_idx = i + 1
+                    break
+            
+            # Extract keywords from keyword_start_idx onwards
+            keywords = [kw.lower() for kw in parts[keyword_start_idx:] if kw]
+        
+        return Question(question, keywords, chapter=parts[1] if len(parts) > 1 else "",
+                        topic=parts[2] if len(parts) > 2 else "", raw_line=line)
+    
+    # Simple question format (the question doubles as the checkpoint key, see checkpoint_options)
+    return Question(line, [])
+
+
+def _is_question_line(line: str) -> bool:
+    """True for lines that hold a question: not blank and not a "#" comment."""
+    return bool(line) and not line.startswith('#')
+
+
+def iter_questions(file_path: str) -> Iterator[Question]:
+    """Yields the questions of a question file one at a time.
+
+    Blank lines and "#" comment lines are skipped. Only the current line is
+    held in memory, so this works for files of any size; the run_questions*
+    functions consume the iterator as they go.
+    """
     with open(file_path, 'r', encoding='utf-8') as f:
         for line in f:
             line = line.strip()
-            if not line:
+            if not _is_question_line(line):
                 continue
-            
-            # Check if it's a structured format separated by pipe (|)
-            if '|' in line:
-                parts = [p.strip() for p in line.split('|')]
-                question = parts[0] if parts else ""
-                
-                if question:
-                    # Extract keywords (typically after "Correct & Complete" or from field 8 onwards)
-                    keywords = []
-                    if len(parts) > 8:
-                        # Look for "Correct & Complete" or similar patterns
-                        keyword_start_idx = 8
-                        for i, part in enumerate(parts):
-                            if i >= 7 and ("Complete" in part or "Correct" in part):
-                                keyword_start_idx = i + 1
-                                break
-                        
-                        # Extract keywords from keyword_start_idx onwards
-                        keywords = [kw.lower() for kw in parts[keyword_start_idx:] if kw]
-                    
-                    questions.append({
-                        "question": question,
-                        "keywords": keywords,
-                        "raw_line": line
-                    })
-            else:
-                # Simple question format
-                questions.append({
-                    "question": line,
-                    "keywords": [],
-                    "raw_line": line
-                })
-    
-    return questions
+            q_data = _parse_question_line(line)
+            if q_data is not None:
+                yield q_data
+
+
+def count_questions(file_path: str) -> int:
+    """Counts the questions of a question file without keeping them (for progress output)."""
+    count = 0
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if _is_question_line(line) and ('|' not in line or line.split('|', 1)[0].strip()):
+                count += 1
+    return count
+
+
+def read_questions(file_path: str) -> List[Question]:
+    """Reads all questions of a question file into a list (see iter_questions)."""
+    return list(iter_questions(file_path))
 
 
 def format_context_for_prompt(context_tree: Dict) -> str:
@@ -161,391 +1200,1745 @@ def format_input_tree_for_prompt(input_tree: Union[Dict, List, str, None], inden
     return "\n".join(lines)
 
 
-def ask_copilot(question: str, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None) -> Dict[str, Any]:
-    # Include Context and Input tree in the prompt
-    context_str = format_context_for_prompt(context_tree) if context_tree else ""
-    input_str = format_input_tree_for_prompt(input_tree) if input_tree else ""
-    
-    full_prompt = question
-    prompt_parts = []
-    
-    if input_str:
-        prompt_parts.append(f"Input Tree:\n{input_str}")
-    if context_str:
-        prompt_parts.append(f"Context:\n{context_str}")
-    
-    if prompt_parts:
-        full_prompt = "\n\n".join(prompt_parts) + f"\n\nQuestion: {question}"
-    
-    api_key = os.getenv("OPENAI_API_KEY")
-    copilot_model = os.getenv("COPILOT_MODEL", "gpt-3.5-turbo")
-    
-    if not api_key:
-        return {
-            "service": "copilot",
-            "question": question,
-            "context_tree": context_tree,
-            "input_tree": input_tree,
-            "response": "",
-            "prompt_used": full_prompt,
-            "error": "OPENAI_API_KEY environment variable not set"
-        }
-    
-    if OPENAI_AVAILABLE:
-        try:
-            client = openai.OpenAI(api_key=api_key)
-            response = client.chat.completions.create(
-                model=copilot_model,  # Model for Copilot
-                messages=[
-                    {"role": "system", "content": "You are a helpful coding assistant GitHub Copilot."},
-                    {"role": "user", "content": full_prompt}
-                ],
-                max_tokens=1000,
-                temperature=0.7
-            )
-            response_text = response.choices[0].message.content
-            return {
-                "service": "copilot",
-                "question": question,
-                "context_tree": context_tree,
-                "input_tree": input_tree,
-                "response": response_text,
-                "prompt_used": full_prompt,
-                "model_used": copilot_model
-            }
-        except Exception as e:
-            return {
-                "service": "copilot",
-                "question": question,
-                "context_tree": context_tree,
-                "input_tree": input_tree,
-                "response": "",
-                "prompt_used": full_prompt,
-                "error": str(e)
-            }
+COPILOT_SYSTEM_PROMPT = "You are a helpful coding assistant GitHub Copilot."
+CHATGPT_SYSTEM_PROMPT = "You are a helpful assistant."
+
+
+class PromptBuilder:
+    """Renders the Input Tree and Context part of a prompt once per pair of trees.
+
+    The rendered prefix is kept as text and as UTF-8 bytes; each question is
+    then only appended to it. Use get_prompt_builder() to share builders.
+    """
+
+    def __init__(self, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None):
+        self.context_tree = context_tree
+        self.input_tree = input_tree
+        
+        # Include Context and Input tree in the prompt
+        context_str = format_context_for_prompt(context_tree) if context_tree else ""
+        input_str = format_input_tree_for_prompt(input_tree) if input_tree else ""
+        
+        prompt_parts = []
+        if input_str:
+            prompt_parts.append(f"Input Tree:\n{input_str}")
+        if context_str:
+            prompt_parts.append(f"Context:\n{context_str}")
+        
+        # The part shared by every question, e.g. for provider-side prompt caching
+        self.static_prefix = "\n\n".join(prompt_parts)
+        self.prefix = self.static_prefix + "\n\nQuestion: " if prompt_parts else ""
+        self.prefix_bytes = self.prefix.encode('utf-8')
+        self.prefix_digest = hashlib.sha256(self.prefix_bytes).hexdigest()
+
+    def build(self, question: str) -> str:
+        """Returns the full prompt for a question."""
+        return self.prefix + question
+
+    def build_bytes(self, question: str) -> bytes:
+        """Returns the full prompt for a question as UTF-8 bytes."""
+        return self.prefix_bytes + question.encode('utf-8')
+
+
+# Prompt builders by tree identity (fast path) and by tree content
+_prompt_builders_by_id: "OrderedDict[tuple, PromptBuilder]" = OrderedDict()
+_prompt_builders_by_hash: "OrderedDict[str, PromptBuilder]" = OrderedDict()
+_prompt_builders_lock = threading.Lock()
+_PROMPT_BUILDER_CACHE_SIZE = 256
+
+
+def _remember(cache: OrderedDict, key, builder: PromptBuilder):
+    cache[key] = builder
+    cache.move_to_end(key)
+    while len(cache) > _PROMPT_BUILDER_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def get_prompt_builder(context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None) -> PromptBuilder:
+    """Returns the shared PromptBuilder for a pair of trees.
+
+    Builders are looked up by the identity of the tree objects first and by a
+    hash of their content second, so the prefix is rendered once per run even
+    when the same trees are loaded more than once. Trees must not be modified
+    after their builder has been created.
+    """
+    id_key = (id(context_tree), id(input_tree))
+    with _prompt_builders_lock:
+        builder = _prompt_builders_by_id.get(id_key)
+        if builder is not None and builder.context_tree is context_tree and builder.input_tree is input_tree:
+            _prompt_builders_by_id.move_to_end(id_key)
+            return builder
+    
+    trees = json.dumps([context_tree, input_tree], sort_keys=True, ensure_ascii=False)
+    hash_key = hashlib.sha256(trees.encode('utf-8')).hexdigest()
+    with _prompt_builders_lock:
+        builder = _prompt_builders_by_hash.get(hash_key)
+        if builder is None:
+            builder = PromptBuilder(context_tree, input_tree)
+            _remember(_prompt_builders_by_hash, hash_key, builder)
+        if builder.context_tree is context_tree and builder.input_tree is input_tree:
+            _remember(_prompt_builders_by_id, id_key, builder)
+        return builder
+
+
+def build_prompt(question: str, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None) -> str:
+    """Builds the full prompt: Input Tree and Context sections followed by the question."""
+    return get_prompt_builder(context_tree, input_tree).build(question)
+
+
+# Question topics that are spelled differently in the input tree
+TOPIC_ALIASES = {
+    "dequeue": "deque"
+}
+
+
+def _normalize_topic(name: str) -> str:
+    """Normalizes a chapter/topic name for matching: lowercase, alphanumerics only, no plural 's'."""
+    normalized = re.sub(r'[^a-z0-9]', '', str(name).lower())
+    if len(normalized) > 3 and normalized.endswith('s'):
+        normalized = normalized[:-1]
+    return TOPIC_ALIASES.get(normalized, normalized)
+
+
+def _trim_tree_to_budget(tree: Dict, token_budget: int) -> Dict:
+    """Returns a copy of tree with list items dropped from the end until its rendering fits the budget."""
+    trimmed = json.loads(json.dumps(tree))
+    lists = []
+    
+    def collect(node):
+        if isinstance(node, dict):
+            for value in node.values():
+                collect(value)
+        elif isinstance(node, list):
+            lists.append(node)
+            for item in node:
+                collect(item)
+    
+    collect(trimmed)
+    while estimate_tokens(format_input_tree_for_prompt(trimmed)) > token_budget:
+        longest = max(lists, key=len, default=None)
+        if not longest:
+            break
+        longest.pop()
+    return trimmed
+
+
+class InputTreeIndex:
+    """Index from a question's (chapter, topic) to the part of the input tree it needs.
+
+    Built once per run from an input tree shaped like
+    {"input": {"Chapter 6": {"Stack": [...], ...}, ...}}. subtree() returns
+    the topic's subtree when the topic is known, the chapter's subtree when
+    only the chapter is known, and the whole tree otherwise. With a token
+    budget, subtrees whose rendering is too long are trimmed to fit. The same
+    subtree object is returned for the same key, so its prompt prefix is only
+    rendered once.
+    """
+
+    def __init__(self, input_tree: Dict, token_budget: Optional[int] = None):
+        self.input_tree = input_tree
+        self.token_budget = token_budget
+        
+        # Trees like {"input": {...}} keep their single root key in every subtree
+        self._root_key = None
+        chapters = input_tree
+        if isinstance(input_tree, dict) and len(input_tree) == 1:
+            root_key, root_value = next(iter(input_tree.items()))
+            if isinstance(root_value, dict):
+                self._root_key = root_key
+                chapters = root_value
+        
+        self._subtrees: Dict[tuple, Dict] = {}
+        if isinstance(chapters, dict):
+            for chapter, topics in chapters.items():
+                chapter_key = _normalize_topic(chapter)
+                self._subtrees[(chapter_key, None)] = self._fit(self._wrap({chapter: topics}))
+                if isinstance(topics, dict):
+                    for topic, items in topics.items():
+                        self._subtrees[(chapter_key, _normalize_topic(topic))] = self._fit(self._wrap({chapter: {topic: items}}))
+        self._full_tree = self._fit(input_tree)
+
+    def _wrap(self, subtree: Dict) -> Dict:
+        return {self._root_key: subtree} if self._root_key is not None else subtree
+
+    def _fit(self, tree: Dict) -> Dict:
+        if self.token_budget and estimate_tokens(format_input_tree_for_prompt(tree)) > self.token_budget:
+            return _trim_tree_to_budget(tree, self.token_budget)
+        return tree
+
+    def subtree(self, chapter: Optional[str] = None, topic: Optional[str] = None) -> Dict:
+        """Returns the input subtree for a question's chapter and topic."""
+        chapter_key = _normalize_topic(chapter) if chapter else None
+        if chapter_key:
+            if topic:
+                subtree = self._subtrees.get((chapter_key, _normalize_topic(topic)))
+                if subtree is not None:
+                    return subtree
+            subtree = self._subtrees.get((chapter_key, None))
+            if subtree is not None:
+                return subtree
+        return self._full_tree
+
+
+# USD per million (input, output) tokens, used for the cost estimate in the call metrics
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-4": (30.0, 60.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "claude-3-5-sonnet": (3.0, 15.0),
+    "claude-3-opus": (15.0, 75.0),
+    "claude-3-sonnet": (3.0, 15.0),
+    "claude-3-haiku": (0.25, 1.25),
+}
+
+# Batch API requests are billed at half price by both providers
+BATCH_PRICE_FACTOR = 0.5
+
+
+def _model_prices(model: Optional[str]):
+    """Returns the (input, output) prices of model, matching dated model names by their longest known prefix."""
+    if not model:
+        return None
+    if model in MODEL_PRICES:
+        return MODEL_PRICES[model]
+    matches = [name for name in MODEL_PRICES if model.startswith(name + "-")]
+    return MODEL_PRICES[max(matches, key=len)] if matches else None
+
+
+def estimate_cost(service: str, model: Optional[str], usage: Dict[str, int], price_factor: float = 1.0) -> Optional[float]:
+    """Estimates the cost of one call in USD from its token usage, or None for models without a known price.
+
+    Prompt-cache reads are billed at 50% of the input price by OpenAI (where
+    they are part of input_tokens) and at 10% by Anthropic (where they are
+    not); Anthropic cache writes cost 125%.
+    """
+    prices = _model_prices(model)
+    if prices is None:
+        return None
+    input_price, output_price = prices
+    input_tokens = usage.get("input_tokens", 0)
+    cached_tokens = usage.get("cached_input_tokens", 0)
+    if service == "claude":
+        input_cost = (input_tokens + cached_tokens * 0.1 + usage.get("cache_creation_input_tokens", 0) * 1.25) * input_price
     else:
+        input_cost = (input_tokens - cached_tokens + cached_tokens * 0.5) * input_price
+    return round((input_cost + usage.get("output_tokens", 0) * output_price) * price_factor / 1_000_000, 8)
+
+
+class CallMetrics:
+    """Measures one ask_* call for the "metrics" entry of its response_data.
+
+    The wall time covers the whole call, including retries and Claude model
+    fallbacks. The time to first token is taken from the first streamed delta,
+    or from the arrival of the response when the call was not streamed.
+    When a request is sent again after part of its response was streamed,
+    on_reset is called so the caller can drop that part.
+    """
+
+    def __init__(self, service: str, on_delta: Optional[Callable[[str], None]] = None, on_reset: Optional[Callable[[], None]] = None):
+        self.service = service
+        self.retries = 0
+        self._on_delta = on_delta
+        self._on_reset = on_reset
+        self._streamed = False
+        self._started = time.perf_counter()
+        self._first_token = None
+
+    @property
+    def delta_callback(self) -> Optional[Callable[[str], None]]:
+        """The on_delta to pass to the request helpers; None keeps the call unstreamed."""
+        return self._on_delta_timed if self._on_delta is not None else None
+
+    def _on_delta_timed(self, text: str):
+        if self._first_token is None:
+            self._first_token = time.perf_counter()
+        self._streamed = True
+        self._on_delta(text)
+
+    def count_retry(self):
+        self.retries += 1
+        self.reset_stream()
+
+    def reset_stream(self):
+        """Called before a request is sent again; passes on that the text streamed so far is void."""
+        if self._streamed:
+            self._streamed = False
+            if self._on_reset is not None:
+                self._on_reset()
+
+    def finish(self, model: Optional[str] = None, completion: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Returns the metrics of the call; completion is the request helper's result, or None if the call failed."""
+        now = time.perf_counter()
+        cache_hit = bool(completion and completion.get("cache_hit"))
+        answered = completion is not None and not cache_hit
+        usage = completion.get("usage", {}) if answered else {}
+        first_token = self._first_token or (now if answered else None)
         return {
-            "service": "copilot",
-            "question": question,
-            "context_tree": context_tree,
-            "input_tree": input_tree,
-            "response": "",
-            "prompt_used": full_prompt,
-            "error": "OpenAI library not available"
+            "wall_time": round(now - self._started, 4),
+            "ttft": round(first_token - self._started, 4) if first_token is not None else None,
+            "input_tokens": usage.get("input_tokens", 0),
+            "output_tokens": usage.get("output_tokens", 0),
+            "cached_input_tokens": usage.get("cached_input_tokens", 0),
+            "retries": self.retries,
+            "cache_hit": cache_hit,
+            "cost_usd": estimate_cost(self.service, model, usage) if answered else 0.0
         }
 
 
-def ask_claude(question: str, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None) -> Dict[str, Any]:
-    """Sends a question to the Claude API."""
-    # Include Context and Input tree in the prompt
-    context_str = format_context_for_prompt(context_tree) if context_tree else ""
-    input_str = format_input_tree_for_prompt(input_tree) if input_tree else ""
+def _service_response(service: str, question: str, context_tree: Optional[Dict], input_tree: Optional[Dict], prompt_used: Union[str, PromptBuilder], **fields) -> ServiceResponse:
+    """Builds the response record returned by the ask_* functions; prompt_used may be the question's PromptBuilder."""
+    return ServiceResponse(service, question, context_tree, input_tree, prompt_used, **fields)
+
+
+def _openai_request(model: str, system_prompt: str, prompt: str, max_tokens: int, temperature: float) -> Dict[str, Any]:
+    # OpenAI caches long prompt prefixes automatically, so the stable parts come
+    # first: the fixed system prompt, then the user prompt, which starts with the
+    # shared Input Tree / Context prefix and ends with the question.
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": max_tokens,
+        "temperature": temperature
+    }
+
+
+def _openai_usage(response) -> Dict[str, int]:
+    """Token usage of a chat completion, including prompt tokens served from OpenAI's prompt cache."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return {}
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "input_tokens": usage.prompt_tokens or 0,
+        "output_tokens": usage.completion_tokens or 0,
+        "cached_input_tokens": getattr(details, "cached_tokens", None) or 0
+    }
+
+
+def _collect_openai_stream(stream, on_delta: Callable[[str], None]):
+    """Forwards the text deltas of a streamed chat completion to on_delta; returns (text, chunk carrying the usage)."""
+    parts = []
+    usage_chunk = None
+    for chunk in stream:
+        if getattr(chunk, "usage", None):
+            usage_chunk = chunk
+        if chunk.choices:
+            text = chunk.choices[0].delta.content
+            if text:
+                parts.append(text)
+                on_delta(text)
+    return "".join(parts), usage_chunk
+
+
+async def _collect_openai_stream_async(stream, on_delta: Callable[[str], None]):
+    """Async version of _collect_openai_stream."""
+    parts = []
+    usage_chunk = None
+    async for chunk in stream:
+        if getattr(chunk, "usage", None):
+            usage_chunk = chunk
+        if chunk.choices:
+            text = chunk.choices[0].delta.content
+            if text:
+                parts.append(text)
+                on_delta(text)
+    return "".join(parts), usage_chunk
+
+
+def _replay_cached_delta(completion: Dict[str, Any], on_delta: Optional[Callable[[str], None]]) -> Dict[str, Any]:
+    """Sends a cached response to on_delta in one piece, so streaming callers see every response."""
+    if on_delta is not None and completion.get("cache_hit") and completion.get("response"):
+        on_delta(completion["response"])
+    return completion
+
+
+def _send_steps(service: str, limiter: TokenBucketLimiter, estimated_tokens: int, send: Callable[[], Any]) -> Generator:
+    """Steps of one provider request: waits for the rate limiter, then calls send()."""
+    yield _Sleep(limiter.reserve(estimated_tokens))
+    try:
+        return (yield send)
+    except Exception as e:
+        _note_rate_limit_error(service, e)
+        raise
+
+
+def _provider_call_steps(service: str, limiter: TokenBucketLimiter, estimated_tokens: int, send: Callable[[], Any], on_retry: Optional[Callable[[], None]]) -> Generator:
+    """Steps of a provider request through the retry policy, the circuit breaker and the rate limiter."""
+    breaker = get_circuit_breaker(service)
+    return current_retry_policy().steps(service, lambda: breaker.steps(lambda: _send_steps(service, limiter, estimated_tokens, send)), on_retry)
+
+
+def _openai_completion_steps(service: str, model: str, system_prompt: str, prompt: str, send: Callable, max_tokens: int = 1000, temperature: float = 0.7, on_delta: Optional[Callable[[str], None]] = None, on_retry: Optional[Callable[[], None]] = None) -> Generator:
+    """Steps of one OpenAI chat completion through the response cache, rate limiter, retry policy and circuit breaker.
+
+    send(request, on_delta) makes the API call (see _openai_send) and returns
+    (text, response carrying the usage). With on_delta, the completion is
+    streamed and every text delta is passed to on_delta as it arrives.
+    on_retry is passed on to the retry policy.
+    """
+    def call_steps():
+        limiter = get_rate_limiter(service)
+        estimated_tokens = estimate_tokens(system_prompt + prompt, max_tokens)
+        request = _openai_request(model, system_prompt, prompt, max_tokens, temperature)
+        text, response = yield from _provider_call_steps(service, limiter, estimated_tokens, functools.partial(send, request, on_delta), on_retry)
+        limiter.settle(estimated_tokens, getattr(getattr(response, "usage", None), "total_tokens", None))
+        return {"response": text, "usage": _openai_usage(response)}
     
-    full_prompt = question
-    prompt_parts = []
+    completion = yield from response_cache.fetch_steps(service, model, system_prompt, prompt, max_tokens, temperature, call_steps)
+    return _replay_cached_delta(completion, on_delta)
+
+
+def _openai_send(api_key: str, request: Dict[str, Any], on_delta: Optional[Callable[[str], None]]):
+    """Makes one chat completion call; returns (text, response carrying the usage)."""
+    client = get_openai_client(api_key)
+    if on_delta is None:
+        response = client.chat.completions.create(**request)
+        return response.choices[0].message.content, response
+    stream = client.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+    return _collect_openai_stream(stream, on_delta)
+
+
+async def _openai_send_async(api_key: str, request: Dict[str, Any], on_delta: Optional[Callable[[str], None]]):
+    """Async version of _openai_send using the AsyncOpenAI client."""
+    client = get_async_openai_client(api_key)
+    if on_delta is None:
+        response = await client.chat.completions.create(**request)
+        return response.choices[0].message.content, response
+    stream = await client.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+    return await _collect_openai_stream_async(stream, on_delta)
+
+
+# Send the shared Input Tree / Context prefix as a cacheable system block (Anthropic prompt caching)
+CLAUDE_PROMPT_CACHING = os.getenv("CLAUDE_PROMPT_CACHING", "1").lower() not in ("0", "false", "no")
+
+
+def _claude_request(model: str, prompt: str, max_tokens: int, cached_prefix: Optional[str] = None) -> Dict[str, Any]:
+    """Builds the Messages API request.
+
+    If cached_prefix is given and starts the prompt, it is sent as a system
+    block marked with cache_control so Anthropic can reuse it across
+    questions, and only the rest of the prompt goes into the user message.
+    """
+    request = {
+        "model": model,
+        "max_tokens": max_tokens,
+        "messages": [
+            {"role": "user", "content": prompt}
+        ]
+    }
+    if CLAUDE_PROMPT_CACHING and cached_prefix and prompt.startswith(cached_prefix):
+        request["system"] = [
+            {"type": "text", "text": cached_prefix, "cache_control": {"type": "ephemeral"}}
+        ]
+        request["messages"][0]["content"] = prompt[len(cached_prefix):].lstrip("\n")
+    return request
+
+
+def _claude_usage(message) -> Dict[str, int]:
+    """Token usage of a message, including prompt-cache reads and writes."""
+    usage = getattr(message, "usage", None)
+    if usage is None:
+        return {}
+    return {
+        "input_tokens": usage.input_tokens or 0,
+        "output_tokens": usage.output_tokens or 0,
+        "cached_input_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0
+    }
+
+
+def _claude_payload(message, limiter: TokenBucketLimiter, estimated_tokens: int) -> Dict[str, Any]:
+    usage = _claude_usage(message)
+    if usage:
+        limiter.settle(estimated_tokens, sum(usage.values()))
+    return {"response": message.content[0].text, "usage": usage}
+
+
+def _claude_completion_steps(model: str, prompt: str, send: Callable, max_tokens: int = 1000, cached_prefix: Optional[str] = None, on_delta: Optional[Callable[[str], None]] = None, on_retry: Optional[Callable[[], None]] = None) -> Generator:
+    """Steps of one Claude message request through the response cache, rate limiter, retry policy and circuit breaker.
+
+    send(request, on_delta) makes the API call (see _claude_send) and returns
+    the message. With on_delta, the message is streamed and every text delta
+    is passed to on_delta as it arrives. on_retry is passed on to the retry policy.
+    """
+    def call_steps():
+        limiter = get_rate_limiter("claude")
+        estimated_tokens = estimate_tokens(prompt, max_tokens)
+        request = _claude_request(model, prompt, max_tokens, cached_prefix)
+        message = yield from _provider_call_steps("claude", limiter, estimated_tokens, functools.partial(send, request, on_delta), on_retry)
+        return _claude_payload(message, limiter, estimated_tokens)
     
-    if input_str:
-        prompt_parts.append(f"Input Tree:\n{input_str}")
-    if context_str:
-        prompt_parts.append(f"Context:\n{context_str}")
+    completion = yield from response_cache.fetch_steps("claude", model, None, prompt, max_tokens, None, call_steps)
+    return _replay_cached_delta(completion, on_delta)
+
+
+def _claude_send(api_key: str, request: Dict[str, Any], on_delta: Optional[Callable[[str], None]]):
+    """Makes one Messages API call; returns the message."""
+    client = get_anthropic_client(api_key)
+    if on_delta is None:
+        return client.messages.create(**request)
+    with client.messages.stream(**request) as stream:
+        for text in stream.text_stream:
+            on_delta(text)
+        return stream.get_final_message()
+
+
+async def _claude_send_async(api_key: str, request: Dict[str, Any], on_delta: Optional[Callable[[str], None]]):
+    """Async version of _claude_send using the AsyncAnthropic client."""
+    client = get_async_anthropic_client(api_key)
+    if on_delta is None:
+        return await client.messages.create(**request)
+    async with client.messages.stream(**request) as stream:
+        async for text in stream.text_stream:
+            on_delta(text)
+        return await stream.get_final_message()
+
+
+def _completed_response(service: str, question: str, context_tree: Optional[Dict], input_tree: Optional[Dict], builder: PromptBuilder, model: str, completion: Dict[str, Any], metrics: CallMetrics) -> ServiceResponse:
+    """Builds the response record of a successful completion."""
+    return _service_response(service, question, context_tree, input_tree, builder,
+                             response=completion["response"], model_used=model,
+                             cache_hit=completion["cache_hit"], usage=completion.get("usage", {}),
+                             metrics=metrics.finish(model, completion))
+
+
+def _openai_unavailable_reason(service: str, api_key: Optional[str]) -> Optional[str]:
+    """Returns why an OpenAI-backed service cannot be called, or None."""
+    if not api_key:
+        return "OPENAI_API_KEY environment variable not set"
+    if not OPENAI_AVAILABLE:
+        return "OpenAI library not available" if service == "copilot" else "openai library not available"
+    return None
+
+
+# Model environment variable, default model and system prompt of the OpenAI-backed services
+OPENAI_SERVICES = {
+    "copilot": ("COPILOT_MODEL", "gpt-3.5-turbo", COPILOT_SYSTEM_PROMPT),
+    "chatgpt": ("CHATGPT_MODEL", "gpt-4", CHATGPT_SYSTEM_PROMPT)
+}
+
+
+def _openai_model(service: str) -> str:
+    variable, default, _ = OPENAI_SERVICES[service]
+    return os.getenv(variable, default)
+
+
+def _ask_openai_steps(service: str, question: str, context_tree: Optional[Dict], input_tree: Optional[Dict], on_delta: Optional[Callable[[str], None]], on_reset: Optional[Callable[[], None]], send: Callable) -> Generator:
+    """Steps of asking Copilot or ChatGPT; send is _openai_send or _openai_send_async."""
+    builder = get_prompt_builder(context_tree, input_tree)
+    api_key = os.getenv("OPENAI_API_KEY")
+    model = _openai_model(service)
     
-    if prompt_parts:
-        full_prompt = "\n\n".join(prompt_parts) + f"\n\nQuestion: {question}"
+    unavailable_reason = _openai_unavailable_reason(service, api_key)
+    if unavailable_reason:
+        return _service_response(service, question, context_tree, input_tree, builder, error=unavailable_reason)
     
-    api_key = os.getenv("ANTHROPIC_API_KEY")
+    metrics = CallMetrics(service, on_delta, on_reset)
+    try:
+        completion = yield from _openai_completion_steps(service, model, OPENAI_SERVICES[service][2], builder.build(question), functools.partial(send, api_key),
+                                                         on_delta=metrics.delta_callback, on_retry=metrics.count_retry)
+        return _completed_response(service, question, context_tree, input_tree, builder, model, completion, metrics)
+    except Exception as e:
+        return _service_response(service, question, context_tree, input_tree, builder, error=str(e), metrics=metrics.finish(model))
+
+
+def ask_copilot(question: str, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None, on_delta: Optional[Callable[[str], None]] = None, on_reset: Optional[Callable[[], None]] = None) -> Dict[str, Any]:
+    """Sends a question to Copilot (an OpenAI model); on_delta, if given, receives the response text as it streams in.
+
+    on_reset is called when the request is sent again after part of the
+    response was streamed; the text passed to on_delta so far is then void.
+    """
+    return _drive(_ask_openai_steps("copilot", question, context_tree, input_tree, on_delta, on_reset, _openai_send))
+
+
+async def ask_copilot_async(question: str, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None, on_delta: Optional[Callable[[str], None]] = None, on_reset: Optional[Callable[[], None]] = None) -> Dict[str, Any]:
+    """Async version of ask_copilot."""
+    return await _drive_async(_ask_openai_steps("copilot", question, context_tree, input_tree, on_delta, on_reset, _openai_send_async))
+
+
+def _claude_unavailable_reason(api_key: Optional[str]) -> Optional[str]:
+    """Returns why Claude cannot be called, or None."""
     if not api_key:
-        return {
-            "service": "claude",
-            "question": question,
-            "context_tree": context_tree,
-            "input_tree": input_tree,
-            "response": "",
-            "prompt_used": full_prompt,
-            "error": "ANTHROPIC_API_KEY environment variable not set"
-        }
-    
+        return "ANTHROPIC_API_KEY environment variable not set"
     if not ANTHROPIC_AVAILABLE:
-        return {
-            "service": "claude",
-            "question": question,
-            "context_tree": context_tree,
-            "input_tree": input_tree,
-            "response": "",
-            "prompt_used": full_prompt,
-            "error": "anthropic library not available"
-        }
+        return "anthropic library not available"
+    return None
+
+
+def _claude_models_to_try(api_key: str):
+    """Returns (model cache key, cached model, models in the order to try them)."""
+    # Try the model that worked last time first, then the rest of the list
+    cache_key = "claude:" + hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+    cached_model = model_cache.get(cache_key)
+    models_to_try = list(CLAUDE_MODELS)
+    if cached_model:
+        models_to_try = [cached_model] + [model for model in models_to_try if model != cached_model]
+    return cache_key, cached_model, models_to_try
+
+
+def _claude_model_error(error: Exception, model: str, cached_model: Optional[str], cache_key: str):
+    """Handles a failed Claude model attempt; returns (error message, whether to stop trying models)."""
+    if isinstance(error, CircuitOpenError):
+        return str(error), True
+    if not isinstance(error, anthropic.APIError):
+        return str(error), False
+    
+    # API error (authentication error, etc.)
+    error_msg = f"API Error: {error.message if hasattr(error, 'message') else str(error)}"
+    if "authentication" in str(error).lower() or "api key" in str(error).lower() or "401" in str(error):
+        return f"Authentication error: API key is invalid. {error_msg}", True
+    if model == cached_model and _is_model_unavailable_error(error):
+        model_cache.invalidate(cache_key)
+    # Retries are used up; the other models would run into the same outage
+    if _is_retryable_error(error):
+        return error_msg, True
+    return error_msg, False
+
+
+def _claude_error_message(error: Exception) -> str:
+    error_str = str(error)
+    if "api key" in error_str.lower() or "authentication" in error_str.lower():
+        return "API key is invalid or not set."
+    return error_str
+
+
+def _ask_claude_steps(question: str, context_tree: Optional[Dict], input_tree: Optional[Dict], on_delta: Optional[Callable[[str], None]], on_reset: Optional[Callable[[], None]], send: Callable) -> Generator:
+    """Steps of asking Claude, trying the models in CLAUDE_MODELS in turn; send is _claude_send or _claude_send_async."""
+    builder = get_prompt_builder(context_tree, input_tree)
+    full_prompt = builder.build(question)
+    api_key = os.getenv("ANTHROPIC_API_KEY")
+    
+    unavailable_reason = _claude_unavailable_reason(api_key)
+    if unavailable_reason:
+        return _service_response("claude", question, context_tree, input_tree, builder, error=unavailable_reason)
     
+    metrics = CallMetrics("claude", on_delta, on_reset)
     try:
-        client = anthropic.Anthropic(api_key=api_key)
-        
-        # List of available models (latest models first)
-        models_to_try = [
-            "claude-3-5-sonnet-20241022",
-            "claude-3-5-sonnet-20240620",
-            "claude-3-opus-20240229",
-            "claude-3-sonnet-20240229",
-            "claude-3-haiku-20240307"
-        ]
+        cache_key, cached_model, models_to_try = _claude_models_to_try(api_key)
         
         last_error = None
         for model in models_to_try:
             try:
-                message = client.messages.create(
-                    model=model,
-                    max_tokens=1000,
-                    messages=[
-                        {"role": "user", "content": full_prompt}
-                    ]
-                )
-                response_text = message.content[0].text
-                return {
-                    "service": "claude",
-                    "question": question,
-                    "context_tree": context_tree,
-                    "input_tree": input_tree,
-                    "response": response_text,
-                    "prompt_used": full_prompt,
-                    "model_used": model
-                }
-            except anthropic.APIError as e:
-                # API error (authentication error, etc.)
-                error_msg = f"API Error: {e.message if hasattr(e, 'message') else str(e)}"
-                if "authentication" in str(e).lower() or "api key" in str(e).lower() or "401" in str(e):
-                    return {
-                        "service": "claude",
-                        "question": question,
-                        "context_tree": context_tree,
-                        "input_tree": input_tree,
-                        "response": "",
-                        "prompt_used": full_prompt,
-                        "error": f"Authentication error: API key is invalid. {error_msg}"
-                    }
-                last_error = error_msg
-                continue
+                completion = yield from _claude_completion_steps(model, full_prompt, functools.partial(send, api_key), cached_prefix=builder.static_prefix,
+                                                                 on_delta=metrics.delta_callback, on_retry=metrics.count_retry)
             except Exception as e:
-                last_error = str(e)
+                last_error, stop = _claude_model_error(e, model, cached_model, cache_key)
+                if stop:
+                    return _service_response("claude", question, context_tree, input_tree, builder, error=last_error, metrics=metrics.finish(model))
+                metrics.reset_stream()
                 continue
+            model_cache.set(cache_key, model)
+            return _completed_response("claude", question, context_tree, input_tree, builder, model, completion, metrics)
         
         # All models failed
-        return {
-            "service": "claude",
-            "question": question,
-            "context_tree": context_tree,
-            "input_tree": input_tree,
-            "response": "",
-            "prompt_used": full_prompt,
-            "error": f"All models failed. Last error: {last_error}"
-        }
+        return _service_response("claude", question, context_tree, input_tree, builder, error=f"All models failed. Last error: {last_error}",
+                                 metrics=metrics.finish())
     except Exception as e:
-        error_str = str(e)
-        if "api key" in error_str.lower() or "authentication" in error_str.lower():
-            error_msg = "API key is invalid or not set."
+        return _service_response("claude", question, context_tree, input_tree, builder, error=_claude_error_message(e), metrics=metrics.finish())
+
+
+def ask_claude(question: str, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None, on_delta: Optional[Callable[[str], None]] = None, on_reset: Optional[Callable[[], None]] = None) -> Dict[str, Any]:
+    """Sends a question to the Claude API; on_delta and on_reset work as in ask_copilot."""
+    return _drive(_ask_claude_steps(question, context_tree, input_tree, on_delta, on_reset, _claude_send))
+
+
+async def ask_claude_async(question: str, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None, on_delta: Optional[Callable[[str], None]] = None, on_reset: Optional[Callable[[], None]] = None) -> Dict[str, Any]:
+    """Async version of ask_claude."""
+    return await _drive_async(_ask_claude_steps(question, context_tree, input_tree, on_delta, on_reset, _claude_send_async))
+
+
+def ask_chatgpt(question: str, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None, on_delta: Optional[Callable[[str], None]] = None, on_reset: Optional[Callable[[], None]] = None) -> Dict[str, Any]:
+    """Sends a question to the ChatGPT API; on_delta and on_reset work as in ask_copilot."""
+    return _drive(_ask_openai_steps("chatgpt", question, context_tree, input_tree, on_delta, on_reset, _openai_send))
+
+
+async def ask_chatgpt_async(question: str, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None, on_delta: Optional[Callable[[str], None]] = None, on_reset: Optional[Callable[[], None]] = None) -> Dict[str, Any]:
+    """Async version of ask_chatgpt."""
+    return await _drive_async(_ask_openai_steps("chatgpt", question, context_tree, input_tree, on_delta, on_reset, _openai_send_async))
+
+
+ASK_FUNCTIONS = {
+    "copilot": ask_copilot,
+    "claude": ask_claude,
+    "chatgpt": ask_chatgpt
+}
+
+ASYNC_ASK_FUNCTIONS = {
+    "copilot": ask_copilot_async,
+    "claude": ask_claude_async,
+    "chatgpt": ask_chatgpt_async
+}
+
+
+class KeywordMatcher:
+    """Finds which of a fixed set of keywords occur in a text in one pass.
+
+    Built once per keyword set: duplicates are removed and keywords are checked
+    longest first. When a keyword is found, every other keyword contained in it
+    is known to be present too and is not searched again. Each remaining check
+    is a C-level substring search, which in CPython is faster than a compiled
+    alternation regex or a pure-Python Aho-Corasick automaton for keyword lists
+    of this size. The result is the same as checking `keyword in text` per keyword.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = tuple(dict.fromkeys(keywords))
+        self._ordered = tuple(sorted(self.keywords, key=len, reverse=True))
+        self._contained = {kw: tuple(other for other in self.keywords if other in kw) for kw in self._ordered}
+
+    def find(self, text: str) -> set:
+        """Returns the set of keywords that occur in text."""
+        found = set()
+        for kw in self._ordered:
+            if kw not in found and kw in text:
+                found.update(self._contained[kw])
+        return found
+
+    def match(self, text: str, keywords: List[str]):
+        """Returns (found, missing) lists for keywords, in the given order."""
+        found_set = self.find(text)
+        found = []
+        missing = []
+        for kw in keywords:
+            (found if kw in found_set else missing).append(kw)
+        return found, missing
+
+    def search(self, text: str) -> bool:
+        """Returns True if any keyword occurs in text."""
+        return any(kw in text for kw in self._ordered)
+
+
+@functools.lru_cache(maxsize=1024)
+def get_keyword_matcher(keywords: tuple) -> KeywordMatcher:
+    """Returns the cached matcher for a tuple of (lowercase) keywords."""
+    return KeywordMatcher(keywords)
+
+
+# Phrases in a response that mean the AI asked for clarification instead of answering
+CLARIFICATION_KEYWORDS = (
+    "clarify", "rephrase", "unclear", "not sure", "don't understand",
+    "not recognized", "not a real word", "typo", "misspelling",
+    "could you please", "please provide", "please clarify",
+    "what do you mean", "what does", "could you explain",
+    "i'm not sure", "i don't know what", "doesn't seem to",
+    "appears to be", "might have been", "seems like there might"
+)
+
+# Incomplete question patterns like "what mean", "what do", "what does"
+UNCLEAR_QUESTION_PATTERNS = (
+    "what mean", "what do", "what does", "what is mean",
+    "what mean by", "mean by", "mean?"
+)
+
+# Very short or meaningless responses (e.g., "I don't know", "Not sure", etc.)
+SHORT_UNCLEAR_RESPONSES = ("i don't know", "not sure", "i'm not sure", "i can't")
+
+
+def classify_response(response_data: Dict[str, Any], expected_keywords: List[str] = None) -> str:
+    response = response_data.get("response", "")
+    error = response_data.get("error")
+    question = response_data.get("question", "").lower()
+    
+    # If there's an error or no response or empty response, return "No Response from AI"
+    if error or not response or response.strip() == "":
+        return "No Response from AI"
+    
+    response_lower = response.lower()
+    
+    # If the response requests clarification or asks about the question's meaning
+    is_clarification_request = get_keyword_matcher(CLARIFICATION_KEYWORDS).search(response_lower)
+    
+    # Detect if the question itself is unclear or has typos
+    is_unclear_question = get_keyword_matcher(UNCLEAR_QUESTION_PATTERNS).search(question)
+    
+    # If it's a clarification request or response to an incomplete question, return "Wrong Answer"
+    if is_clarification_request or (is_unclear_question and is_clarification_request):
+        return "Wrong Answer"
+    
+    # If the response is very short or meaningless
+    if get_keyword_matcher(SHORT_UNCLEAR_RESPONSES).search(response_lower) and len(response.split()) < 10:
+        return "Wrong Answer"
+    
+    # Check expected keywords if provided
+    if expected_keywords and len(expected_keywords) > 0:
+        keywords_lower = [kw.lower() for kw in expected_keywords]
+        found_keywords, missing_keywords = get_keyword_matcher(tuple(keywords_lower)).match(response_lower, keywords_lower)
+        keyword_match_ratio = len(found_keywords) / len(keywords_lower) if keywords_lower else 0
+        
+        # Store keyword matching info in response_data for later use
+        response_data["keyword_analysis"] = {
+            "expected_keywords": expected_keywords,
+            "found_keywords": found_keywords,
+            "missing_keywords": missing_keywords,
+            "match_ratio": keyword_match_ratio
+        }
+        
+        # If less than 50% of keywords are found, consider it "Wrong Answer"
+        if keyword_match_ratio < 0.5:
+            return "Wrong Answer"
+    
+    # Otherwise, consider it as "Correct Answer"
+    return "Correct Answer"
+
+
+def categorize_response(response_data: Dict[str, Any], expected_keywords: List[str] = None) -> CategorizedResponse:
+    classification = classify_response(response_data, expected_keywords)
+    
+    # Classify according to Output tree structure
+    if classification == "Correct Answer":
+        return CategorizedResponse("Valid", "Correct Answer", response_data)
+    elif classification == "Wrong Answer":
+        return CategorizedResponse("Invalid", "Wrong Answer", response_data)
+    else:  # No Response from AI
+        return CategorizedResponse("Invalid", "No Response from AI", response_data)
+
+
+class CheckpointStore:
+    """Durable per-question checkpoint of AI responses for resuming a run.
+
+    Each successful response is appended to a JSONL file and fsync'ed right
+    away. Records are keyed by a hash of the question's raw line plus the
+    context and input trees, so a checkpoint is only reused for the same
+    question asked with the same trees. Responses with an error are not
+    recorded and are asked again on resume.
+
+    Only the file offset of each (key, service) record is kept in memory;
+    completed() reads the records of a key back from the file when it is
+    asked for them, so memory does not grow with the size of the responses.
+    """
+
+    def __init__(self, path: str, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None, resume: bool = False):
+        self.path = path
+        self.context_tree = context_tree
+        self.input_tree = input_tree
+        trees = json.dumps([context_tree, input_tree], sort_keys=True, ensure_ascii=False)
+        self._trees_digest = hashlib.sha256(trees.encode('utf-8')).hexdigest()
+        self._offsets: Dict[tuple, int] = {}
+        self._lock = threading.Lock()
+        if resume and os.path.exists(path):
+            self._load()
+        self._file = open(path, 'ab' if resume else 'wb')
+        self._reader = None
+
+    def _load(self):
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if record is not None:
+                    self._offsets[(record["key"], record["service"])] = offset
+                offset += len(line)
+        # Drop the last line of an interrupted write, so new records start on a line of their own
+        if offset < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+
+    @property
+    def completed_count(self) -> int:
+        """Number of (question, service) responses in the checkpoint."""
+        return len(self._offsets)
+
+    def key(self, raw_line: str, input_tree: Optional[Dict] = None) -> str:
+        """Returns the checkpoint key of a question line.
+
+        If the question uses its own (pruned) input tree, the key also covers
+        that tree through the digest of its rendered prompt prefix.
+        """
+        digest = self._trees_digest
+        if input_tree is not None and input_tree is not self.input_tree:
+            digest += get_prompt_builder(self.context_tree, input_tree).prefix_digest
+        return hashlib.sha256((digest + "\n" + raw_line).encode('utf-8')).hexdigest()
+
+    def completed(self, key: str, input_tree: Optional[Dict] = None) -> Dict[str, ServiceResponse]:
+        """Returns {service: response_data} of the responses already recorded for key."""
+        with self._lock:
+            offsets = {service: self._offsets[(key, service)] for service in ASK_FUNCTIONS if (key, service) in self._offsets}
+            if not offsets:
+                return {}
+            if self._reader is None:
+                self._reader = open(self.path, 'rb')
+            responses = {}
+            for service, offset in offsets.items():
+                self._reader.seek(offset)
+                responses[service] = json.loads(self._reader.readline())["response_data"]
+        input_tree = input_tree if input_tree is not None else self.input_tree
+        builder = get_prompt_builder(self.context_tree, input_tree)
+        completed = {}
+        for service, response_data in responses.items():
+            fields = {name: value for name, value in response_data.items() if name not in ("context_tree", "input_tree", "keyword_analysis")}
+            completed[service] = ServiceResponse.from_dict(dict(fields, context_tree=self.context_tree, input_tree=input_tree), builder)
+        return completed
+
+    def record(self, key: str, service: str, response_data: Dict[str, Any]):
+        """Durably records a response unless it is an error."""
+        if response_data.get("error") or not response_data.get("response"):
+            return
+        # The trees are part of the key, so they are not repeated in every record
+        stored = {name: value for name, value in response_data.items() if name not in ("context_tree", "input_tree", "keyword_analysis")}
+        line = json.dumps({"key": key, "service": service, "response_data": stored}, ensure_ascii=False, default=_record_to_json) + "\n"
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(line.encode('utf-8'))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._offsets[(key, service)] = offset
+
+    def close(self):
+        """Closes the checkpoint file."""
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+
+def checkpoint_options(checkpoint: Optional[CheckpointStore], q_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the process_question keyword arguments that wire a question to a checkpoint."""
+    if checkpoint is None:
+        return {}
+    input_tree = q_data.get("input_tree")
+    key = checkpoint.key(q_data.get("raw_line", q_data["question"]), input_tree)
+    return {
+        "completed_responses": checkpoint.completed(key, input_tree),
+        "on_service_response": lambda service, response_data: checkpoint.record(key, service, response_data)
+    }
+
+
+def prune_input_trees(questions_data: Iterable[Dict[str, Any]], input_tree: Dict, token_budget: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Yields the questions, each given only the input subtree for its chapter and topic (stored as q_data["input_tree"])."""
+    index = InputTreeIndex(input_tree, token_budget)
+    for q_data in questions_data:
+        q_data["input_tree"] = index.subtree(q_data.get("chapter"), q_data.get("topic"))
+        yield q_data
+
+
+def enabled_services(use_copilot: bool = True) -> List[str]:
+    """Returns the services to ask, in the fixed output order Copilot, Claude, ChatGPT."""
+    services = []
+    
+    # Copilot (optional)
+    if use_copilot:
+        copilot_token = os.getenv("GITHUB_COPILOT_TOKEN") or os.getenv("OPENAI_API_KEY")
+        if copilot_token:
+            services.append("copilot")
+        else:
+            print("  [Copilot] Skipping due to missing API key.")
+    
+    # Claude
+    services.append("claude")
+    
+    # ChatGPT
+    services.append("chatgpt")
+    
+    return services
+
+
+def _prompt_model(service: str) -> str:
+    """The model a service's prompts go to (for Claude, its model list in fallback order)."""
+    if service == "copilot":
+        return os.getenv("COPILOT_MODEL", "gpt-3.5-turbo")
+    if service == "chatgpt":
+        return os.getenv("CHATGPT_MODEL", "gpt-4")
+    return ",".join(CLAUDE_MODELS)
+
+
+def prompt_key(question: str, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None) -> bytes:
+    """A digest of the full prompt of a question, computed from the builder's prefix digest."""
+    prefix_digest = get_prompt_builder(context_tree, input_tree).prefix_digest
+    return hashlib.blake2b(f"{prefix_digest}\n{question}".encode('utf-8'), digest_size=16).digest()
+
+
+def _shared_response(response_data: ServiceResponse, context_tree: Optional[Dict], input_tree: Optional[Dict]) -> ServiceResponse:
+    """Copies a response for another question with the same prompt; the copy is classified separately."""
+    shared = response_data.copy()
+    shared.context_tree = context_tree
+    shared.input_tree = input_tree
+    if "keyword_analysis" in shared:
+        del shared.keyword_analysis
+    if shared.get("metrics"):
+        shared.metrics = dict(shared.metrics, deduplicated=True)
+    return shared
+
+
+class PromptPlan:
+    """The identical (service, model, prompt) requests of a run, so each is sent only once.
+
+    Built by plan_prompts before the run. A prompt that occurs once is sent
+    as usual. For a repeated prompt the first question to ask a service sends
+    it and the others wait for that response and get a copy of it (see
+    _shared_response), which is then classified with their own expected
+    keywords. A shared response is released once every question using it got
+    it. The model, system prompt and sampling settings are fixed per service
+    within a run, so the prompt digest plus the service identifies a request.
+
+    The plan only covers one run. The request it sends goes through the
+    response cache, so with the cache enabled (--cache read) repeats in later
+    runs or other question files are answered from the cache instead.
+    """
+
+    def __init__(self, counts: Dict[bytes, int], questions: int = 0):
+        self.questions = questions
+        self.unique_prompts = len(counts)
+        self.duplicates = sum(counts.values()) - len(counts)
+        # Only repeated prompts need to be tracked
+        self._counts = {key: count for key, count in counts.items() if count > 1}
+        self._shared: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def _claim(self, service: str, key: bytes, make_future: Optional[Callable[[], Any]]):
+        """Takes one use of a repeated prompt; returns (future, whether this caller sends the request).
+
+        Without make_future the use is only given up (the question does not ask).
+        """
+        shared_key = (service, _prompt_model(service), key)
+        with self._lock:
+            entry = self._shared.get(shared_key)
+            if entry is None:
+                # [future of the response, uses left]
+                entry = self._shared[shared_key] = [None, self._counts[key]]
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._shared[shared_key]
+            if make_future is None:
+                return None, False
+            owner = entry[0] is None
+            if owner:
+                entry[0] = make_future()
+            return entry[0], owner
+
+    def skip(self, service: str, question: str, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None):
+        """Gives up a question's use of a prompt, e.g. when its response came from a checkpoint."""
+        key = prompt_key(question, context_tree, input_tree)
+        if key in self._counts:
+            self._claim(service, key, None)
+
+    def steps(self, service: str, question: str, context_tree: Optional[Dict], input_tree: Optional[Dict],
+              send_steps: Callable[[], Generator], on_delta: Optional[Callable[[str], None]] = None) -> Generator:
+        """Step generator (see _drive) that runs send_steps() for the first use of a prompt and returns a copy of its response for the others."""
+        key = prompt_key(question, context_tree, input_tree)
+        if key not in self._counts:
+            return (yield from send_steps())
+        future, owner = self._claim(service, key, Future)
+        if owner:
+            try:
+                response_data = yield from send_steps()
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            except BaseException:
+                future.cancel()
+                raise
+            future.set_result(response_data)
+            return response_data
+        response_data = yield future
+        if on_delta is not None and response_data.get("response"):
+            on_delta(response_data["response"])
+        return _shared_response(response_data, context_tree, input_tree)
+
+
+def plan_prompts(questions_data: Iterable[Dict[str, Any]], context_tree: Dict = None, input_tree: Dict = None) -> PromptPlan:
+    """Planning pass over a run's questions: counts how often each prompt occurs (see PromptPlan).
+
+    questions_data is consumed, so pass a separate iterator over the same
+    questions (with the same pruning) as the run itself.
+    """
+    counts: Dict[bytes, int] = {}
+    questions = 0
+    for q_data in questions_data:
+        key = prompt_key(q_data["question"], context_tree, q_data.get("input_tree", input_tree))
+        counts[key] = counts.get(key, 0) + 1
+        questions += 1
+    return PromptPlan(counts, questions)
+
+
+class _QuestionRun:
+    """One question being sent to the enabled services; shared by process_question and process_question_async."""
+
+    def __init__(self, question: str, context_tree: Optional[Dict], input_tree: Optional[Dict], expected_keywords: Optional[List[str]],
+                 completed_responses: Optional[Dict[str, Dict[str, Any]]], on_service_response: Optional[Callable[[str, Dict[str, Any]], None]],
+                 on_delta: Optional[Callable[[str, str], None]], on_stream_reset: Optional[Callable[[str], None]], prompt_plan: Optional[PromptPlan]):
+        self.question = question
+        self.context_tree = context_tree
+        self.input_tree = input_tree
+        self.expected_keywords = expected_keywords
+        self.completed_responses = completed_responses or {}
+        self.on_service_response = on_service_response
+        self.on_delta = on_delta
+        self.on_stream_reset = on_stream_reset
+        self.prompt_plan = prompt_plan
+
+    def ask_steps(self, service: str, send: Callable[..., Any]) -> Generator:
+        """Step generator (see _drive) for one service's response; send(service, on_delta, on_reset) asks the service."""
+        if service in self.completed_responses:
+            if self.prompt_plan is not None:
+                self.prompt_plan.skip(service, self.question, self.context_tree, self.input_tree)
+            return self.completed_responses[service]
+        service_delta = functools.partial(self.on_delta, service) if self.on_delta is not None else None
+        service_reset = functools.partial(self.on_stream_reset, service) if self.on_stream_reset is not None else None
+        send_steps = lambda: _call_step(functools.partial(send, service, service_delta, service_reset))
+        if self.prompt_plan is None:
+            response_data = yield from send_steps()
         else:
-            error_msg = error_str
-        
+            response_data = yield from self.prompt_plan.steps(service, self.question, self.context_tree, self.input_tree, send_steps, service_delta)
+        if self.on_service_response is not None:
+            self.on_service_response(service, response_data)
+        return response_data
+
+    def result(self, service_responses: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Categorizes the responses, given in service order."""
         return {
-            "service": "claude",
-            "question": question,
-            "context_tree": context_tree,
-            "input_tree": input_tree,
-            "response": "",
-            "prompt_used": full_prompt,
-            "error": error_msg
+            "question": self.question,
+            "expected_keywords": self.expected_keywords or [],
+            "responses": [categorize_response(service_response, self.expected_keywords) for service_response in service_responses]
         }
 
 
-def ask_chatgpt(question: str, context_tree: Optional[Dict] = None, input_tree: Optional[Dict] = None) -> Dict[str, Any]:
-    """Sends a question to the ChatGPT API."""
-    # Include Context and Input tree in the prompt
-    context_str = format_context_for_prompt(context_tree) if context_tree else ""
-    input_str = format_input_tree_for_prompt(input_tree) if input_tree else ""
-    
-    full_prompt = question
-    prompt_parts = []
+def process_question(question: str, context_tree: Dict = None, input_tree: Dict = None, use_copilot: bool = True, expected_keywords: List[str] = None, parallel: bool = True, completed_responses: Optional[Dict[str, Dict[str, Any]]] = None, on_service_response: Optional[Callable[[str, Dict[str, Any]], None]] = None, on_delta: Optional[Callable[[str, str], None]] = None, on_stream_reset: Optional[Callable[[str], None]] = None, prompt_plan: Optional[PromptPlan] = None) -> Dict[str, Any]:
+    """Sends a question to every enabled AI service and categorizes the responses.
+
+    With parallel=True the services are queried at the same time, so a question
+    takes as long as its slowest service. Responses are always returned in the
+    fixed order Copilot, Claude, ChatGPT.
+
+    Services found in completed_responses (e.g. restored from a checkpoint) are
+    not asked again. on_service_response is called with (service, response_data)
+    for every new response as soon as it arrives. With on_delta, responses are
+    streamed and on_delta is called with (service, text) for every text delta;
+    the responses are still categorized once they are complete. When a
+    service's request is sent again after part of its response was streamed,
+    on_stream_reset is called with the service and the text it streamed so
+    far should be dropped. With a prompt_plan, a prompt that another question
+    of the run already sends is not sent again; its response is shared (see
+    PromptPlan).
+    """
+    services = enabled_services(use_copilot)
+    run = _QuestionRun(question, context_tree, input_tree, expected_keywords, completed_responses, on_service_response, on_delta, on_stream_reset, prompt_plan)
     
-    if input_str:
-        prompt_parts.append(f"Input Tree:\n{input_str}")
-    if context_str:
-        prompt_parts.append(f"Context:\n{context_str}")
+    def send(service: str, service_delta: Optional[Callable[[str], None]], service_reset: Optional[Callable[[], None]]) -> Dict[str, Any]:
+        with provider_slot(service):
+            return ASK_FUNCTIONS[service](question, context_tree, input_tree, on_delta=service_delta, on_reset=service_reset)
     
-    if prompt_parts:
-        full_prompt = "\n\n".join(prompt_parts) + f"\n\nQuestion: {question}"
+    def ask_service(service: str) -> Dict[str, Any]:
+        return _drive(run.ask_steps(service, send))
     
-    api_key = os.getenv("OPENAI_API_KEY")
-    chatgpt_model = os.getenv("CHATGPT_MODEL", "gpt-4")
+    if parallel and len(services) - len(run.completed_responses) > 1:
+        with ThreadPoolExecutor(max_workers=len(services)) as executor:
+            futures = [_submit(executor, ask_service, service) for service in services]
+            return run.result([future.result() for future in futures])
+    return run.result([ask_service(service) for service in services])
+
+
+async def process_question_async(question: str, context_tree: Dict = None, input_tree: Dict = None, use_copilot: bool = True, expected_keywords: List[str] = None, provider_slots: Optional[Dict[str, asyncio.Semaphore]] = None, completed_responses: Optional[Dict[str, Dict[str, Any]]] = None, on_service_response: Optional[Callable[[str, Dict[str, Any]], None]] = None, on_delta: Optional[Callable[[str, str], None]] = None, on_stream_reset: Optional[Callable[[str], None]] = None, prompt_plan: Optional[PromptPlan] = None) -> Dict[str, Any]:
+    """Async version of process_question; all services are queried concurrently."""
+    provider_slots = provider_slots or {}
+    run = _QuestionRun(question, context_tree, input_tree, expected_keywords, completed_responses, on_service_response, on_delta, on_stream_reset, prompt_plan)
     
-    if not api_key:
-        return {
-            "service": "chatgpt",
-            "question": question,
-            "context_tree": context_tree,
-            "input_tree": input_tree,
-            "response": "",
-            "prompt_used": full_prompt,
-            "error": "OPENAI_API_KEY environment variable not set"
-        }
+    async def send(service: str, service_delta: Optional[Callable[[str], None]], service_reset: Optional[Callable[[], None]]) -> Dict[str, Any]:
+        slot = provider_slots.get(service)
+        if slot is None:
+            return await ASYNC_ASK_FUNCTIONS[service](question, context_tree, input_tree, on_delta=service_delta, on_reset=service_reset)
+        async with slot:
+            return await ASYNC_ASK_FUNCTIONS[service](question, context_tree, input_tree, on_delta=service_delta, on_reset=service_reset)
     
-    if not OPENAI_AVAILABLE:
-        return {
-            "service": "chatgpt",
-            "question": question,
-            "context_tree": context_tree,
-            "input_tree": input_tree,
-            "response": "",
-            "prompt_used": full_prompt,
-            "error": "openai library not available"
-        }
+    service_responses = await asyncio.gather(*(_drive_async(run.ask_steps(service, send)) for service in enabled_services(use_copilot)))
+    return run.result(service_responses)
+
+
+def _progress_label(index: int, total: Optional[int]) -> str:
+    return f"[{index}/{total}]" if total is not None else f"[{index}]"
+
+
+def _print_progress(index: int, total: Optional[int], q_data: Dict[str, Any]):
+    keywords = q_data.get("keywords", [])
+    print(f"\n{_progress_label(index, total)} Processing: {q_data['question'][:50]}...")
+    if keywords:
+        print(f"  Expected keywords: {', '.join(keywords[:5])}{'...' if len(keywords) > 5 else ''}")
+
+
+def _result_sink(on_result: Optional[Callable[[int, Dict[str, Any]], None]]):
+    """Returns (collected results, emit(index, result)); with on_result, results are passed on instead of collected."""
+    all_results = []
     
+    def emit(index: int, result: Dict[str, Any]):
+        if on_result is None:
+            all_results.append(result)
+        else:
+            on_result(index, result)
+    return all_results, emit
+
+
+def _in_order(questions_data: Iterable[Dict[str, Any]], submit: Callable[[int, Dict[str, Any]], Any], window: int) -> Iterator[tuple]:
+    """Submits questions with submit(index, q_data) and yields (index, future) in input order.
+
+    A question is only submitted once the future window places ahead of it
+    was taken, so a huge file never sits in an executor's queue. Futures not
+    taken when the generator is closed are cancelled.
+    """
+    in_flight = deque()
     try:
-        client = openai.OpenAI(api_key=api_key)
-        response = client.chat.completions.create(
-            model=chatgpt_model,  # Model for ChatGPT (default: gpt-4)
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": full_prompt}
-            ],
-            max_tokens=1000,
-            temperature=0.7
-        )
-        response_text = response.choices[0].message.content
-        return {
-            "service": "chatgpt",
-            "question": question,
-            "context_tree": context_tree,
-            "input_tree": input_tree,
-            "response": response_text,
-            "prompt_used": full_prompt,
-            "model_used": chatgpt_model
-        }
-    except Exception as e:
-        return {
-            "service": "chatgpt",
-            "question": question,
-            "context_tree": context_tree,
-            "input_tree": input_tree,
-            "response": "",
-            "prompt_used": full_prompt,
-            "error": str(e)
-        }
+        for i, q_data in enumerate(questions_data, 1):
+            in_flight.append((i, submit(i, q_data)))
+            if len(in_flight) >= window:
+                yield in_flight.popleft()
+        while in_flight:
+            yield in_flight.popleft()
+    finally:
+        for _, future in in_flight:
+            future.cancel()
 
 
-def classify_response(response_data: Dict[str, Any], expected_keywords: List[str] = None) -> str:
-    response = response_data.get("response", "")
-    error = response_data.get("error")
-    question = response_data.get("question", "").lower()
+def run_questions(questions_data: Iterable[Dict[str, Any]], context_tree: Dict = None, input_tree: Dict = None, use_copilot: bool = True, workers: int = 1, parallel: bool = True, on_result: Optional[Callable[[int, Dict[str, Any]], None]] = None, checkpoint: Optional[CheckpointStore] = None, total: Optional[int] = None, prompt_plan: Optional[PromptPlan] = None) -> List[Dict[str, Any]]:
+    """Processes questions on a pool of workers and returns results in input order.
+
+    questions_data may be a lazy iterator (see iter_questions): questions are
+    only taken from it as workers free up, with at most 2 * workers questions
+    submitted at a time. total is the number of questions for the progress
+    output (defaults to len(questions_data) if it has one).
+    A question's own "input_tree" (see prune_input_trees) replaces input_tree.
+    If on_result is given, it is called with (index, result) for each question
+    in input order as soon as the result is available, and the results are not
+    collected (an empty list is returned). With a checkpoint, every response is
+    recorded as it arrives and responses already in the checkpoint are reused.
+    With a prompt_plan (see plan_prompts), repeated prompts are sent only once.
+    """
+    if total is None and hasattr(questions_data, "__len__"):
+        total = len(questions_data)
     
-    # If there's an error or no response or empty response, return "No Response from AI"
-    if error or not response or response.strip() == "":
-        return "No Response from AI"
+    def process(index: int, q_data: Dict[str, Any]) -> Dict[str, Any]:
+        _print_progress(index, total, q_data)
+        return process_question(q_data["question"], context_tree, q_data.get("input_tree", input_tree), use_copilot=use_copilot, expected_keywords=q_data.get("keywords", []), parallel=parallel,
+                                prompt_plan=prompt_plan, **checkpoint_options(checkpoint, q_data))
     
-    response_lower = response.lower()
+    all_results, emit = _result_sink(on_result)
     
-    # Check if the response is a clarification request or asking about the question's meaning
-    clarification_keywords = [
-        "clarify", "rephrase", "unclear", "not sure", "don't understand",
-        "not recognized", "not a real word", "typo", "misspelling",
-        "could you please", "please provide", "please clarify",
-        "what do you mean", "what does", "could you explain",
-        "i'm not sure", "i don't know what", "doesn't seem to",
-        "appears to be", "might have been", "seems like there might"
+    # API rate limiting is handled per service by the token-bucket limiters
+    if workers <= 1:
+        for i, q_data in enumerate(questions_data, 1):
+            emit(i, process(i, q_data))
+        return all_results
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        with closing(_in_order(questions_data, functools.partial(_submit, executor, process), 2 * workers)) as futures:
+            for index, future in futures:
+                emit(index, future.result())
+    return all_results
+
+
+async def run_questions_async(questions_data: Iterable[Dict[str, Any]], context_tree: Dict = None, input_tree: Dict = None, use_copilot: bool = True, concurrency: int = 100, on_result: Optional[Callable[[int, Dict[str, Any]], None]] = None, checkpoint: Optional[CheckpointStore] = None, total: Optional[int] = None, prompt_plan: Optional[PromptPlan] = None) -> List[Dict[str, Any]]:
+    """Processes questions on one event loop, at most `concurrency` at a time, and returns results in input order.
+
+    The per-provider in-flight limits from configure_provider_limits apply here
+    as well. Questions are taken from questions_data as earlier ones finish,
+    with at most 2 * concurrency tasks alive at a time. on_result, checkpoint,
+    total and prompt_plan work as in run_questions.
+    """
+    if total is None and hasattr(questions_data, "__len__"):
+        total = len(questions_data)
+    question_slots = asyncio.Semaphore(max(1, concurrency))
+    provider_slots = {service: asyncio.Semaphore(limit) for service, limit in PROVIDER_LIMITS.items()}
+    
+    async def process(index: int, q_data: Dict[str, Any]) -> Dict[str, Any]:
+        async with question_slots:
+            _print_progress(index, total, q_data)
+            return await process_question_async(q_data["question"], context_tree, q_data.get("input_tree", input_tree), use_copilot=use_copilot, expected_keywords=q_data.get("keywords", []),
+                                                provider_slots=provider_slots, prompt_plan=prompt_plan, **checkpoint_options(checkpoint, q_data))
+    
+    all_results, emit = _result_sink(on_result)
+    tasks = _in_order(questions_data, lambda index, q_data: asyncio.ensure_future(process(index, q_data)), 2 * max(1, concurrency))
+    try:
+        for index, task in tasks:
+            emit(index, await task)
+        return all_results
+    finally:
+        tasks.close()
+        await close_async_api_clients()
+
+
+# Seconds between status checks of submitted batch jobs
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "30"))
+
+OPENAI_BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchJobState:
+    """Batch jobs submitted by a run, persisted so an interrupted run can re-attach to them.
+
+    Jobs are stored per service together with a digest of their requests; with
+    resume=True, a job is reused when the new run would submit exactly the same
+    requests. Without resume, previously recorded jobs are forgotten.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self._jobs: Dict[str, Dict[str, str]] = {}
+        if resume:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._jobs = json.load(f)
+            except (OSError, ValueError):
+                self._jobs = {}
+        self._lock = threading.Lock()
+
+    def get(self, service: str, requests_digest: str) -> Optional[str]:
+        """Returns the id of the submitted job for these requests, or None."""
+        with self._lock:
+            job = self._jobs.get(service)
+        if job and job.get("requests_digest") == requests_digest:
+            return job.get("batch_id")
+        return None
+
+    def set(self, service: str, requests_digest: str, batch_id: str):
+        with self._lock:
+            self._jobs[service] = {"batch_id": batch_id, "requests_digest": requests_digest}
+            self._save()
+
+    def remove(self, service: str):
+        with self._lock:
+            if self._jobs.pop(service, None) is not None:
+                self._save()
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._jobs, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Warning: Could not write batch state {self.path}: {e}")
+
+
+def _wait_for_batch(service: str, batch_id: str, retrieve: Callable, status_of: Callable, final_statuses: Iterable[str], poll_interval: float):
+    """Polls a batch job until it reaches a final status and returns it; failed polls are retried like API calls."""
+    last_status = None
+    while True:
+        batch = current_retry_policy().call(service, lambda: retrieve(batch_id))
+        status = status_of(batch)
+        if status != last_status:
+            print(f"  [{service}] Batch {batch_id}: {status}")
+            last_status = status
+        if status in final_statuses:
+            return batch
+        time.sleep(poll_interval)
+
+
+def _run_openai_batch(service: str, api_key: str, model: str, system_prompt: str, prompts: Dict[str, str], state: Optional[BatchJobState] = None, poll_interval: float = BATCH_POLL_INTERVAL):
+    """Runs {custom_id: prompt} as one OpenAI Batch job.
+
+    Returns (batch id, {custom_id: {"response", "usage"} or {"error"}}).
+    """
+    client = get_openai_client(api_key)
+    lines = [
+        json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": _openai_request(model, system_prompt, prompt, 1000, 0.7)
+        }, ensure_ascii=False)
+        for custom_id, prompt in prompts.items()
     ]
+    data = ("\n".join(lines) + "\n").encode('utf-8')
+    requests_digest = hashlib.sha256(data).hexdigest()
     
-    # If the response requests clarification or asks about the question's meaning
-    is_clarification_request = any(keyword in response_lower for keyword in clarification_keywords)
+    batch_id = state.get(service, requests_digest) if state else None
+    if batch_id is None:
+        input_file = current_retry_policy().call(service, lambda: client.files.create(file=(f"{service}_batch.jsonl", data), purpose="batch"))
+        batch_id = current_retry_policy().call(service, lambda: client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h")).id
+        if state:
+            state.set(service, requests_digest, batch_id)
+        print(f"  [{service}] Submitted batch {batch_id} with {len(lines)} requests")
+    else:
+        print(f"  [{service}] Re-attaching to batch {batch_id}")
+    batch = _wait_for_batch(service, batch_id, client.batches.retrieve, lambda b: b.status, OPENAI_BATCH_FINAL_STATUSES, poll_interval)
     
-    # Detect if the question itself is unclear or has typos
-    # Incomplete question patterns like "what mean", "what do", "what does"
-    question_patterns = [
-        "what mean", "what do", "what does", "what is mean",
-        "what mean by", "mean by", "mean?"
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        content = current_retry_policy().call(service, lambda: client.files.content(file_id).text)
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") == 200:
+                completion = openai.types.chat.ChatCompletion.model_validate(response["body"])
+                results[record["custom_id"]] = {"response": completion.choices[0].message.content, "usage": _openai_usage(completion)}
+            else:
+                error = record.get("error") or (response.get("body") or {}).get("error") or {}
+                results[record["custom_id"]] = {"error": f"Batch request failed: {error.get('message') or response.get('status_code')}"}
+    
+    # Requests of failed (e.g. invalid input file) or expired batches have no result line
+    batch_errors = getattr(getattr(batch, "errors", None), "data", None) or []
+    reason = "; ".join(error.message for error in batch_errors if getattr(error, "message", None)) or f"batch {batch.status}"
+    for custom_id in prompts:
+        results.setdefault(custom_id, {"error": f"No result in batch {batch_id}: {reason}"})
+    if state:
+        state.remove(service)
+    return batch_id, results
+
+
+def _run_claude_batch(api_key: str, model: str, prompts: Dict[str, str], cached_prefixes: Dict[str, Optional[str]], state: Optional[BatchJobState] = None, poll_interval: float = BATCH_POLL_INTERVAL):
+    """Runs {custom_id: prompt} as one Anthropic Message Batch.
+
+    Returns (batch id, {custom_id: {"response", "usage"} or {"error", "model_unavailable"}}).
+    """
+    client = get_anthropic_client(api_key)
+    batch_requests = [
+        {"custom_id": custom_id, "params": _claude_request(model, prompt, 1000, cached_prefixes.get(custom_id))}
+        for custom_id, prompt in prompts.items()
     ]
+    requests_digest = hashlib.sha256(json.dumps(batch_requests, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
     
-    is_unclear_question = any(pattern in question for pattern in question_patterns)
+    batch_id = state.get("claude", requests_digest) if state else None
+    if batch_id is None:
+        batch_id = current_retry_policy().call("claude", lambda: client.messages.batches.create(requests=batch_requests)).id
+        if state:
+            state.set("claude", requests_digest, batch_id)
+        print(f"  [claude] Submitted batch {batch_id} with {len(batch_requests)} requests")
+    else:
+        print(f"  [claude] Re-attaching to batch {batch_id}")
+    _wait_for_batch("claude", batch_id, client.messages.batches.retrieve, lambda b: b.processing_status, ("ended",), poll_interval)
     
-    # If it's a clarification request or response to an incomplete question, return "Wrong Answer"
-    if is_clarification_request or (is_unclear_question and is_clarification_request):
-        return "Wrong Answer"
+    results = {}
+    for entry in current_retry_policy().call("claude", lambda: list(client.messages.batches.results(batch_id))):
+        result = entry.result
+        if result.type == "succeeded":
+            results[entry.custom_id] = {"response": result.message.content[0].text, "usage": _claude_usage(result.message)}
+        elif result.type == "errored":
+            error = getattr(result.error, "error", None)
+            error_type = getattr(error, "type", "")
+            message = getattr(error, "message", None) or str(result.error)
+            results[entry.custom_id] = {
+                "error": f"API Error: {message}",
+                "model_unavailable": error_type in ("not_found_error", "permission_error") or _is_model_unavailable_error(Exception(message))
+            }
+        else:
+            results[entry.custom_id] = {"error": f"Batch request {result.type}"}
+    for custom_id in prompts:
+        results.setdefault(custom_id, {"error": f"No result in batch {batch_id}"})
+    if state:
+        state.remove("claude")
+    return batch_id, results
+
+
+def _batch_metrics(service: str, model: str, usage: Optional[Dict[str, int]] = None, cache_hit: bool = False) -> Dict[str, Any]:
+    """Call metrics of a batch response; batch jobs have no per-request latency."""
+    usage = usage or {}
+    return {
+        "wall_time": None,
+        "ttft": None,
+        "input_tokens": usage.get("input_tokens", 0),
+        "output_tokens": usage.get("output_tokens", 0),
+        "cached_input_tokens": usage.get("cached_input_tokens", 0),
+        "retries": 0,
+        "cache_hit": cache_hit,
+        "cost_usd": 0.0 if cache_hit else estimate_cost(service, model, usage, BATCH_PRICE_FACTOR),
+        "batch": True
+    }
+
+
+def ask_service_batch(service: str, items: List[Dict[str, Any]], context_tree: Optional[Dict] = None, state: Optional[BatchJobState] = None, poll_interval: float = BATCH_POLL_INTERVAL) -> Dict[int, Dict[str, Any]]:
+    """Asks one service every question in items through its batch API.
+
+    items are dicts with "index", "question" and "input_tree". Returns
+    {index: response_data}, with response_data shaped like the ask_* results.
+    Cached responses are served from the response cache and not submitted.
+    For Claude, requests that fail because the model is unavailable are
+    resubmitted with the next model in CLAUDE_MODELS.
+    """
+    responses = {}
     
-    # If the response is very short or meaningless (e.g., "I don't know", "Not sure", etc.)
-    short_unclear_responses = ["i don't know", "not sure", "i'm not sure", "i can't"]
-    if any(phrase in response_lower for phrase in short_unclear_responses) and len(response.split()) < 10:
-        return "Wrong Answer"
+    def respond(item: Dict[str, Any], prompt: Union[str, PromptBuilder], **fields):
+        responses[item["index"]] = _service_response(service, item["question"], context_tree, item["input_tree"], prompt, **fields)
     
-    # Check expected keywords if provided
-    if expected_keywords and len(expected_keywords) > 0:
-        keywords_lower = [kw.lower() for kw in expected_keywords]
-        found_keywords = [kw for kw in keywords_lower if kw in response_lower]
-        keyword_match_ratio = len(found_keywords) / len(keywords_lower) if keywords_lower else 0
+    if service == "claude":
+        api_key = os.getenv("ANTHROPIC_API_KEY")
+        unavailable_reason = _claude_unavailable_reason(api_key)
+    else:
+        api_key = os.getenv("OPENAI_API_KEY")
+        unavailable_reason = _openai_unavailable_reason(service, api_key)
+    if unavailable_reason:
+        for item in items:
+            respond(item, get_prompt_builder(context_tree, item["input_tree"]), error=unavailable_reason)
+        return responses
+    
+    if service == "claude":
+        cache_key, cached_model, models_to_try = _claude_models_to_try(api_key)
+        system_prompt, temperature = None, None
+    elif service == "copilot":
+        models_to_try = [os.getenv("COPILOT_MODEL", "gpt-3.5-turbo")]
+        system_prompt, temperature = COPILOT_SYSTEM_PROMPT, 0.7
+    else:
+        models_to_try = [os.getenv("CHATGPT_MODEL", "gpt-4")]
+        system_prompt, temperature = CHATGPT_SYSTEM_PROMPT, 0.7
+    
+    remaining = items
+    last_error = None
+    for model in models_to_try:
+        pending = {}
+        for item in remaining:
+            builder = get_prompt_builder(context_tree, item["input_tree"])
+            prompt = builder.build(item["question"])
+            key = None
+            if response_cache.mode != "off":
+                try:
+                    key, payload = response_cache._lookup(service, model, system_prompt, prompt, 1000, temperature)
+                except ResponseCacheMiss as e:
+                    respond(item, builder, error=str(e))
+                    continue
+                if payload is not None:
+                    respond(item, builder, response=payload["response"], model_used=model, cache_hit=True, usage=payload.get("usage", {}),
+                            metrics=_batch_metrics(service, model, cache_hit=True))
+                    continue
+            pending[f"q{item['index']}-{service}"] = dict(item, prompt=prompt, builder=builder, cached_prefix=builder.static_prefix, cache_key=key)
+        if not pending:
+            return responses
         
-        # Store keyword matching info in response_data for later use
-        response_data["keyword_analysis"] = {
-            "expected_keywords": expected_keywords,
-            "found_keywords": found_keywords,
-            "missing_keywords": [kw for kw in keywords_lower if kw not in response_lower],
-            "match_ratio": keyword_match_ratio
-        }
+        prompts = {custom_id: request["prompt"] for custom_id, request in pending.items()}
+        try:
+            if service == "claude":
+                cached_prefixes = {custom_id: request["cached_prefix"] for custom_id, request in pending.items()}
+                batch_id, results = _run_claude_batch(api_key, model, prompts, cached_prefixes, state, poll_interval)
+            else:
+                batch_id, results = _run_openai_batch(service, api_key, model, system_prompt, prompts, state, poll_interval)
+        except Exception as e:
+            error = _claude_error_message(e) if service == "claude" else str(e)
+            for request in pending.values():
+                respond(request, request["builder"], error=error)
+            return responses
         
-        # If less than 50% of keywords are found, consider it "Wrong Answer"
-        if keyword_match_ratio < 0.5:
-            return "Wrong Answer"
+        retry = []
+        for custom_id, request in pending.items():
+            payload = results[custom_id]
+            if "error" in payload:
+                if payload.get("model_unavailable"):
+                    last_error = payload["error"]
+                    retry.append(request)
+                else:
+                    respond(request, request["builder"], error=payload["error"])
+                continue
+            if request["cache_key"]:
+                response_cache.put(request["cache_key"], service, model, payload)
+            respond(request, request["builder"], response=payload["response"], model_used=model,
+                    cache_hit=False, usage=payload.get("usage", {}), batch_id=batch_id,
+                    metrics=_batch_metrics(service, model, payload.get("usage", {})))
+        
+        if service == "claude":
+            if len(retry) < len(pending):
+                model_cache.set(cache_key, model)
+            elif model == cached_model:
+                model_cache.invalidate(cache_key)
+        if not retry:
+            return responses
+        remaining = retry
     
-    # Otherwise, consider it as "Correct Answer"
-    return "Correct Answer"
+    # All models failed
+    for item in remaining:
+        respond(item, get_prompt_builder(context_tree, item["input_tree"]), error=f"All models failed. Last error: {last_error}")
+    return responses
 
 
-def categorize_response(response_data: Dict[str, Any], expected_keywords: List[str] = None) -> Dict[str, Any]:
-    classification = classify_response(response_data, expected_keywords)
+def run_questions_batch(questions_data: Iterable[Dict[str, Any]], context_tree: Dict = None, input_tree: Dict = None, use_copilot: bool = True, on_result: Optional[Callable[[int, Dict[str, Any]], None]] = None, checkpoint: Optional[CheckpointStore] = None, state: Optional[BatchJobState] = None, poll_interval: float = BATCH_POLL_INTERVAL, dedupe: bool = True) -> List[Dict[str, Any]]:
+    """Asks every question through the providers' batch APIs and returns results in input order.
+
+    All prompts of a service go into one batch job (OpenAI Batch for Copilot
+    and ChatGPT, Anthropic Message Batches for Claude); the jobs run at the
+    same time and are polled every poll_interval seconds. The responses are
+    then categorized exactly like in process_question. Submitted jobs are
+    recorded in state, if given, so that a resumed run can wait for them
+    instead of submitting again. on_result and checkpoint work as in
+    run_questions. With dedupe, a prompt that occurs more than once is
+    submitted once per service and its response is shared (see PromptPlan).
+    """
+    services = enabled_services(use_copilot)
     
-    # Classify according to Output tree structure
-    if classification == "Correct Answer":
-        return {
-            "validity": "Valid",
-            "result": "Correct Answer",
-            "response_data": response_data
-        }
-    elif classification == "Wrong Answer":
-        return {
-            "validity": "Invalid",
-            "result": "Wrong Answer",
-            "response_data": response_data
+    questions = []
+    pending = {service: [] for service in services}
+    # The index of the question that submits each prompt, and of the questions reusing it
+    first_index = {service: {} for service in services}
+    shared_from = {service: {} for service in services}
+    for index, q_data in enumerate(questions_data, 1):
+        options = checkpoint_options(checkpoint, q_data)
+        item = {"index": index, "question": q_data["question"], "input_tree": q_data.get("input_tree", input_tree)}
+        completed_responses = options.get("completed_responses", {})
+        key = prompt_key(item["question"], context_tree, item["input_tree"]) if dedupe else None
+        for service in services:
+            if service in completed_responses:
+                continue
+            if dedupe:
+                first = first_index[service].setdefault(key, index)
+                if first != index:
+                    shared_from[service][index] = first
+                    continue
+            pending[service].append(item)
+        questions.append((q_data, completed_responses, options.get("on_service_response")))
+    
+    duplicates = sum(len(indexes) for indexes in shared_from.values())
+    print(f"\nSubmitting {sum(len(items) for items in pending.values())} requests in batch mode"
+          f"{f' ({duplicates} requests for repeated prompts skipped)' if duplicates else ''}...")
+    with ThreadPoolExecutor(max_workers=len(services)) as executor:
+        futures = {
+            service: _submit(executor, ask_service_batch, service, items, context_tree, state, poll_interval)
+            for service, items in pending.items() if items
         }
-    else:  # No Response from AI
-        return {
-            "validity": "Invalid",
-            "result": "No Response from AI",
-            "response_data": response_data
+        batch_responses = {service: future.result() for service, future in futures.items()}
+    
+    all_results = []
+    for index, (q_data, completed_responses, on_service_response) in enumerate(questions, 1):
+        keywords = q_data.get("keywords", [])
+        result = {
+            "question": q_data["question"],
+            "expected_keywords": keywords or [],
+            "responses": []
         }
+        for service in services:
+            response_data = completed_responses.get(service)
+            if response_data is None:
+                if index in shared_from[service]:
+                    response_data = _shared_response(batch_responses[service][shared_from[service][index]], context_tree,
+                                                     q_data.get("input_tree", input_tree))
+                else:
+                    response_data = batch_responses[service][index]
+                if on_service_response is not None:
+                    on_service_response(service, response_data)
+            result["responses"].append(categorize_response(response_data, keywords))
+        if on_result is None:
+            all_results.append(result)
+        else:
+            on_result(index, result)
+    return all_results
 
 
-def process_question(question: str, context_tree: Dict = None, input_tree: Dict = None, use_copilot: bool = True, expected_keywords: List[str] = None) -> Dict[str, Any]:
-    results = {
-        "question": question,
-        "expected_keywords": expected_keywords or [],
-        "responses": []
+def _new_summary(total_questions: int = 0) -> Dict[str, int]:
+    return {
+        "total_questions": total_questions,
+        "total_responses": 0,
+        "valid_count": 0,
+        "invalid_count": 0,
+        "correct_answer_count": 0,
+        "wrong_answer_count": 0,
+        "no_response_count": 0
     }
-    
-    # Copilot (optional)
-    if use_copilot:
-        copilot_token = os.getenv("GITHUB_COPILOT_TOKEN") or os.getenv("OPENAI_API_KEY")
-        if copilot_token:
-            copilot_response = ask_copilot(question, context_tree, input_tree)
-            results["responses"].append(categorize_response(copilot_response, expected_keywords))
+
+
+def _count_response(summary: Dict[str, int], validity: str, result: str):
+    """Updates the summary statistics with one categorized response."""
+    summary["total_responses"] += 1
+    if validity == "Valid":
+        summary["valid_count"] += 1
+        summary["correct_answer_count"] += 1
+    else:
+        summary["invalid_count"] += 1
+        if result == "Wrong Answer":
+            summary["wrong_answer_count"] += 1
         else:
-            print("  [Copilot] Skipping due to missing API key.")
-    
-    # Claude
-    claude_response = ask_claude(question, context_tree, input_tree)
-    results["responses"].append(categorize_response(claude_response, expected_keywords))
+            summary["no_response_count"] += 1
+
+
+def _percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99 of values (nearest rank); None when there are no values."""
+    values = sorted(values)
+    return {
+        f"p{p}": values[max(0, math.ceil(p / 100 * len(values)) - 1)] if values else None
+        for p in (50, 95, 99)
+    }
+
+
+class ServiceMetricsAggregator:
+    """Aggregates the call metrics of responses per service for the "services" block of the summary.
+
+    Latency and time-to-first-token percentiles are taken over the calls that
+    reached the provider; response cache hits and batch responses only count
+    towards the totals. Responses shared from another question's request (see
+    PromptPlan) are counted as deduplicated and add no tokens, cost or latency.
+    """
+
+    def __init__(self):
+        self._services: Dict[str, Dict[str, Any]] = {}
+
+    def add(self, response_data: Dict[str, Any]):
+        service = response_data.get("service", "unknown")
+        stats = self._services.get(service)
+        if stats is None:
+            stats = {"requests": 0, "errors": 0, "cache_hits": 0, "deduplicated": 0, "retries": 0, "input_tokens": 0, "output_tokens": 0,
+                     "cached_input_tokens": 0, "cost_usd": 0.0, "latency": [], "ttft": []}
+            self._services[service] = stats
+        stats["requests"] += 1
+        if response_data.get("error"):
+            stats["errors"] += 1
+        metrics = response_data.get("metrics")
+        if not metrics:
+            return
+        if metrics.get("deduplicated"):
+            stats["deduplicated"] += 1
+            return
+        if metrics.get("cache_hit"):
+            stats["cache_hits"] += 1
+        else:
+            if metrics.get("wall_time") is not None:
+                stats["latency"].append(metrics["wall_time"])
+            if metrics.get("ttft") is not None:
+                stats["ttft"].append(metrics["ttft"])
+        for field in ("retries", "input_tokens", "output_tokens", "cached_input_tokens"):
+            stats[field] += metrics.get(field) or 0
+        stats["cost_usd"] += metrics.get("cost_usd") or 0.0
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        services = {}
+        for service, stats in self._services.items():
+            services[service] = dict(stats, latency=_percentiles(stats["latency"]), ttft=_percentiles(stats["ttft"]),
+                                     cost_usd=round(stats["cost_usd"], 6))
+        return services
+
+
+def _response_entry(question: str, response: Dict[str, Any]) -> Dict[str, Any]:
+    """Builds the entry stored under output/<validity>/<result> for one response."""
+    response_entry = {
+        "question": question,
+        "service": response["response_data"].get("service", "unknown"),
+        "response": response["response_data"].get("response", ""),
+        "prompt_used": response["response_data"].get("prompt_used", "")
+    }
     
-    # ChatGPT
-    chatgpt_response = ask_chatgpt(question, context_tree, input_tree)
-    results["responses"].append(categorize_response(chatgpt_response, expected_keywords))
+    # Add keyword analysis if available
+    keyword_analysis = response["response_data"].get("keyword_analysis")
+    if keyword_analysis:
+        response_entry["keyword_analysis"] = {
+            "expected_keywords": keyword_analysis.get("expected_keywords", []),
+            "found_keywords": keyword_analysis.get("found_keywords", []),
+            "missing_keywords": keyword_analysis.get("missing_keywords", []),
+            "match_ratio": keyword_analysis.get("match_ratio", 0)
+        }
     
-    return results
+    return response_entry
+
 
+class _ResponseEntry(_Record):
+    """An output/<validity>/<result> entry that is only rendered (see _response_entry) when it is serialized."""
 
-def save_output_tree(results: List[Dict], output_path: str):
-    """Saves results in output tree format.
+    __slots__ = ("question", "response")
+
+    def __init__(self, question: str, response: Dict[str, Any]):
+        self.question = question
+        self.response = response
+
+    def to_dict(self) -> Dict[str, Any]:
+        return _response_entry(self.question, self.response)
+
+
+def save_output_tree(results: List[Dict], output_path: str) -> Dict[str, Any]:
+    """Saves results in output tree format and returns the summary.
     
     Output tree structure:
     {
@@ -557,7 +2950,8 @@ def save_output_tree(results: List[Dict], output_path: str):
           "Wrong Answer": [...],
           "No Response from AI": [...]
         }
-      }
+      },
+      "summary": {..., "services": {<service>: {latency, ttft, token totals, ...}}}
     }
     """
     # Initialize Output tree structure
@@ -571,18 +2965,11 @@ def save_output_tree(results: List[Dict], output_path: str):
                 "No Response from AI": []
             }
         },
-        "summary": {
-            "total_questions": len(results),
-            "total_responses": 0,
-            "valid_count": 0,
-            "invalid_count": 0,
-            "correct_answer_count": 0,
-            "wrong_answer_count": 0,
-            "no_response_count": 0
-        }
+        "summary": _new_summary(len(results))
     }
     
     # Classify and save responses for each question
+    service_metrics = ServiceMetricsAggregator()
     for question_result in results:
         question = question_result["question"]
         for response in question_result["responses"]:
@@ -590,42 +2977,261 @@ def save_output_tree(results: List[Dict], output_path: str):
             result = response["result"]
             
             # Update statistics
-            output_tree["summary"]["total_responses"] += 1
-            if validity == "Valid":
-                output_tree["summary"]["valid_count"] += 1
-                output_tree["summary"]["correct_answer_count"] += 1
-            else:
-                output_tree["summary"]["invalid_count"] += 1
-                if result == "Wrong Answer":
-                    output_tree["summary"]["wrong_answer_count"] += 1
-                else:
-                    output_tree["summary"]["no_response_count"] += 1
-            
-            # Add response to the corresponding category
-            response_entry = {
-                "question": question,
-                "service": response["response_data"].get("service", "unknown"),
-                "response": response["response_data"].get("response", ""),
-                "prompt_used": response["response_data"].get("prompt_used", "")
-            }
-            
-            # Add keyword analysis if available
-            keyword_analysis = response["response_data"].get("keyword_analysis")
-            if keyword_analysis:
-                response_entry["keyword_analysis"] = {
-                    "expected_keywords": keyword_analysis.get("expected_keywords", []),
-                    "found_keywords": keyword_analysis.get("found_keywords", []),
-                    "missing_keywords": keyword_analysis.get("missing_keywords", []),
-                    "match_ratio": keyword_analysis.get("match_ratio", 0)
-                }
+            _count_response(output_tree["summary"], validity, result)
+            service_metrics.add(response["response_data"])
             
-            output_tree["output"][validity][result].append(response_entry)
+            # Add response to the corresponding category (rendered while the file is written)
+            output_tree["output"][validity][result].append(_ResponseEntry(question, response))
+    
+    output_tree["summary"]["services"] = service_metrics.summary()
     
     # Also include full results (detailed information)
     output_tree["detailed_results"] = results
     
     with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(output_tree, f, ensure_ascii=False, indent=2)
+        json.dump(output_tree, f, ensure_ascii=False, indent=2, default=_record_to_json)
+    return output_tree["summary"]
+
+
+class OutputLogWriter:
+    """Appends categorized responses to a JSONL log as each question finishes.
+
+    Every response becomes one line:
+    {"index": ..., "question": ..., "expected_keywords": [...], "validity": ..., "result": ..., "response_data": {...}}
+    The log is flushed after every question, so a crash keeps everything
+    written so far. The summary counters are kept up to date as records are
+    written. build_output_tree_from_log turns the log into the output tree.
+    """
+
+    def __init__(self, log_path: str, append: bool = False):
+        self.log_path = log_path
+        self.summary = _new_summary()
+        self._file = open(log_path, 'a' if append else 'w', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def write_result(self, index: int, question_result: Dict[str, Any]):
+        """Writes the categorized responses of one question."""
+        lines = []
+        for response in question_result["responses"]:
+            record = {
+                "index": index,
+                "question": question_result["question"],
+                "expected_keywords": question_result.get("expected_keywords", []),
+                "validity": response["validity"],
+                "result": response["result"],
+                "response_data": response["response_data"]
+            }
+            lines.append(json.dumps(record, ensure_ascii=False, default=_record_to_json) + "\n")
+        with self._lock:
+            self._file.write("".join(lines))
+            self._file.flush()
+            self.summary["total_questions"] += 1
+            for response in question_result["responses"]:
+                _count_response(self.summary, response["validity"], response["result"])
+
+    def close(self):
+        """Closes the log file."""
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_log_results(log_path: str) -> Iterator[Dict[str, Any]]:
+    """Yields one question result per question from an OutputLogWriter log.
+
+    Records of the same question are consecutive in the log, so only one
+    question is held in memory at a time. A truncated last line (e.g. after a
+    crash) is ignored.
+    """
+    current = None
+    current_index = None
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if current is None or record["index"] != current_index:
+                if current is not None:
+                    yield current
+                current_index = record["index"]
+                current = {
+                    "question": record["question"],
+                    "expected_keywords": record.get("expected_keywords", []),
+                    "responses": []
+                }
+            current["responses"].append({
+                "validity": record["validity"],
+                "result": record["result"],
+                "response_data": record["response_data"]
+            })
+    if current is not None:
+        yield current
+
+
+def write_output_tree_streaming(results: Iterable[Dict[str, Any]], output_path: str) -> Dict[str, Any]:
+    """Writes the output tree from an iterable of question results in one streaming pass.
+
+    The tree has the same layout as save_output_tree, but entries are spooled
+    to temporary files instead of being kept in memory and the JSON is written
+    without indentation. Returns the summary.
+    """
+    summary = _new_summary()
+    service_metrics = ServiceMetricsAggregator()
+    categories = [("Valid", "Correct Answer"), ("Invalid", "Wrong Answer"), ("Invalid", "No Response from AI")]
+    spools = {category: tempfile.TemporaryFile(mode='w+', encoding='utf-8') for category in categories}
+    first_entry = {category: True for category in categories}
+    details = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+    
+    try:
+        first_detail = True
+        for question_result in results:
+            summary["total_questions"] += 1
+            question = question_result["question"]
+            for response in question_result["responses"]:
+                category = (response["validity"], response["result"])
+                _count_response(summary, *category)
+                service_metrics.add(response["response_data"])
+                if not first_entry[category]:
+                    spools[category].write(", ")
+                first_entry[category] = False
+                spools[category].write(json.dumps(_response_entry(question, response), ensure_ascii=False))
+            if not first_detail:
+                details.write(", ")
+            first_detail = False
+            details.write(json.dumps(question_result, ensure_ascii=False, default=_record_to_json))
+        
+        summary["services"] = service_metrics.summary()
+        tmp_path = f"{output_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('{"output": {')
+            for i, validity in enumerate(("Valid", "Invalid")):
+                if i:
+                    f.write(', ')
+                f.write(f'{json.dumps(validity)}: {{')
+                for j, category in enumerate(c for c in categories if c[0] == validity):
+                    if j:
+                        f.write(', ')
+                    f.write(f'{json.dumps(category[1])}: [')
+                    spools[category].seek(0)
+                    shutil.copyfileobj(spools[category], f)
+                    f.write(']')
+                f.write('}')
+            f.write(f'}}, "summary": {json.dumps(summary)}, "detailed_results": [')
+            details.seek(0)
+            shutil.copyfileobj(details, f)
+            f.write(']}')
+        os.replace(tmp_path, output_path)
+    finally:
+        for spool in spools.values():
+            spool.close()
+        details.close()
+    
+    return summary
+
+
+def build_output_tree_from_log(log_path: str, output_path: str) -> Dict[str, Any]:
+    """Builds the output tree file from an OutputLogWriter log; returns the summary."""
+    return write_output_tree_streaming(iter_log_results(log_path), output_path)
+
+
+def iter_detailed_results(output_path: str, chunk_size: int = 1 << 20):
+    """Yields the detailed_results entries of a saved output tree one by one.
+
+    The file is read in chunks and each entry is decoded on its own, so the
+    whole output tree never has to be loaded at once.
+    """
+    decoder = json.JSONDecoder()
+    marker = '"detailed_results"'
+    with open(output_path, 'r', encoding='utf-8') as f:
+        # Skip ahead to the start of the detailed_results array
+        buffer = ""
+        while True:
+            chunk = f.read(chunk_size)
+            buffer += chunk
+            index = buffer.find(marker)
+            if index >= 0:
+                buffer = buffer[index + len(marker):]
+                break
+            if not chunk:
+                return
+            buffer = buffer[-len(marker):]
+        
+        def fill() -> bool:
+            nonlocal buffer
+            chunk = f.read(chunk_size)
+            buffer += chunk
+            return bool(chunk)
+        
+        # Skip the ':' and '[' in front of the first entry
+        while '[' not in buffer:
+            if not fill():
+                return
+        buffer = buffer[buffer.index('[') + 1:]
+        
+        while True:
+            buffer = buffer.lstrip(" \t\r\n,")
+            if not buffer:
+                if not fill():
+                    raise ValueError(f"Unexpected end of file in {output_path}")
+                continue
+            if buffer[0] == ']':
+                return
+            try:
+                entry, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if not fill():
+                    raise
+                continue
+            buffer = buffer[end:]
+            yield entry
+
+
+def reclassify_result(question_result: Dict[str, Any]) -> Dict[str, Any]:
+    """Runs categorize_response again on the stored responses of one question."""
+    expected_keywords = question_result.get("expected_keywords", [])
+    responses = []
+    for response in question_result.get("responses", []):
+        response_data = dict(response.get("response_data", {}))
+        response_data.pop("keyword_analysis", None)
+        responses.append(categorize_response(response_data, expected_keywords))
+    return dict(question_result, responses=responses)
+
+
+def reclassify_main(argv: List[str]):
+    """Re-scores a previous output file or JSONL log without calling any AI service."""
+    parser = argparse.ArgumentParser(prog='main.py reclassify', description='Re-classify the responses of an existing output file without API calls')
+    parser.add_argument('input_file', type=str, help='Output file or .jsonl log of a previous run')
+    parser.add_argument('--output', type=str, default='output_reclassified.json', help='Output file path (default: output_reclassified.json)')
+    args = parser.parse_args(argv)
+    
+    start = time.time()
+    if args.input_file.endswith('.jsonl'):
+        results = iter_log_results(args.input_file)
+    else:
+        results = iter_detailed_results(args.input_file)
+    summary = write_output_tree_streaming((reclassify_result(question_result) for question_result in results), args.output)
+    
+    print(f"Re-classified {summary['total_questions']} questions in {time.time() - start:.2f}s.")
+    print(f"Results saved to {args.output}.")
+
+
+def build_output_main(argv: List[str]):
+    """Builds an output tree from the JSONL log of a (possibly interrupted) run."""
+    parser = argparse.ArgumentParser(prog='main.py build-output', description='Build the output tree from a JSONL log written with --stream')
+    parser.add_argument('log_file', type=str, help='JSONL log of a run')
+    parser.add_argument('--output', type=str, default='output.json', help='Output file path (default: output.json)')
+    args = parser.parse_args(argv)
+    
+    summary = build_output_tree_from_log(args.log_file, args.output)
+    print(f"Built output tree for {summary['total_questions']} questions.")
+    print(f"Results saved to {args.output}.")
 
 
 def select_file_gui(title: str, filetypes: list) -> Optional[str]:
@@ -645,14 +3251,60 @@ def select_file_gui(title: str, filetypes: list) -> Optional[str]:
     return file_path if file_path else None
 
 
+def parse_service_limits(values: List[str], option: str) -> Dict[str, float]:
+    """Parses repeated SERVICE=N command line values."""
+    limits = {}
+    for value in values:
+        service, _, limit = value.partition('=')
+        try:
+            limits[service.strip().lower()] = float(limit)
+        except ValueError:
+            print(f"Error: Invalid {option} value '{value}'. Expected SERVICE=N.")
+            sys.exit(1)
+    return limits
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'reclassify':
+        reclassify_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'build-output':
+        build_output_main(sys.argv[2:])
+        return
+    
     parser = argparse.ArgumentParser(description='Test Automation Tool')
     parser.add_argument('questions_file', type=str, nargs='?', help='Path to text file containing questions')
     parser.add_argument('--context-tree', type=str, help='Path to Context tree JSON file (optional)')
     parser.add_argument('--input-tree', type=str, help='Path to Input tree JSON file (optional)')
     parser.add_argument('--output', type=str, default='output.json', help='Output file path (default: output.json)')
+    parser.add_argument('--prune-input-tree', action='store_true', help="Only include the input subtree of each question's chapter and topic in its prompt")
+    parser.add_argument('--prompt-token-budget', type=int, help='With --prune-input-tree, trim each subtree to about this many tokens')
+    parser.add_argument('--stream', action='store_true', help='Write each result to a JSONL log as soon as it finishes and build the output tree from the log')
+    parser.add_argument('--log', type=str, help='JSONL log path for --stream (default: <output>.jsonl)')
+    parser.add_argument('--checkpoint', type=str, help='Checkpoint file recording every response as it arrives (default: <output>.checkpoint.jsonl)')
+    parser.add_argument('--resume', action='store_true', help='Resume from the checkpoint: only ask the (question, service) pairs that are not in it yet')
     parser.add_argument('--skip-copilot', action='store_true', help='Skip Copilot (useful when API key is missing)')
     parser.add_argument('--gui', action='store_true', help='Select files in GUI mode')
+    parser.add_argument('--sequential', action='store_true', help='Query AI services one after another instead of concurrently')
+    parser.add_argument('--workers', type=int, default=1, help='Number of questions processed in parallel (default: 1)')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='Run on one asyncio event loop with the async SDK clients; --workers sets the number of questions in flight')
+    parser.add_argument('--batch', action='store_true', help='Submit all prompts through the OpenAI Batch and Anthropic Message Batches APIs and poll until they finish')
+    parser.add_argument('--no-dedupe', action='store_true', help='Send every question even if another question of the run has the same prompt (repeats across runs or files are only reused with --cache read)')
+    parser.add_argument('--batch-poll-interval', type=float, default=BATCH_POLL_INTERVAL, help=f'Seconds between batch status checks (default: $BATCH_POLL_INTERVAL or {BATCH_POLL_INTERVAL:g})')
+    parser.add_argument('--max-inflight-copilot', type=int, help='Maximum concurrent requests to Copilot (default: unlimited)')
+    parser.add_argument('--max-inflight-claude', type=int, help='Maximum concurrent requests to Claude (default: unlimited)')
+    parser.add_argument('--max-inflight-chatgpt', type=int, help='Maximum concurrent requests to ChatGPT (default: unlimited)')
+    parser.add_argument('--rpm', action='append', default=[], metavar='SERVICE=N', help='Requests per minute for a service, e.g. claude=50 (overrides <SERVICE>_RPM)')
+    parser.add_argument('--tpm', action='append', default=[], metavar='SERVICE=N', help='Tokens per minute for a service, e.g. chatgpt=40000 (overrides <SERVICE>_TPM)')
+    parser.add_argument('--max-retries', type=int, help='Retries per request for 429/5xx/connection errors, with exponential backoff (default: $RETRY_MAX_RETRIES or 3)')
+    parser.add_argument('--retry-budget', type=int, help='Maximum number of retries in the whole run (default: $RETRY_BUDGET or unlimited)')
+    parser.add_argument('--circuit-threshold', type=int, help='Consecutive provider failures that open a service\'s circuit breaker; 0 disables it (default: $CIRCUIT_FAILURE_THRESHOLD or 5)')
+    parser.add_argument('--circuit-timeout', type=float, help='Seconds an open circuit breaker waits before letting a probe request through (default: $CIRCUIT_RECOVERY_TIMEOUT or 30)')
+    parser.add_argument('--cache', choices=ResponseCache.MODES, help='Response cache mode: off, read (read-through), refresh or offline (replay only) (default: $RESPONSE_CACHE_MODE or off)')
+    parser.add_argument('--cache-path', type=str, help='Response cache SQLite file (default: $RESPONSE_CACHE_PATH or .response_cache.sqlite3)')
+    parser.add_argument('--cache-max-entries', type=int, help='Evict the oldest cached responses beyond this count')
+    parser.add_argument('--cache-max-age', type=float, help='Ignore and evict cached responses older than this many seconds')
+    parser.add_argument('--model-cache', type=str, help='JSON file that remembers the working Claude model between runs (default: $MODEL_CACHE_PATH)')
     
     args = parser.parse_args()
     
@@ -699,9 +3351,10 @@ def main():
         args.context_tree = context_tree
         args.input_tree = input_tree
     
-    # Read questions file
-    questions_data = read_questions(args.questions_file)
-    print(f"Read {len(questions_data)} questions.")
+    # Questions are read lazily while the run goes on
+    questions_data = iter_questions(args.questions_file)
+    total_questions = count_questions(args.questions_file)
+    print(f"Found {total_questions} questions.")
     
     # Check which AI services to use
     use_copilot = not args.skip_copilot
@@ -738,23 +3391,85 @@ def main():
         with open(args.input_tree, 'r', encoding='utf-8') as f:
             input_tree = json.load(f)
     
+    prune = bool(input_tree and args.prune_input_tree)
+    if prune:
+        questions_data = prune_input_trees(questions_data, input_tree, args.prompt_token_budget)
+        print("Input tree pruned to each question's chapter and topic.")
+    
+    # Planning pass over a second reader of the file: find the prompts that are asked more than once
+    prompt_plan = None
+    if not args.no_dedupe and not args.batch:
+        planned_questions = iter_questions(args.questions_file)
+        if prune:
+            planned_questions = prune_input_trees(planned_questions, input_tree, args.prompt_token_budget)
+        prompt_plan = plan_prompts(planned_questions, context_tree, input_tree)
+        if prompt_plan.duplicates:
+            print(f"{prompt_plan.duplicates} repeated prompts will be answered once and shared ({prompt_plan.unique_prompts} unique prompts).")
+    
     # Process each question
-    all_results = []
-    for i, q_data in enumerate(questions_data, 1):
-        question = q_data["question"]
-        keywords = q_data.get("keywords", [])
-        print(f"\n[{i}/{len(questions_data)}] Processing: {question[:50]}...")
-        if keywords:
-            print(f"  Expected keywords: {', '.join(keywords[:5])}{'...' if len(keywords) > 5 else ''}")
-        result = process_question(question, context_tree, input_tree, use_copilot=use_copilot, expected_keywords=keywords)
-        all_results.append(result)
-        
-        # Short delay for API rate limiting (optional)
-        if i < len(questions_data):
-            time.sleep(0.5)
+    configure_provider_limits({
+        "copilot": args.max_inflight_copilot,
+        "claude": args.max_inflight_claude,
+        "chatgpt": args.max_inflight_chatgpt
+    })
+    if args.model_cache:
+        configure_model_cache(args.model_cache)
+    if args.cache or args.cache_path or args.cache_max_entries or args.cache_max_age:
+        configure_response_cache(args.cache or response_cache.mode, args.cache_path, args.cache_max_entries, args.cache_max_age)
+    configure_rate_limits(
+        rpm=parse_service_limits(args.rpm, '--rpm'),
+        tpm=parse_service_limits(args.tpm, '--tpm')
+    )
+    configure_retry_policy(max_retries=args.max_retries, budget=args.retry_budget)
+    configure_circuit_breakers(args.circuit_threshold, args.circuit_timeout)
+    
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint.jsonl"
+    checkpoint = CheckpointStore(checkpoint_path, context_tree, input_tree, resume=args.resume)
+    if args.resume:
+        print(f"Resuming from {checkpoint_path}: {checkpoint.completed_count} responses already completed.")
+    
+    writer = None
+    on_result = None
+    if args.stream:
+        log_path = args.log or f"{args.output}.jsonl"
+        writer = OutputLogWriter(log_path)
+        on_result = writer.write_result
+        print(f"Streaming results to {log_path}.")
+    
+    try:
+        if args.batch:
+            batch_state = BatchJobState(f"{args.output}.batches.json", resume=args.resume)
+            all_results = run_questions_batch(questions_data, context_tree, input_tree, use_copilot=use_copilot, on_result=on_result, checkpoint=checkpoint,
+                                              state=batch_state, poll_interval=args.batch_poll_interval, dedupe=not args.no_dedupe)
+        elif args.use_async:
+            all_results = asyncio.run(run_questions_async(questions_data, context_tree, input_tree, use_copilot=use_copilot, concurrency=args.workers, on_result=on_result, checkpoint=checkpoint,
+                                                         total=total_questions, prompt_plan=prompt_plan))
+        else:
+            all_results = run_questions(questions_data, context_tree, input_tree, use_copilot=use_copilot, workers=args.workers, parallel=not args.sequential, on_result=on_result, checkpoint=checkpoint,
+                                        total=total_questions, prompt_plan=prompt_plan)
+    finally:
+        checkpoint.close()
+        if writer is not None:
+            writer.close()
+    
+    for service, metrics in retry_policy.metrics().items():
+        if metrics["retries"] or metrics["budget_exhausted"]:
+            print(f"  [{service}] {metrics['retries']} retries over {metrics['calls']} calls: {metrics['recovered']} recovered, "
+                  f"{metrics['gave_up']} gave up, {metrics['budget_exhausted']} refused by the retry budget, {metrics['backoff_seconds']:.1f}s backoff")
+    for service, breaker in CIRCUIT_BREAKERS.items():
+        if breaker.opened_count:
+            print(f"  [{service}] Circuit breaker opened {breaker.opened_count} time(s), {breaker.rejected_count} calls skipped (now {breaker.state})")
     
     # Save results
-    save_output_tree(all_results, args.output)
+    if writer is not None:
+        summary = build_output_tree_from_log(writer.log_path, args.output)
+    else:
+        summary = save_output_tree(all_results, args.output)
+    for service, stats in summary["services"].items():
+        latency = stats["latency"]
+        if latency["p50"] is not None:
+            print(f"  [{service}] latency p50 {latency['p50']:.2f}s / p95 {latency['p95']:.2f}s / p99 {latency['p99']:.2f}s, "
+                  f"{stats['input_tokens']} input / {stats['output_tokens']} output tokens, {stats['cache_hits']} cache hits, {stats['deduplicated']} deduplicated, ~${stats['cost_usd']:.4f}")
     print(f"\nResults saved to {args.output}.")
 
 
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# web_server creates its JobManager on import; keep its job files out of the repository
+os.environ.setdefault("JOBS_DIR", tempfile.mkdtemp(prefix="test_jobs_"))
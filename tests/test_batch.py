@@ -0,0 +1,86 @@
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def env(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    monkeypatch.delenv("CHATGPT_MODEL", raising=False)
+    monkeypatch.setattr(main, "model_cache", main.ModelResolutionCache())
+
+
+def items(*questions):
+    return [{"index": index, "question": question, "input_tree": None} for index, question in enumerate(questions, 1)]
+
+
+def test_results_are_mapped_back_to_their_questions(monkeypatch):
+    submitted = []
+
+    def run_batch(service, api_key, model, system_prompt, prompts, state, poll_interval):
+        submitted.append(prompts)
+        # Results come back keyed by custom_id, not in submission order
+        return "batch_1", {"q2-chatgpt": {"error": "Batch request failed: boom"},
+                           "q1-chatgpt": {"response": "LIFO.", "usage": {"input_tokens": 5, "output_tokens": 2}}}
+
+    monkeypatch.setattr(main, "_run_openai_batch", run_batch)
+    responses = main.ask_service_batch("chatgpt", items("What is a stack?", "What is a queue?"))
+
+    assert submitted == [{"q1-chatgpt": "What is a stack?", "q2-chatgpt": "What is a queue?"}]
+    assert responses[1]["question"] == "What is a stack?" and responses[1]["response"] == "LIFO."
+    assert responses[1]["batch_id"] == "batch_1" and responses[1]["model_used"] == "gpt-4"
+    assert responses[1]["metrics"]["batch"] is True and responses[1]["metrics"]["input_tokens"] == 5
+    assert responses[2]["question"] == "What is a queue?" and responses[2]["error"] == "Batch request failed: boom"
+    assert responses[2]["response"] == ""
+
+
+def test_failed_submission_answers_every_question_with_the_error(monkeypatch):
+    def run_batch(*args):
+        raise RuntimeError("invalid input file")
+
+    monkeypatch.setattr(main, "_run_openai_batch", run_batch)
+    responses = main.ask_service_batch("copilot", items("What is a stack?", "What is a queue?"))
+    assert {index: response["error"] for index, response in responses.items()} == {1: "invalid input file", 2: "invalid input file"}
+
+
+def test_claude_resubmits_unavailable_models_with_the_next_model(monkeypatch):
+    models = []
+
+    def run_batch(api_key, model, prompts, cached_prefixes, state, poll_interval):
+        models.append((model, sorted(prompts)))
+        if model == main.CLAUDE_MODELS[0]:
+            return "batch_1", {"q1-claude": {"error": "API Error: model not found", "model_unavailable": True},
+                               "q2-claude": {"error": "API Error: overloaded", "model_unavailable": False}}
+        return "batch_2", {"q1-claude": {"response": "LIFO.", "usage": {}}}
+
+    monkeypatch.setattr(main, "_run_claude_batch", run_batch)
+    responses = main.ask_service_batch("claude", items("What is a stack?", "What is a queue?"))
+
+    assert models == [(main.CLAUDE_MODELS[0], ["q1-claude", "q2-claude"]), (main.CLAUDE_MODELS[1], ["q1-claude"])]
+    assert responses[1]["response"] == "LIFO." and responses[1]["model_used"] == main.CLAUDE_MODELS[1]
+    assert responses[2]["error"] == "API Error: overloaded"
+
+
+def test_run_questions_batch_shares_repeated_prompts(monkeypatch):
+    submitted = []
+
+    def ask_batch(service, batch_items, context_tree, state, poll_interval):
+        submitted.append((service, [item["index"] for item in batch_items]))
+        return {item["index"]: main.ServiceResponse(service, item["question"], context_tree, item["input_tree"], item["question"],
+                                                    response=f"Answer {item['index']}", metrics={"batch": True})
+                for item in batch_items}
+
+    monkeypatch.setattr(main, "ask_service_batch", ask_batch)
+    questions = [main.Question("What is a stack?", ["LIFO"]), main.Question("What is a queue?", []),
+                 main.Question("What is a stack?", ["FIFO"])]
+    results = main.run_questions_batch(questions, use_copilot=False)
+
+    assert sorted(submitted) == [("chatgpt", [1, 2]), ("claude", [1, 2])]
+    assert [result["question"] for result in results] == ["What is a stack?", "What is a queue?", "What is a stack?"]
+    for result in results:
+        assert [response["response_data"]["service"] for response in result["responses"]] == ["claude", "chatgpt"]
+    shared = results[2]["responses"][0]["response_data"]
+    assert shared["response"] == "Answer 1" and shared["metrics"]["deduplicated"] is True
+    assert "deduplicated" not in results[0]["responses"][0]["response_data"]["metrics"]
+    assert results[1]["responses"][1]["response_data"]["response"] == "Answer 2"
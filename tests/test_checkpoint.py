@@ -0,0 +1,51 @@
+import json
+
+import main
+
+
+def response(service, text="A stack is a LIFO data structure.", **fields):
+    return main.ServiceResponse(service, "What is a stack?", None, None, "Question: What is a stack?", response=text, **fields)
+
+
+def test_record_and_resume(tmp_path):
+    path = str(tmp_path / "run.checkpoint.jsonl")
+    checkpoint = main.CheckpointStore(path)
+    key = checkpoint.key("What is a stack?")
+    checkpoint.record(key, "claude", response("claude", model_used="claude-test"))
+    checkpoint.record(key, "chatgpt", response("chatgpt", error="boom"))
+    checkpoint.close()
+
+    resumed = main.CheckpointStore(path, resume=True)
+    assert resumed.completed_count == 1
+    completed = resumed.completed(key)
+    assert list(completed) == ["claude"]
+    assert completed["claude"]["response"] == "A stack is a LIFO data structure."
+    assert completed["claude"]["model_used"] == "claude-test"
+    assert resumed.completed(resumed.key("What is a queue?")) == {}
+    resumed.close()
+
+
+def test_only_offsets_are_kept_in_memory(tmp_path):
+    checkpoint = main.CheckpointStore(str(tmp_path / "run.checkpoint.jsonl"))
+    key = checkpoint.key("What is a stack?")
+    checkpoint.record(key, "copilot", response("copilot", text="x" * 10_000))
+    assert all(isinstance(offset, int) for offset in checkpoint._offsets.values())
+    # Responses recorded in this run are read back from the file
+    assert checkpoint.completed(key)["copilot"]["response"] == "x" * 10_000
+    checkpoint.close()
+
+
+def test_interrupted_last_line_is_dropped(tmp_path):
+    path = tmp_path / "run.checkpoint.jsonl"
+    checkpoint = main.CheckpointStore(str(path))
+    key = checkpoint.key("What is a stack?")
+    checkpoint.record(key, "claude", response("claude"))
+    checkpoint.close()
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"key": "' + key + '", "service": "chat')
+
+    resumed = main.CheckpointStore(str(path), resume=True)
+    resumed.record(key, "chatgpt", response("chatgpt"))
+    resumed.close()
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["service"] for line in lines] == ["claude", "chatgpt"]
@@ -0,0 +1,104 @@
+import pytest
+
+import main
+
+
+class APIError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    return now
+
+
+def call(breaker, fn):
+    return main._drive(breaker.steps(lambda: main._call_step(fn)))
+
+
+def fail(status):
+    def fn():
+        raise APIError(status)
+    return fn
+
+
+def test_opens_after_consecutive_provider_failures(clock):
+    breaker = main.CircuitBreaker("claude", failure_threshold=3, recovery_timeout=30)
+    for _ in range(3):
+        with pytest.raises(APIError):
+            call(breaker, fail(500))
+    assert breaker.state == breaker.OPEN and breaker.opened_count == 1
+
+    sent = []
+    with pytest.raises(main.CircuitOpenError):
+        call(breaker, lambda: sent.append(1))
+    assert sent == [] and breaker.rejected_count == 1
+
+
+def test_rate_limits_and_request_errors_do_not_count(clock):
+    breaker = main.CircuitBreaker("chatgpt", failure_threshold=2)
+    for status in (429, 400, 404, 429):
+        with pytest.raises(APIError):
+            call(breaker, fail(status))
+    assert breaker.state == breaker.CLOSED
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = main.CircuitBreaker("chatgpt", failure_threshold=2)
+    with pytest.raises(APIError):
+        call(breaker, fail(503))
+    assert call(breaker, lambda: "ok") == "ok"
+    with pytest.raises(APIError):
+        call(breaker, fail(503))
+    assert breaker.state == breaker.CLOSED
+
+
+def test_half_open_probe(clock):
+    breaker = main.CircuitBreaker("claude", failure_threshold=1, recovery_timeout=30)
+    with pytest.raises(APIError):
+        call(breaker, fail(401))
+    assert breaker.state == breaker.OPEN
+
+    # After the recovery timeout one probe is let through; a failed probe opens the breaker again
+    clock[0] += 30
+    with pytest.raises(APIError):
+        call(breaker, fail(500))
+    assert breaker.state == breaker.OPEN
+    with pytest.raises(main.CircuitOpenError):
+        call(breaker, lambda: "ok")
+
+    clock[0] += 30
+    probe = breaker.steps(lambda: main._call_step(lambda: "ok"))
+    next(probe)
+    assert breaker.state == breaker.HALF_OPEN
+    # Only one probe at a time
+    with pytest.raises(main.CircuitOpenError):
+        call(breaker, lambda: "ok")
+    with pytest.raises(StopIteration):
+        probe.send("ok")
+    assert breaker.state == breaker.CLOSED
+
+
+def test_cancelled_probe_frees_the_slot(clock):
+    breaker = main.CircuitBreaker("claude", failure_threshold=1, recovery_timeout=1)
+    with pytest.raises(APIError):
+        call(breaker, fail(500))
+    clock[0] += 1
+    probe = breaker.steps(lambda: main._call_step(lambda: "ok"))
+    next(probe)
+    with pytest.raises(KeyboardInterrupt):
+        probe.throw(KeyboardInterrupt())
+    assert call(breaker, lambda: "ok") == "ok"
+    assert breaker.state == breaker.CLOSED
+
+
+def test_threshold_zero_disables_the_breaker(clock):
+    breaker = main.CircuitBreaker("claude", failure_threshold=0)
+    for _ in range(10):
+        with pytest.raises(APIError):
+            call(breaker, fail(500))
+    assert call(breaker, lambda: "ok") == "ok"
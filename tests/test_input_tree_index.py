@@ -0,0 +1,58 @@
+import main
+
+TREE = {
+    "input": {
+        "Chapter 6": {
+            "Stack": ["Definition", "Application Use cases", "Comparative"],
+            "Dequeue": ["Definition", "Misleading"]
+        },
+        "Chapter 7": {
+            "Array Lists": ["Definition and Purpose", "Operations"]
+        }
+    }
+}
+
+
+def test_topic_subtree_keeps_the_root_key():
+    index = main.InputTreeIndex(TREE)
+    assert index.subtree("Chapter 6", "Stack") == {"input": {"Chapter 6": {"Stack": ["Definition", "Application Use cases", "Comparative"]}}}
+
+
+def test_names_are_matched_loosely():
+    index = main.InputTreeIndex(TREE)
+    # Case, spaces, a plural "s" and the deque/dequeue alias are ignored
+    assert index.subtree("chapter7", "array list") == {"input": {"Chapter 7": {"Array Lists": ["Definition and Purpose", "Operations"]}}}
+    assert index.subtree("Chapter 6", "Deque") == {"input": {"Chapter 6": {"Dequeue": ["Definition", "Misleading"]}}}
+    assert index.subtree("Chapter 6", "Deques") is index.subtree("CHAPTER 6", "dequeue")
+
+
+def test_falls_back_to_the_chapter_and_then_the_whole_tree():
+    index = main.InputTreeIndex(TREE)
+    assert index.subtree("Chapter 6", "Heap") == {"input": {"Chapter 6": TREE["input"]["Chapter 6"]}}
+    assert index.subtree("Chapter 9", "Stack") is TREE
+    assert index.subtree() is TREE
+
+
+def test_same_key_returns_the_same_subtree():
+    index = main.InputTreeIndex(TREE)
+    assert index.subtree("Chapter 6", "Stack") is index.subtree("chapter 6", "stacks")
+
+
+def test_token_budget_trims_the_longest_lists():
+    tree = {"input": {"Chapter 6": {"Stack": [f"Item {i} " + "x" * 40 for i in range(50)], "Queue": ["Definition"]}}}
+    index = main.InputTreeIndex(tree, token_budget=100)
+    subtree = index.subtree("Chapter 6", "Stack")
+    assert main.estimate_tokens(main.format_input_tree_for_prompt(subtree)) <= 100
+    items = subtree["input"]["Chapter 6"]["Stack"]
+    assert 0 < len(items) < 50 and items == tree["input"]["Chapter 6"]["Stack"][:len(items)]
+    # Small subtrees are left alone and the original tree is not modified
+    assert index.subtree("Chapter 6", "Queue") == {"input": {"Chapter 6": {"Queue": ["Definition"]}}}
+    assert len(tree["input"]["Chapter 6"]["Stack"]) == 50
+
+
+def test_prune_input_trees_sets_each_questions_subtree():
+    questions = [main.Question("What is a stack?", [], chapter="Chapter 6", topic="Stack"),
+                 main.Question("What is a tree?", [])]
+    pruned = list(main.prune_input_trees(iter(questions), TREE))
+    assert pruned[0]["input_tree"] == {"input": {"Chapter 6": {"Stack": ["Definition", "Application Use cases", "Comparative"]}}}
+    assert pruned[1]["input_tree"] is TREE
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def questions(*texts):
+    return [main.Question(text, []) for text in texts]
+
+
+def response(service, question, text="A stack is LIFO."):
+    return main.ServiceResponse(service, question, None, None, question, response=text, metrics={"retries": 0})
+
+
+def counting_send(service, question, sent):
+    def send_steps():
+        sent.append(question)
+        return (yield from main._call_step(lambda: response(service, question)))
+    return send_steps
+
+
+def test_repeated_prompt_is_sent_once_and_shared():
+    plan = main.plan_prompts(questions("What is a stack?", "What is a queue?", "What is a stack?"))
+    assert (plan.questions, plan.unique_prompts, plan.duplicates) == (3, 2, 1)
+    sent, deltas = [], []
+    results = [main._drive(plan.steps("claude", question, None, None, counting_send("claude", question, sent), deltas.append))
+               for question in ("What is a stack?", "What is a queue?", "What is a stack?")]
+
+    assert sent == ["What is a stack?", "What is a queue?"]
+    assert results[2]["response"] == results[0]["response"]
+    assert results[2]["metrics"]["deduplicated"] is True
+    assert "deduplicated" not in results[0]["metrics"]
+    # Only the follower's shared response is replayed as one delta
+    assert deltas == ["A stack is LIFO."]
+    # The shared response is released once its last user got it
+    assert plan._shared == {}
+
+
+def test_followers_wait_for_the_owner_on_the_event_loop():
+    plan = main.plan_prompts(questions("What is a stack?", "What is a stack?", "What is a stack?"))
+    sent = []
+
+    async def send(question):
+        sent.append(question)
+        await asyncio.sleep(0.01)
+        return response("chatgpt", question)
+
+    async def run():
+        return await asyncio.gather(*(main._drive_async(plan.steps("chatgpt", "What is a stack?", None, None,
+                                                                   lambda: main._call_step(lambda: send("What is a stack?"))))
+                                      for _ in range(3)))
+
+    results = asyncio.run(run())
+    assert sent == ["What is a stack?"]
+    assert [result.get("metrics", {}).get("deduplicated", False) for result in results] == [False, True, True]
+
+
+def test_owner_error_reaches_the_followers():
+    plan = main.plan_prompts(questions("What is a stack?", "What is a stack?"))
+
+    def failing():
+        raise RuntimeError("boom")
+        yield
+
+    with pytest.raises(RuntimeError):
+        main._drive(plan.steps("claude", "What is a stack?", None, None, failing))
+    with pytest.raises(RuntimeError):
+        main._drive(plan.steps("claude", "What is a stack?", None, None, failing))
+
+
+def test_skipped_uses_release_the_prompt():
+    plan = main.plan_prompts(questions("What is a stack?", "What is a stack?"))
+    sent = []
+    main._drive(plan.steps("claude", "What is a stack?", None, None, counting_send("claude", "What is a stack?", sent)))
+    plan.skip("claude", "What is a stack?")
+    assert sent == ["What is a stack?"]
+    assert plan._shared == {}
+
+
+def test_repeats_across_runs_are_reused_only_with_the_response_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setitem(main.ASK_FUNCTIONS, "claude", lambda question, context_tree=None, input_tree=None, on_delta=None, on_reset=None:
+                        response("claude", question))
+    sent = []
+
+    def send(api_key, request, on_delta):
+        sent.append(request["messages"][-1]["content"])
+        return "A stack is LIFO.", None
+
+    monkeypatch.setattr(main, "_openai_send", send)
+
+    def run(questions_file):
+        data = questions(*questions_file)
+        return main.run_questions(data, use_copilot=False, prompt_plan=main.plan_prompts(data))
+
+    run(["What is a stack?", "What is a stack?"])
+    run(["What is a stack?", "What is a queue?"])
+    assert sent == ["What is a stack?", "What is a stack?", "What is a queue?"]
+
+    sent.clear()
+    monkeypatch.setattr(main, "response_cache", main.ResponseCache(str(tmp_path / "cache.sqlite3"), mode="read"))
+    run(["What is a stack?", "What is a stack?"])
+    results = run(["What is a stack?", "What is a queue?"])
+    main.response_cache.close()
+    assert sent == ["What is a stack?", "What is a queue?"]
+    assert results[0]["responses"][1]["response_data"]["cache_hit"] is True
@@ -0,0 +1,54 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_no_limits_never_wait(clock):
+    limiter = main.TokenBucketLimiter()
+    assert all(limiter.reserve(10_000) == 0 for _ in range(100))
+
+
+def test_requests_per_minute(clock):
+    limiter = main.TokenBucketLimiter(rpm=60)
+    assert all(limiter.reserve() == 0 for _ in range(60))
+    # The bucket is empty: every further request waits one more second
+    assert limiter.reserve() == pytest.approx(1.0)
+    assert limiter.reserve() == pytest.approx(2.0)
+    clock[0] += 2.0
+    assert limiter.reserve() == pytest.approx(1.0)
+
+
+def test_tokens_per_minute_and_settle(clock):
+    limiter = main.TokenBucketLimiter(tpm=1200)
+    assert limiter.reserve(1000) == 0
+    assert limiter.reserve(1000) == pytest.approx(40.0)
+    # The first request used only 100 of its estimated 1000 tokens
+    limiter.settle(1000, 100)
+    assert limiter.reserve(100) == pytest.approx(0.0)
+    # A reservation larger than the bucket is capped at the bucket size
+    clock[0] += 60
+    assert limiter.reserve(10_000) == 0
+
+
+def test_pause_delays_every_request(clock):
+    limiter = main.TokenBucketLimiter(rpm=600)
+    limiter.pause(5)
+    assert limiter.reserve() == pytest.approx(5.0)
+    clock[0] += 5
+    assert limiter.reserve() == 0
+
+
+def test_acquire_sleeps_for_the_reserved_wait(clock, monkeypatch):
+    slept = []
+    monkeypatch.setattr(main.time, "sleep", slept.append)
+    limiter = main.TokenBucketLimiter(rpm=1)
+    limiter.acquire()
+    limiter.acquire()
+    assert slept == [pytest.approx(60.0)]
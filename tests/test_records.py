@@ -0,0 +1,47 @@
+import json
+
+import main
+
+
+def test_service_response_round_trip():
+    builder = main.get_prompt_builder({"context": {"Level": "Undergraduate"}}, None)
+    record = main.ServiceResponse("claude", "What is a stack?", None, None, builder, response="A stack is LIFO.",
+                                  model_used="claude-test", usage={"input_tokens": 3})
+    data = json.loads(json.dumps(record, default=main._record_to_json))
+    assert data["prompt_used"] == builder.build("What is a stack?")
+    assert "error" not in data and record.get("error") is None and "error" not in record
+
+    restored = main.ServiceResponse.from_dict(data, builder)
+    assert restored.to_dict() == data
+    assert restored._prompt is builder
+
+
+def test_unknown_keys_are_kept():
+    data = {"service": "chatgpt", "question": "What is a queue?", "context_tree": None, "input_tree": None,
+            "response": "FIFO.", "prompt_used": "What is a queue?", "finish_reason": "stop"}
+    record = main.ServiceResponse.from_dict(data)
+    assert record["finish_reason"] == "stop" and "finish_reason" in record
+    assert record.to_dict() == data
+
+    record["reviewed"] = True
+    copy = record.copy()
+    copy["reviewed"] = False
+    assert record["reviewed"] is True
+    assert list(copy) == ["service", "question", "context_tree", "input_tree", "response", "prompt_used", "finish_reason", "reviewed"]
+
+
+def test_resume_with_unknown_keys_in_the_checkpoint(tmp_path):
+    path = tmp_path / "run.checkpoint.jsonl"
+    checkpoint = main.CheckpointStore(str(path))
+    key = checkpoint.key("What is a stack?")
+    checkpoint.record(key, "claude", main.ServiceResponse("claude", "What is a stack?", None, None, "What is a stack?", response="LIFO."))
+    checkpoint.close()
+    record = json.loads(path.read_text(encoding="utf-8").splitlines()[-1])
+    record["response_data"]["stop_sequence"] = None
+    path.write_text(json.dumps(record) + "\n", encoding="utf-8")
+
+    resumed = main.CheckpointStore(str(path), resume=True)
+    completed = resumed.completed(key)
+    resumed.close()
+    assert completed["claude"]["response"] == "LIFO."
+    assert completed["claude"]["stop_sequence"] is None
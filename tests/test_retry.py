@@ -0,0 +1,119 @@
+import pytest
+
+import main
+
+
+class APIError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = type("Response", (), {"status_code": status_code, "headers": headers or {}})()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(main.time, "sleep", slept.append)
+    return slept
+
+
+def failing(errors, result="ok"):
+    """Returns a call that raises the given errors in turn, then returns result."""
+    errors = list(errors)
+    calls = []
+
+    def call():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+    call.calls = calls
+    return call
+
+
+def test_transient_errors_are_retried_with_backoff(sleeps):
+    policy = main.RetryPolicy(max_retries=3, base_delay=1.0, max_delay=60.0)
+    call = failing([APIError(503), APIError(429)])
+    retries = []
+    assert policy.call("claude", call, on_retry=lambda: retries.append(1)) == "ok"
+    assert len(call.calls) == 3
+    assert len(retries) == 2
+    assert len(sleeps) == 2 and 0 <= sleeps[0] <= 1.0 and 0 <= sleeps[1] <= 2.0
+    metrics = policy.metrics()["claude"]
+    assert (metrics["calls"], metrics["retries"], metrics["recovered"]) == (1, 2, 1)
+
+
+def test_retry_after_header_sets_the_delay(sleeps):
+    policy = main.RetryPolicy(max_retries=1, base_delay=100.0)
+    assert policy.call("chatgpt", failing([APIError(429, {"retry-after-ms": "250"})])) == "ok"
+    assert sleeps == [0.25]
+
+
+def test_request_errors_are_not_retried(sleeps):
+    policy = main.RetryPolicy(max_retries=3)
+    call = failing([APIError(400)])
+    with pytest.raises(APIError):
+        policy.call("claude", call)
+    assert len(call.calls) == 1
+    assert sleeps == []
+
+
+def test_gives_up_after_max_retries(sleeps):
+    policy = main.RetryPolicy(max_retries=2, base_delay=0.0)
+    call = failing([APIError(500)] * 5)
+    with pytest.raises(APIError):
+        policy.call("claude", call)
+    assert len(call.calls) == 3
+    assert policy.metrics()["claude"]["gave_up"] == 1
+
+
+def test_budget_is_shared_by_all_services(sleeps):
+    policy = main.RetryPolicy(max_retries=5, base_delay=0.0, budget=2)
+    assert policy.call("claude", failing([APIError(500)])) == "ok"
+    assert policy.call("chatgpt", failing([APIError(500)])) == "ok"
+    with pytest.raises(APIError):
+        policy.call("claude", failing([APIError(500)]))
+    assert policy.retries_used == 2
+    assert policy.metrics()["claude"]["budget_exhausted"] == 1
+    assert policy.renewed().retries_used == 0
+
+
+def test_run_policy_applies_in_the_service_threads(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    seen = {}
+
+    def ask(service):
+        def ask_service(question, context_tree=None, input_tree=None, on_delta=None, on_reset=None):
+            seen[service] = main.current_retry_policy()
+            return main.ServiceResponse(service, question, None, None, question, response="A stack is LIFO.")
+        return ask_service
+
+    for service in main.ASK_FUNCTIONS:
+        monkeypatch.setitem(main.ASK_FUNCTIONS, service, ask(service))
+
+    with main.use_retry_policy() as policy:
+        main.process_question("What is a stack?", parallel=True)
+    assert policy is not main.retry_policy
+    assert set(seen) == {"copilot", "claude", "chatgpt"}
+    assert all(used is policy for used in seen.values())
+    assert main.current_retry_policy() is main.retry_policy
+
+
+def test_streamed_text_is_reset_before_a_retry(monkeypatch, sleeps):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setattr(main, "retry_policy", main.RetryPolicy(max_retries=2, base_delay=0.0))
+    attempts = []
+
+    def send(api_key, request, on_delta):
+        attempts.append(1)
+        if len(attempts) == 1:
+            on_delta("A sta")
+            raise APIError(503)
+        on_delta("A stack is LIFO.")
+        return "A stack is LIFO.", None
+
+    events = []
+    response_data = main._drive(main._ask_openai_steps("chatgpt", "What is a stack?", None, None, events.append, lambda: events.append(None), send))
+    assert response_data["response"] == "A stack is LIFO."
+    assert response_data["metrics"]["retries"] == 1
+    assert events == ["A sta", None, "A stack is LIFO."]
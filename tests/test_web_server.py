@@ -0,0 +1,144 @@
+import io
+import os
+import re
+import shutil
+import subprocess
+import threading
+
+import pytest
+
+import web_server
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "uploads").mkdir()
+    monkeypatch.setattr(web_server, "jobs", web_server.JobManager(str(tmp_path / "jobs"), workers=1))
+    return web_server.app.test_client()
+
+
+def test_index_renders(client):
+    response = client.get("/")
+    assert response.status_code == 200
+    assert b"<script" in response.data
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="node is not installed")
+def test_index_script_parses(client, tmp_path):
+    html = client.get("/").get_data(as_text=True)
+    script_path = tmp_path / "page.js"
+    script_path.write_text("\n".join(re.findall(r"<script[^>]*>(.*?)</script>", html, re.S)), encoding="utf-8")
+    result = subprocess.run(["node", "--check", str(script_path)], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+def test_upload_and_submit_job(client, monkeypatch):
+    ran = []
+    monkeypatch.setattr(web_server, "run_job_events", lambda job: ran.append(job.filename) or iter([{"type": "complete", "output_file": ""}]))
+    response = client.post("/upload", data={"file": (io.BytesIO(b"What is a stack?\n"), "my questions.txt")})
+    assert response.get_json() == {"success": True, "filename": "my_questions.txt"}
+
+    response = client.post("/jobs", json={"filename": "my_questions.txt"})
+    assert response.status_code == 200
+    job = web_server.jobs.get(response.get_json()["job_id"])
+    for _ in job.follow(keepalive=1):
+        pass
+    assert job.status == "completed"
+    assert ran == ["my_questions.txt"]
+
+
+@pytest.mark.parametrize("filename", ["../secret.txt", "/etc/passwd", "sub/questions.txt", ""])
+def test_submit_rejects_paths_outside_uploads(client, tmp_path, filename):
+    (tmp_path / "secret.txt").write_text("What is a secret?\n", encoding="utf-8")
+    response = client.post("/jobs", json={"filename": filename})
+    assert response.status_code == 404
+    assert web_server.jobs.list() == []
+
+
+def test_job_events_are_replayed_from_the_log(tmp_path):
+    job = web_server.Job("job1", "questions.txt")
+    job.dir = str(tmp_path)
+    job.events_path = str(tmp_path / "events.jsonl")
+    job.state_path = str(tmp_path / "state.json")
+    job.set_status("running")
+    for i in range(5):
+        job.emit({"type": "delta", "service": "claude", "text": str(i)})
+    job.set_status("completed")
+
+    assert [index for index, _ in job.follow()] == [0, 1, 2, 3, 4]
+    assert [event["text"] for _, event in job.follow(start=3)] == ["3", "4"]
+    # A job loaded from disk counts the events in its log
+    loaded = web_server.Job.load(str(tmp_path))
+    loaded.events_path = job.events_path
+    assert loaded.event_count() == 5
+
+
+def test_finished_jobs_beyond_retention_are_deleted(tmp_path, monkeypatch):
+    monkeypatch.setattr(web_server, "run_job_events", lambda job: iter([{"type": "complete", "output_file": ""}]))
+    manager = web_server.JobManager(str(tmp_path / "jobs"), workers=1, retention=2)
+    created = []
+    for i in range(4):
+        job, _ = manager.submit(f"q{i}.txt")
+        for _ in job.follow(keepalive=1):
+            pass
+        created.append(job)
+    manager._executor.shutdown(wait=True)
+
+    assert [state["filename"] for state in manager.list()] == ["q3.txt", "q2.txt"]
+    assert not os.path.exists(created[0].dir)
+    assert os.path.exists(created[3].dir)
+
+
+def test_upload_refuses_to_replace_a_file_in_use(client, monkeypatch):
+    release = threading.Event()
+
+    def run_job_events(job):
+        release.wait(5)
+        yield {"type": "complete", "output_file": ""}
+
+    monkeypatch.setattr(web_server, "run_job_events", run_job_events)
+    upload = lambda content: client.post("/upload", data={"file": (io.BytesIO(content), "q.txt")})
+    assert upload(b"What is a queue?\n").get_json()["success"]
+    job_id = client.post("/jobs", json={"filename": "q.txt"}).get_json()["job_id"]
+
+    # The same content attaches to the running job, different content is refused
+    assert upload(b"What is a queue?\n").get_json()["success"]
+    response = upload(b"What is a deque?\n")
+    assert response.status_code == 409
+    assert not response.get_json()["success"]
+
+    release.set()
+    for _ in web_server.jobs.get(job_id).follow(keepalive=1):
+        pass
+    web_server.jobs._executor.shutdown(wait=True)
+    assert upload(b"What is a deque?\n").get_json()["success"]
+
+
+def test_stream_reset_is_relayed_and_jobs_get_their_own_retry_budget(client, tmp_path, monkeypatch):
+    import main
+
+    (tmp_path / "uploads" / "q.txt").write_text("What is a stack?\n", encoding="utf-8")
+    policies = []
+
+    def process_question(question, context_tree=None, input_tree=None, on_delta=None, on_stream_reset=None, **options):
+        policies.append(main.current_retry_policy())
+        on_delta("claude", "A sta")
+        on_stream_reset("claude")
+        on_delta("claude", "A stack is LIFO.")
+        response_data = main.ServiceResponse("claude", question, None, None, question, response="A stack is LIFO.")
+        options["on_service_response"]("claude", response_data)
+        return {"question": question, "expected_keywords": [], "responses": [main.categorize_response(response_data)]}
+
+    monkeypatch.setattr(web_server, "process_question", process_question)
+    job = web_server.Job("job1", "q.txt")
+    job.output_path = str(tmp_path / "output.json")
+    events = [event for event in web_server.run_job_events(job) if event["type"] in ("delta", "service_retry", "service_done", "error")]
+
+    assert events == [
+        {"type": "delta", "service": "claude", "text": "A sta"},
+        {"type": "service_retry", "service": "claude"},
+        {"type": "delta", "service": "claude", "text": "A stack is LIFO."},
+        {"type": "service_done", "service": "claude", "error": ""}
+    ]
+    assert policies[0] is not main.retry_policy
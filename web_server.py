@@ -4,7 +4,7 @@ Test Automation Tool Web Server
 HTML 인터페이스를 통해 파일을 선택하고 실행할 수 있는 웹 서버
 """
 
-from flask import Flask, render_template_string, request, jsonify, Response, stream_with_context
+from flask import Flask, render_template_string, request, jsonify, Response, stream_with_context, send_file
 from flask_cors import CORS
 import os
 import sys
@@ -12,19 +12,20 @@ import json
 import subprocess
 import threading
 import queue
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from werkzeug.utils import secure_filename
 
 # main.py의 함수들을 import
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from main import read_questions, process_question, save_output_tree, validate_context_tree
+from main import iter_questions, count_questions, plan_prompts, process_question, save_output_tree, validate_context_tree, CheckpointStore, checkpoint_options, current_retry_policy, use_retry_policy
 
 app = Flask(__name__)
 CORS(app)
 
-# 전역 변수로 실행 상태 관리
-execution_queue = queue.Queue()
-current_execution = None
-
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="en">
@@ -279,6 +280,10 @@ HTML_TEMPLATE = """
                 <div class="file-name" id="questionsFileName"></div>
             </div>
             
+            <div class="form-group">
+                <label><input type="checkbox" id="resumeRun"> Resume from the checkpoint of the last run of this file</label>
+            </div>
+            
             <button type="submit" class="btn" id="submitBtn">Run</button>
         </form>
         
@@ -474,7 +479,7 @@ HTML_TEMPLATE = """
                 
                 const result = await response.json();
                 if (result.success) {
-                    startProgress(result.filename);
+                    await startJob(result.filename);
                 } else {
                     showStatus('File upload failed: ' + result.error, 'error');
                     document.getElementById('submitBtn').disabled = false;
@@ -485,12 +490,30 @@ HTML_TEMPLATE = """
             }
         });
         
-        function startProgress(filename) {
+        async function startJob(filename) {
+            const response = await fetch('/jobs', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ filename: filename, resume: document.getElementById('resumeRun').checked })
+            });
+            const result = await response.json();
+            if (!result.success) {
+                throw new Error(result.error);
+            }
+            if (!result.created) {
+                addLog('A run for this file is already in progress; attaching to it.');
+            }
+            attachJob(result.job_id);
+        }
+
+        // The job keeps running on the server; its id is kept so a reloaded page can re-attach
+        function attachJob(jobId) {
             if (eventSource) {
                 eventSource.close();
             }
+            localStorage.setItem('jobId', jobId);
             
-            eventSource = new EventSource(`/run/${filename}`);
+            eventSource = new EventSource(`/jobs/${jobId}/events`);
             
             eventSource.onmessage = function(event) {
                 const data = JSON.parse(event.data);
@@ -499,26 +522,71 @@ HTML_TEMPLATE = """
                     updateProgress(data.current, data.total, data.message);
                 } else if (data.type === 'log') {
                     addLog(data.message);
+                } else if (data.type === 'delta') {
+                    appendDelta(data.service, data.text);
+                } else if (data.type === 'service_retry') {
+                    resetDelta(data.service);
+                } else if (data.type === 'service_done') {
+                    finishDelta(data.service);
                 } else if (data.type === 'classification') {
                     // Update statistics when classification data is received
                     updateStatistics(data.service, data.result);
                 } else if (data.type === 'complete') {
                     eventSource.close();
+                    localStorage.removeItem('jobId');
                     document.getElementById('submitBtn').disabled = false;
                     displayStatistics();
                     showStatus('Complete! Results saved to ' + data.output_file, 'success');
                 } else if (data.type === 'error') {
                     eventSource.close();
+                    localStorage.removeItem('jobId');
                     document.getElementById('submitBtn').disabled = false;
                     showStatus('Error: ' + data.message, 'error');
                 }
             };
             
-            eventSource.onerror = function() {
-                eventSource.close();
-                document.getElementById('submitBtn').disabled = false;
+            // On connection errors EventSource reconnects by itself and resumes after the last event id;
+            // it only has to be stopped when the job is no longer running
+            eventSource.onerror = async function() {
+                let job = null;
+                try {
+                    const response = await fetch(`/jobs/${jobId}`);
+                    job = response.ok ? await response.json() : null;
+                } catch (error) {
+                    return;
+                }
+                if (!job || (job.status !== 'queued' && job.status !== 'running')) {
+                    eventSource.close();
+                    localStorage.removeItem('jobId');
+                    document.getElementById('submitBtn').disabled = false;
+                    if (job && job.status === 'interrupted') {
+                        showStatus('The run was interrupted by a server restart. Run it again with "Resume" checked to continue from the checkpoint.', 'error');
+                    }
+                }
             };
         }
+
+        // Re-attach to a job that was still running when the page was closed or reloaded
+        window.addEventListener('load', async function() {
+            const jobId = localStorage.getItem('jobId');
+            if (!jobId) {
+                return;
+            }
+            const response = await fetch(`/jobs/${jobId}`);
+            if (!response.ok) {
+                localStorage.removeItem('jobId');
+                return;
+            }
+            const job = await response.json();
+            if (job.status !== 'queued' && job.status !== 'running') {
+                localStorage.removeItem('jobId');
+                return;
+            }
+            document.getElementById('submitBtn').disabled = true;
+            document.getElementById('progressContainer').classList.add('active');
+            resetStats();
+            attachJob(jobId);
+        });
         
         function updateProgress(current, total, message) {
             const percentage = total > 0 ? Math.round((current / total) * 100) : 0;
@@ -575,6 +643,37 @@ HTML_TEMPLATE = """
             }
         }
         
+        // Text node of the response currently being streamed into each service's column
+        let streaming = {};
+
+        function appendDelta(service, text) {
+            const outputElement = document.getElementById(service + 'Output');
+            if (!outputElement) {
+                return;
+            }
+            if (!streaming[service]) {
+                outputElement.appendChild(document.createTextNode('\\n--- ' + service.toUpperCase() + ' (streaming) ---\\n'));
+                streaming[service] = outputElement.appendChild(document.createTextNode(''));
+            }
+            streaming[service].appendData(text);
+            outputElement.scrollTop = outputElement.scrollHeight;
+        }
+
+        // The request was sent again; the text streamed so far is replaced by the new attempt's
+        function resetDelta(service) {
+            if (streaming[service]) {
+                streaming[service].data = '';
+            }
+        }
+
+        function finishDelta(service) {
+            const outputElement = document.getElementById(service + 'Output');
+            if (streaming[service] && outputElement) {
+                outputElement.appendChild(document.createTextNode('\\n'));
+            }
+            streaming[service] = null;
+        }
+        
         function showStatus(message, type) {
             const status = document.getElementById('status');
             status.textContent = message;
@@ -590,6 +689,12 @@ HTML_TEMPLATE = """
 def index():
     return render_template_string(HTML_TEMPLATE)
 
+def upload_path(filename):
+    """Path of an uploaded file in uploads/; None for names that could point outside of it."""
+    if not filename or secure_filename(filename) != filename:
+        return None
+    return os.path.join('uploads', filename)
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -600,122 +705,480 @@ def upload_file():
         return jsonify({'success': False, 'error': 'No file selected'})
     
     if file and file.filename.endswith('.txt'):
-        filename = file.filename
-        filepath = os.path.join('uploads', filename)
+        filename = secure_filename(file.filename)
+        filepath = upload_path(filename)
+        if filepath is None:
+            return jsonify({'success': False, 'error': 'Invalid file name'})
+        # A running job reads its questions file lazily, so it must not change under it;
+        # uploading the same content again just attaches to that job
+        if jobs.active(filename) is not None:
+            with open(filepath, 'rb') as f:
+                unchanged = f.read() == file.read()
+            if unchanged:
+                return jsonify({'success': True, 'filename': filename})
+            return jsonify({'success': False, 'error': f'A job is still running on {filename}; wait for it to finish or upload under another name'}), 409
         os.makedirs('uploads', exist_ok=True)
         file.save(filepath)
         return jsonify({'success': True, 'filename': filename})
     
     return jsonify({'success': False, 'error': 'Invalid file format'})
 
-@app.route('/run/<filename>')
-def run_test(filename):
-    def generate():
-        filepath = os.path.join('uploads', filename)
+JOBS_DIR = os.getenv('JOBS_DIR', 'jobs')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+# Finished jobs kept (with their directories) before the oldest are deleted
+JOB_RETENTION = int(os.getenv('JOB_RETENTION', '100'))
+
+
+class Job:
+    """A test run executed in the background.
+
+    Every event the run produces is appended to jobs/<id>/events.jsonl
+    through one open handle, so SSE clients can attach at any time and replay
+    the log from the start; events are not kept in memory. The job's state is kept in jobs/<id>/state.json
+    and its results are written to jobs/<id>/output.json.
+    """
+
+    def __init__(self, job_id, filename, resume=False, state=None):
+        self.id = job_id
+        self.filename = filename
+        self.resume = resume
+        self.dir = os.path.join(JOBS_DIR, job_id)
+        self.output_path = os.path.join(self.dir, 'output.json')
+        self.events_path = os.path.join(self.dir, 'events.jsonl')
+        self.state_path = os.path.join(self.dir, 'state.json')
+        state = state or {}
+        self.status = state.get('status', 'queued')
+        self.created_at = state.get('created_at', time.time())
+        self.started_at = state.get('started_at')
+        self.finished_at = state.get('finished_at')
+        self.progress = state.get('progress', {'current': 0, 'total': 0})
+        self.error = state.get('error')
+        # Number of events in the log (counted on first use for jobs loaded from disk)
+        self._event_count = None if state else 0
+        self._log = None
+        self._condition = threading.Condition()
+        os.makedirs(self.dir, exist_ok=True)
+
+    @classmethod
+    def load(cls, job_dir):
+        """Loads a job from its state file; jobs that were still running are marked interrupted."""
+        with open(os.path.join(job_dir, 'state.json'), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        job = cls(state['id'], state['filename'], state.get('resume', False), state)
+        if job.status in ('queued', 'running'):
+            job.status = 'interrupted'
+            job.save_state()
+        return job
+
+    @property
+    def finished(self):
+        return self.status in ('completed', 'failed', 'interrupted')
+
+    def event_count(self):
+        with self._condition:
+            if self._event_count is None:
+                self._event_count = 0
+                if os.path.exists(self.events_path):
+                    with open(self.events_path, 'r', encoding='utf-8') as f:
+                        self._event_count = sum(1 for line in f if line.strip())
+            return self._event_count
+
+    def state(self):
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'resume': self.resume,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'progress': self.progress,
+            'error': self.error,
+            'output_file': self.output_path if self.status == 'completed' else None
+        }
+
+    def save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def emit(self, event):
+        """Appends an event to the job's log and wakes up attached clients."""
+        with self._condition:
+            count = self.event_count()
+            if self._log is None:
+                self._log = open(self.events_path, 'a', encoding='utf-8')
+            self._log.write(json.dumps(event, ensure_ascii=False) + '\n')
+            # Readers only read up to _event_count, so every counted line is complete on disk
+            self._log.flush()
+            self._event_count = count + 1
+            if event['type'] == 'progress':
+                self.progress = {'current': event['current'], 'total': event['total']}
+                self.save_state()
+            elif event['type'] == 'error':
+                self.error = event['message']
+            self._condition.notify_all()
+
+    def set_status(self, status):
+        with self._condition:
+            self.status = status
+            if status == 'running':
+                self.started_at = time.time()
+            elif self.finished:
+                self.finished_at = time.time()
+                if self._log is not None:
+                    self._log.close()
+                    self._log = None
+            self.save_state()
+            self._condition.notify_all()
+
+    def follow(self, start=0, keepalive=15.0):
+        """Yields (index, event) from event number start on, waiting for new ones until the job finishes.
+
+        Yields (None, None) every keepalive seconds without events, so the SSE
+        response can send a comment and notice disconnected clients.
+        """
+        index = 0
+        offset = 0
+        while True:
+            with self._condition:
+                if max(index, start) >= self.event_count() and not self.finished:
+                    self._condition.wait(keepalive)
+                available = self.event_count()
+                finished = self.finished
+            if max(index, start) < available:
+                pending = []
+                try:
+                    f = open(self.events_path, 'r', encoding='utf-8')
+                except FileNotFoundError:
+                    # The job was deleted by the retention limit
+                    return
+                with f:
+                    f.seek(offset)
+                    while index < available:
+                        line = f.readline()
+                        if index >= start:
+                            pending.append((index, json.loads(line)))
+                        index += 1
+                    offset = f.tell()
+                yield from pending
+            elif finished:
+                return
+            else:
+                yield None, None
+
+
+class JobManager:
+    """Runs jobs on a fixed pool of worker threads.
+
+    Only one job per questions file can be queued or running at a time:
+    starting it again returns the active job, so two browser tabs share one
+    run instead of doing the work twice. Only the newest `retention` finished
+    jobs are kept; older ones are forgotten and their directories deleted.
+    """
+
+    def __init__(self, jobs_dir=JOBS_DIR, workers=JOB_WORKERS, retention=JOB_RETENTION):
+        self.jobs_dir = jobs_dir
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+        os.makedirs(jobs_dir, exist_ok=True)
+        for name in sorted(os.listdir(jobs_dir)):
+            job_dir = os.path.join(jobs_dir, name)
+            if os.path.exists(os.path.join(job_dir, 'state.json')):
+                try:
+                    job = Job.load(job_dir)
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"Warning: Could not load job {name}: {e}")
+                    continue
+                self._jobs[job.id] = job
+        self._prune()
+
+    def _prune(self):
+        """Deletes the oldest finished jobs beyond the retention limit."""
+        with self._lock:
+            finished = sorted((job for job in self._jobs.values() if job.finished), key=lambda job: job.finished_at or job.created_at)
+            expired = finished[:max(0, len(finished) - self.retention)]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            shutil.rmtree(job.dir, ignore_errors=True)
+
+    def _active(self, filename):
+        for job in self._jobs.values():
+            if job.filename == filename and not job.finished:
+                return job
+        return None
+
+    def active(self, filename):
+        """Returns the queued or running job for a questions file, or None."""
+        with self._lock:
+            return self._active(filename)
+
+    def submit(self, filename, resume=False):
+        """Starts a job for an uploaded questions file; returns (job, whether it was newly created)."""
+        with self._lock:
+            job = self._active(filename)
+            if job is not None:
+                return job, False
+            job = Job(uuid.uuid4().hex[:12], filename, resume)
+            job.save_state()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job)
+        return job, True
+
+    def _run(self, job):
+        job.set_status('running')
+        try:
+            for event in run_job_events(job):
+                job.emit(event)
+        except Exception as e:
+            job.emit({'type': 'error', 'message': str(e)})
+        job.set_status('failed' if job.error else 'completed')
+        self._prune()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return sorted((job.state() for job in self._jobs.values()), key=lambda state: state['created_at'], reverse=True)
+
+
+def run_job_events(job):
+    """Runs a job's questions file and yields the events sent to its SSE clients."""
+    filepath = upload_path(job.filename)
+    resume = job.resume
+    checkpoint = None
+    
+    if filepath is None or not os.path.exists(filepath):
+        yield {'type': 'error', 'message': 'File not found'}
+        return
+    
+    try:
+        # Questions are read lazily as the job goes on
+        questions = iter_questions(filepath)
+        total = count_questions(filepath)
         
-        if not os.path.exists(filepath):
-            yield f"data: {json.dumps({'type': 'error', 'message': 'File not found'})}\n\n"
-            return
+        yield {'type': 'log', 'message': f'Found {total} questions.'}
         
-        try:
-            # Read questions
-            questions = read_questions(filepath)
-            total = len(questions)
+        # Automatically find Context tree and Input tree (optional)
+        context_tree = None
+        input_tree = None
+        
+        # Auto-find in the same directory
+        base_dir = os.path.dirname(filepath) or '.'
+        context_path = os.path.join(base_dir, 'example_context_tree.json')
+        input_path = os.path.join(base_dir, 'example_input_tree.json')
+        
+        if os.path.exists(context_path):
+            with open(context_path, 'r', encoding='utf-8') as f:
+                context_tree = json.load(f)
+            yield {'type': 'log', 'message': 'Found Context tree.'}
+        
+        if os.path.exists(input_path):
+            with open(input_path, 'r', encoding='utf-8') as f:
+                input_tree = json.load(f)
+            yield {'type': 'log', 'message': 'Found Input tree.'}
+        
+        # Repeated prompts are asked once and their responses shared
+        prompt_plan = plan_prompts(iter_questions(filepath), context_tree, input_tree)
+        if prompt_plan.duplicates:
+            yield {'type': 'log', 'message': f'{prompt_plan.duplicates} repeated prompts will be answered once and shared.'}
+        
+        # Every response is checkpointed as it arrives so an interrupted run can be resumed
+        checkpoint = CheckpointStore(filepath + '.checkpoint.jsonl', context_tree, input_tree, resume=resume)
+        if resume:
+            yield {'type': 'log', 'message': f'Resuming: {checkpoint.completed_count} responses already completed.'}
+        
+        # Every job gets its own retry budget, so concurrent and earlier jobs cannot use it up
+        retry_policy = current_retry_policy().renewed()
+        
+        # Process each question
+        all_results = []
+        for i, q_data in enumerate(questions, 1):
+            question = q_data["question"]
+            keywords = q_data.get("keywords", [])
+            yield {'type': 'progress', 'current': i, 'total': total, 'message': f'[{i}/{total}] Processing: {question[:50]}...'}
             
-            yield f"data: {json.dumps({'type': 'log', 'message': f'Read {total} questions.'})}\n\n"
+            if keywords:
+                keywords_display = ", ".join(keywords[:5])
+                if len(keywords) > 5:
+                    keywords_display += "..."
+                keywords_msg = f"Expected keywords: {keywords_display}"
+                yield {'type': 'log', 'message': keywords_msg}
             
-            # Automatically find Context tree and Input tree (optional)
-            context_tree = None
-            input_tree = None
+            # Run the question in a worker thread and relay its token deltas as they arrive
+            options = checkpoint_options(checkpoint, q_data)
+            record_response = options.get("on_service_response")
+            events = queue.Queue()
+            streamed_services = set()
             
-            # Auto-find in the same directory
-            base_dir = os.path.dirname(filepath) or '.'
-            context_path = os.path.join(base_dir, 'example_context_tree.json')
-            input_path = os.path.join(base_dir, 'example_input_tree.json')
+            def on_delta(service, text, events=events):
+                events.put(('event', {'type': 'delta', 'service': service, 'text': text}))
             
-            if os.path.exists(context_path):
-                with open(context_path, 'r', encoding='utf-8') as f:
-                    context_tree = json.load(f)
-                yield f"data: {json.dumps({'type': 'log', 'message': 'Found Context tree.'})}\n\n"
+            def on_stream_reset(service, events=events):
+                events.put(('event', {'type': 'service_retry', 'service': service}))
             
-            if os.path.exists(input_path):
-                with open(input_path, 'r', encoding='utf-8') as f:
-                    input_tree = json.load(f)
-                yield f"data: {json.dumps({'type': 'log', 'message': 'Found Input tree.'})}\n\n"
+            def on_service_response(service, response_data, events=events, record_response=record_response):
+                if record_response is not None:
+                    record_response(service, response_data)
+                events.put(('event', {'type': 'service_done', 'service': service, 'error': response_data.get('error', '')}))
             
-            # Process each question
-            all_results = []
-            for i, q_data in enumerate(questions, 1):
-                question = q_data["question"]
-                keywords = q_data.get("keywords", [])
-                yield f"data: {json.dumps({'type': 'progress', 'current': i, 'total': total, 'message': f'[{i}/{total}] Processing: {question[:50]}...'})}\n\n"
-                
-                if keywords:
-                    keywords_display = ", ".join(keywords[:5])
-                    if len(keywords) > 5:
-                        keywords_display += "..."
-                    keywords_msg = f"Expected keywords: {keywords_display}"
-                    yield f"data: {json.dumps({'type': 'log', 'message': keywords_msg})}\n\n"
-                
-                result = process_question(question, context_tree, input_tree, use_copilot=True, expected_keywords=keywords)
-                all_results.append(result)
-                
-                # Display prompt_used and response for each AI service
-                for response_item in result["responses"]:
-                    response_data = response_item.get("response_data", {})
-                    service = response_data.get("service", "unknown")
-                    prompt_used = response_data.get("prompt_used", "")
-                    ai_response = response_data.get("response", "")
-                    error = response_data.get("error", "")
-                    keyword_analysis = response_data.get("keyword_analysis")
-                    validity = response_item.get("validity", "Invalid")
-                    result_classification = response_item.get("result", "No Response from AI")
-
-                    service_header = f"\n--- {service.upper()} ---"
-                    yield f"data: {json.dumps({'type': 'log', 'message': service_header})}\n\n"
-
-                    # Send classification result to client for statistics
-                    yield f"data: {json.dumps({'type': 'classification', 'service': service, 'validity': validity, 'result': result_classification})}\n\n"
-
-                    if error:
-                        yield f"data: {json.dumps({'type': 'log', 'message': f'Error: {error}'})}\n\n"
-                    else:
-                        if prompt_used:
-                            prompt_preview = prompt_used[:200] + "..." if len(prompt_used) > 200 else prompt_used
-                            yield f"data: {json.dumps({'type': 'log', 'message': f'Prompt: {prompt_preview}'})}\n\n"
-                        if ai_response:
-                            response_preview = ai_response[:300] + "..." if len(ai_response) > 300 else ai_response
-                            yield f"data: {json.dumps({'type': 'log', 'message': f'Response: {response_preview}'})}\n\n"
-                        else:
-                            yield f"data: {json.dumps({'type': 'log', 'message': 'Response: (empty)'})}\n\n"
-
-                        # Display keyword analysis if available
-                        if keyword_analysis:
-                            match_ratio = keyword_analysis.get("match_ratio", 0)
-                            found_count = len(keyword_analysis.get("found_keywords", []))
-                            total_count = len(keyword_analysis.get("expected_keywords", []))
-                            keywords_msg = f"Keywords: {found_count}/{total_count} found ({match_ratio*100:.0f}%)"
-                            yield f"data: {json.dumps({'type': 'log', 'message': keywords_msg})}\n\n"
-                            if keyword_analysis.get("missing_keywords"):
-                                missing = keyword_analysis["missing_keywords"][:3]
-                                missing_display = ", ".join(missing)
-                                if len(keyword_analysis["missing_keywords"]) > 3:
-                                    missing_display += "..."
-                                missing_msg = f"Missing: {missing_display}"
-                                yield f"data: {json.dumps({'type': 'log', 'message': missing_msg})}\n\n"
+            options["on_service_response"] = on_service_response
             
-            # Save results
-            output_file = 'output.json'
-            save_output_tree(all_results, output_file)
+            def ask(events=events, options=options):
+                try:
+                    with use_retry_policy(retry_policy):
+                        events.put(('result', process_question(question, context_tree, input_tree, use_copilot=True, expected_keywords=keywords,
+                                                               on_delta=on_delta, on_stream_reset=on_stream_reset, prompt_plan=prompt_plan, **options)))
+                except Exception as e:
+                    events.put(('exception', e))
             
-            yield f"data: {json.dumps({'type': 'log', 'message': f'Results saved to {output_file}.'})}\n\n"
-            yield f"data: {json.dumps({'type': 'complete', 'output_file': output_file})}\n\n"
+            threading.Thread(target=ask, daemon=True).start()
+            while True:
+                kind, payload = events.get()
+                if kind == 'result':
+                    result = payload
+                    break
+                if kind == 'exception':
+                    raise payload
+                if payload['type'] == 'delta':
+                    streamed_services.add(payload['service'])
+                yield payload
+            all_results.append(result)
             
-        except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+            # Display prompt_used and response for each AI service
+            for response_item in result["responses"]:
+                response_data = response_item.get("response_data", {})
+                service = response_data.get("service", "unknown")
+                prompt_used = response_data.get("prompt_used", "")
+                ai_response = response_data.get("response", "")
+                error = response_data.get("error", "")
+                keyword_analysis = response_data.get("keyword_analysis")
+                validity = response_item.get("validity", "Invalid")
+                result_classification = response_item.get("result", "No Response from AI")
+
+                service_header = f"\n--- {service.upper()} ---"
+                yield {'type': 'log', 'message': service_header}
+
+                # Send classification result to client for statistics
+                yield {'type': 'classification', 'service': service, 'validity': validity, 'result': result_classification}
+
+                if error:
+                    yield {'type': 'log', 'message': f'Error: {error}'}
+                else:
+                    if prompt_used:
+                        prompt_preview = prompt_used[:200] + "..." if len(prompt_used) > 200 else prompt_used
+                        yield {'type': 'log', 'message': f'Prompt: {prompt_preview}'}
+                    if not ai_response:
+                        yield {'type': 'log', 'message': 'Response: (empty)'}
+                    elif service not in streamed_services:
+                        # Streamed responses are already shown in full
+                        response_preview = ai_response[:300] + "..." if len(ai_response) > 300 else ai_response
+                        yield {'type': 'log', 'message': f'Response: {response_preview}'}
+
+                    # Display keyword analysis if available
+                    if keyword_analysis:
+                        match_ratio = keyword_analysis.get("match_ratio", 0)
+                        found_count = len(keyword_analysis.get("found_keywords", []))
+                        total_count = len(keyword_analysis.get("expected_keywords", []))
+                        keywords_msg = f"Keywords: {found_count}/{total_count} found ({match_ratio*100:.0f}%)"
+                        yield {'type': 'log', 'message': keywords_msg}
+                        if keyword_analysis.get("missing_keywords"):
+                            missing = keyword_analysis["missing_keywords"][:3]
+                            missing_display = ", ".join(missing)
+                            if len(keyword_analysis["missing_keywords"]) > 3:
+                                missing_display += "..."
+                            missing_msg = f"Missing: {missing_display}"
+                            yield {'type': 'log', 'message': missing_msg}
+        
+        # Save results (one result file per job, so concurrent jobs never overwrite each other)
+        output_file = job.output_path
+        save_output_tree(all_results, output_file)
+        
+        yield {'type': 'log', 'message': f'Results saved to {output_file}.'}
+        yield {'type': 'complete', 'output_file': output_file}
+        
+    except Exception as e:
+        yield {'type': 'error', 'message': str(e)}
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+
+jobs = JobManager()
+
+
+def stream_job_events(job, start=0):
+    """SSE response that replays a job's events from number start and follows it until it finishes."""
+    def generate():
+        for index, event in job.follow(start):
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"id: {index}\ndata: {json.dumps(event)}\n\n"
     
     return Response(stream_with_context(generate()), mimetype='text/event-stream')
 
+
+@app.route('/jobs', methods=['GET', 'POST'])
+def job_list():
+    if request.method == 'GET':
+        return jsonify({'jobs': jobs.list()})
+    
+    data = request.get_json(silent=True) or request.form
+    filepath = upload_path(data.get('filename', ''))
+    if filepath is None or not os.path.exists(filepath):
+        return jsonify({'success': False, 'error': 'File not found'}), 404
+    filename = data['filename']
+    # resume skips the (question, service) pairs already saved in the file's checkpoint
+    job, created = jobs.submit(filename, resume=str(data.get('resume', '')).lower() in ('1', 'true'))
+    return jsonify({'success': True, 'job_id': job.id, 'created': created, 'job': job.state()})
+
+
+@app.route('/jobs/<job_id>')
+def job_state(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    return jsonify(job.state())
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    # EventSource reconnects with Last-Event-ID; ?from=N replays from event N
+    last_event_id = request.headers.get('Last-Event-ID')
+    start = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else request.args.get('from', 0, type=int)
+    return stream_job_events(job, start)
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None or job.status != 'completed' or not os.path.exists(job.output_path):
+        return jsonify({'success': False, 'error': 'Result not available'}), 404
+    return send_file(os.path.abspath(job.output_path), mimetype='application/json', as_attachment=True,
+                     download_name=f"output_{job.id}.json")
+
+
+@app.route('/run/<filename>')
+def run_test(filename):
+    """Starts (or attaches to) the job for an uploaded file and streams its events."""
+    filepath = upload_path(filename)
+    if filepath is None or not os.path.exists(filepath):
+        return Response(f"data: {json.dumps({'type': 'error', 'message': 'File not found'})}\n\n", mimetype='text/event-stream')
+    # ?resume=1 skips the (question, service) pairs already saved in the checkpoint
+    job, _ = jobs.submit(filename, resume=request.args.get('resume') == '1')
+    return stream_job_events(job)
+
+
 if __name__ == '__main__':
     os.makedirs('uploads', exist_ok=True)
     print("Starting web server...")